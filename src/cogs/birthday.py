@@ -12,6 +12,33 @@ from discord.ext import tasks
 from cogs.utils import discord_utils
 from cogs.utils import embed_templates
 from cogs.utils import misc_utils
+from cogs.utils.birthday_calendar import BirthdayCalendar
+
+BIRTHDAY_CHANNEL_ID = 747542544291987597
+
+# Upcoming birthdays listed by /bursdag kommende. Ten pages of the paginator
+UPCOMING_BIRTHDAYS_LIMIT = 100
+
+# query_members accepts at most 100 user IDs per request
+QUERY_MEMBERS_BATCH_SIZE = 100
+
+GREETINGS = (
+    "Gratulerer med dagen {mention}! 🥳",
+    "GRALLA BALLA!!! {mention}",
+    "Hurra for deg som fyller år i dag! {mention}",
+    "HOLY HECKIN' POGGERS legenden {mention} har bursdag i dag POG POG POG",
+    "Cakes and candles brother! 🙏 {mention}",
+    "Som en AI-chatbot kan jeg ikke generere så personlige ting som bursdagshilsener for deg... "
+    + "nei vent jeg er jo et menneske. Til lykke med dagen {mention}!",
+    "{mention} har bursdag i dag! Sørg for å spise mye kake, is og oppvaskmaskinpølser.",
+    "WOWOWOW {mention} har faktisk bursdag i dag! Kan dere tro det? Dette må feires!",
+    "Hvorfor er det ingen som snakker om at det er selveste bursdagen til {mention} i dag? "
+    + "Håper dagen din blir fin!",
+    "FOLKENS! I dag blir {mention} ett år eldre. Grattis!!!!!",
+    "# AKKURAT NÅ! AKKURAT NÅ!\n{mention} fyller år i dag!\n# AKKURAT NÅ! AKKURAT NÅ!",
+    "χρόνια πολλά! जन्मदिन की शुभकामनाएँ! สุขสันต์วันเกิด! 生日快樂! з днем ​​народження! お誕生日おめでとう\n\n"
+    + "Med andre ord: GRATULERER MED DAGEN {mention}!!!",
+)
 
 
 class Birthday(commands.Cog):
@@ -28,6 +55,11 @@ class Birthday(commands.Cog):
         self.cursor = self.bot.db_connection.cursor()
         self.init_db()
         self.cursor.execute("SET timezone TO 'Europe/Oslo';")
+
+        # Loaded once and kept in sync on every change, so the daily check doesn't have to scan the table
+        self.cursor.execute("SELECT discord_id, birthday FROM birthdays WHERE birthday IS NOT NULL")
+        self.calendar = BirthdayCalendar(self.cursor.fetchall(), datetime.now(misc_utils.TIMEZONE).date())
+
         self.birthday_check.start()
 
     def init_db(self):
@@ -58,51 +90,19 @@ class Birthday(commands.Cog):
 
         self.bot.logger.info("Checking for birthdays")
 
-        self.cursor.execute(
-            """
-            SELECT *
-            FROM birthdays
-            WHERE EXTRACT(MONTH FROM birthday) = EXTRACT(MONTH FROM current_date)
-                AND EXTRACT(DAY FROM birthday) = EXTRACT(DAY FROM current_date);
-            """
-        )
+        today = datetime.now(misc_utils.TIMEZONE).date()
+        self.calendar.rotate(today)
 
-        birthdays = self.cursor.fetchall()
-        self.bot.logger.info(f"Found the following birthdays: {birthdays}")  # TODO: Temporary. Remove
+        user_ids = self.calendar.on(today)
+        self.bot.logger.info(f"Found the following birthdays: {user_ids}")  # TODO: Temporary. Remove
 
-        if not birthdays:
+        if not user_ids:
             return
 
         guild = self.bot.get_guild(self.bot.UIO_GAMING_GUILD_ID)
-        channel = guild.get_channel(747542544291987597)
-        for birthday in birthdays:
-            user = await guild.fetch_member(birthday[0])
-            if not user:
-                self.bot.logger.warning(f"Could not find user with ID {birthday[0]}")
-                continue
-
-            # Is it inefficent to define a list of greetings per iteration? Yes
-            # Am I hoping python somehow will automatically optimize my code? Yes
-            # Have I checked whether or not that's the case? No
-            # Do I bother to? No
-            greetings = [
-                f"Gratulerer med dagen {user.mention}! 🥳",
-                f"GRALLA BALLA!!! {user.mention}",
-                f"Hurra for deg som fyller år i dag! {user.mention}",
-                f"HOLY HECKIN' POGGERS legenden {user.mention} har bursdag i dag POG POG POG",
-                f"Cakes and candles brother! 🙏 {user.mention}",
-                "Som en AI-chatbot kan jeg ikke generere så personlige ting som bursdagshilsener for deg... "
-                + f"nei vent jeg er jo et menneske. Til lykke med dagen {user.mention}!",
-                f"{user.mention} har bursdag i dag! Sørg for å spise mye kake, is og oppvaskmaskinpølser.",
-                f"WOWOWOW {user.mention} har faktisk bursdag i dag! Kan dere tro det? Dette må feires!",
-                f"Hvorfor er det ingen som snakker om at det er selveste bursdagen til {user.mention} i dag? "
-                + "Håper dagen din blir fin!",
-                f"FOLKENS! I dag blir {user.mention} ett år eldre. Grattis!!!!!",
-                f"# AKKURAT NÅ! AKKURAT NÅ!\n{user.mention} fyller år i dag!\n# AKKURAT NÅ! AKKURAT NÅ!",
-                "χρόνια πολλά! जन्मदिन की शुभकामनाएँ! สุขสันต์วันเกิด! 生日快樂! з днем ​​народження! お誕生日おめでとう\n\n"
-                + f"Med andre ord: GRATULERER MED DAGEN {user.mention}!!!",
-            ]
-            message = random.choice(greetings)
+        channel = guild.get_channel(BIRTHDAY_CHANNEL_ID)
+        for user in await self.resolve_members(guild, user_ids):
+            message = random.choice(GREETINGS).format(mention=user.mention)
 
             if random.randint(0, 100) == 69:
                 message += (
@@ -115,6 +115,42 @@ class Birthday(commands.Cog):
 
             await channel.send(message)
 
+    async def resolve_members(self, guild: discord.Guild, user_ids: set[int]) -> list[discord.Member]:
+        """
+        Get the members with the given IDs. Looks in the member cache first and asks the gateway for the rest
+        in batches. Users who have left the server are skipped
+
+        Parameters
+        ----------
+        guild (discord.Guild): The guild to get the members from
+        user_ids (set[int]): The users' Discord IDs
+
+        Returns
+        ----------
+        (list[discord.Member]): The members that were found
+        """
+
+        members = []
+        missing = []
+        for user_id in user_ids:
+            if member := guild.get_member(user_id):
+                members.append(member)
+            else:
+                missing.append(user_id)
+
+        for i in range(0, len(missing), QUERY_MEMBERS_BATCH_SIZE):
+            batch = missing[i : i + QUERY_MEMBERS_BATCH_SIZE]
+            try:
+                members += await guild.query_members(user_ids=batch, limit=len(batch))
+            except asyncio.TimeoutError:
+                self.bot.logger.warning(f"Timed out looking up members {batch}")
+
+        if len(members) < len(user_ids):
+            found = {member.id for member in members}
+            self.bot.logger.warning(f"Could not find users with IDs {[i for i in user_ids if i not in found]}")
+
+        return members
+
     async def cog_unload(self):
         self.bot.logger.info("Unloading cog")
         self.birthday_check.cancel()
@@ -152,49 +188,30 @@ class Birthday(commands.Cog):
         (datetime): The date of the next birthday
         """
 
-        self.cursor.execute(
-            """
-            SELECT *, CAST(birthday + ((EXTRACT(YEAR FROM AGE(birthday)) + 1) * interval '1' YEAR) AS DATE) AS next_bday
-            FROM birthdays
-            WHERE discord_id = %s
-            """,
-            (user_id,),
-        )
-        results = self.cursor.fetchone()
-        if results:
-            birthday = results[2]
-            return datetime(birthday.year, birthday.month, birthday.day)
+        next_birthday = self.calendar.next_birthday(user_id)
+        if next_birthday:
+            return datetime(next_birthday.year, next_birthday.month, next_birthday.day)
         else:
             # This will never happen unless a database error occurs. Keeping the type checker happy
             return datetime.now()
 
-    def fetch_next_birthdays(self) -> list[tuple[int, datetime, datetime]]:
+    def fetch_next_birthdays(self, limit: int | None = None) -> list[tuple[int, datetime]]:
         """
-        Fetch the 5 first future birthdays of all users in the database
+        Get the next birthdays of all users in the database, starting with today's
+
+        Parameters
+        ----------
+        limit (int | None): Maximum number of birthdays. Defaults to all of them
 
         Returns
         ----------
-        (list[tuple[int, datetime, datetime]]): List of tuples containing the user ID, date of birth and next birthday
+        (list[tuple[int, datetime]]): List of tuples containing the user ID and next birthday
         """
 
-        self.cursor.execute(
-            """
-            SELECT *, CAST(birthday + ((EXTRACT(YEAR FROM AGE(birthday)) + 1) * interval '1' YEAR) AS DATE) AS next_bday
-            FROM birthdays
-            ORDER BY next_bday ASC
-            """
-        )
-        results = self.cursor.fetchall()
-
-        # Convert date objects to datetime objects
-        birthdays = []
-        for result in results:
-            discord_id, birthday, next_birthday = result
-            birthday = datetime(birthday.year, birthday.month, birthday.day)
-            next_birthday = datetime(next_birthday.year, next_birthday.month, next_birthday.day)
-            birthdays.append((discord_id, birthday, next_birthday))
-
-        return birthdays
+        return [
+            (user_id, datetime(next_birthday.year, next_birthday.month, next_birthday.day))
+            for user_id, next_birthday in self.calendar.upcoming(limit)
+        ]
 
     def set_user_birthday(self, user_id: int, birthday: datetime):
         """
@@ -218,6 +235,8 @@ class Birthday(commands.Cog):
             self.bot.db_connection.rollback()
             self.cursor.execute("UPDATE birthdays SET birthday = %s WHERE discord_id = %s", (birthday, user_id))
 
+        self.calendar.add(user_id, birthday.date())
+
     @app_commands.checks.bot_has_permissions(embed_links=True)
     @app_commands.checks.cooldown(1, 5)
     @birthday_group.command(name="sett", description="Lagrer din bursdag i databasen")
@@ -270,6 +289,7 @@ class Birthday(commands.Cog):
         """
 
         self.cursor.execute("DELETE FROM birthdays WHERE discord_id = (%s)", (interaction.user.id,))
+        self.calendar.remove(interaction.user.id)
 
         embed = embed_templates.success("Bursdag fjernet")
         await interaction.response.send_message(embed=embed)
@@ -306,7 +326,7 @@ class Birthday(commands.Cog):
 
         #  Next birthday information
         next_birthday = self.fetch_user_next_birthday(bruker.id)
-        next_birthday_days = (next_birthday - datetime.now()).days
+        next_birthday_days = (next_birthday.date() - datetime.now(misc_utils.TIMEZONE).date()).days
 
         embed = discord.Embed(description=bruker.mention, color=bruker.color)
         embed.set_thumbnail(url=bruker.display_avatar)
@@ -335,19 +355,15 @@ class Birthday(commands.Cog):
 
         await interaction.response.defer()
 
-        next_birthdays = self.fetch_next_birthdays()
+        next_birthdays = self.fetch_next_birthdays(UPCOMING_BIRTHDAYS_LIMIT)
 
         if not next_birthdays:
             return await interaction.followup.send(embed=embed_templates.error_warning("Ingen bursdager"))
 
         birthday_strings = []
-        for user in next_birthdays:
-            user_id, _, next_birthday = user
-            try:
-                discord_user = await interaction.guild.fetch_member(
-                    user_id
-                )  # Guild should always be available because of guild_only
-            except (discord.NotFound, discord.HTTPException):
+        for user_id, next_birthday in next_birthdays:
+            # Guild should always be available because of guild_only
+            if not (discord_user := interaction.guild.get_member(user_id)):
                 continue
 
             timestamp = discord.utils.format_dt(next_birthday, style="D")
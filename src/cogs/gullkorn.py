@@ -1,8 +1,18 @@
+from collections import defaultdict
+
 import discord
 from discord import app_commands
 from discord.ext import commands
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import execute_values
 
 from cogs.utils import embed_templates
+from cogs.utils.leaderboard import Leaderboard
+
+GULLKORN_CHANNEL_ID = 865970753748074576
+
+# Discord returns at most 100 messages per history request
+BACKFILL_PAGE_SIZE = 100
 
 
 class Gullkorn(commands.Cog):
@@ -19,6 +29,51 @@ class Gullkorn(commands.Cog):
         self.cursor = self.bot.db_connection.cursor()
         self.init_db()
 
+        # Kept in sync with the database so stats don't need to query it
+        self.most_cited = Leaderboard()
+        self.most_posted = Leaderboard()
+        self.total_posted = 0
+        self.user_names = {}  # dict[int, str]
+        self.backfill_finished = False
+        self.backfill_running = False
+        self.populate_cache()
+
+    def populate_cache(self):
+        """
+        Loads the leaderboards from the database
+        """
+
+        self.cursor.execute("SELECT discord_id, times_cited, citations_posted FROM gullkorn")
+        for discord_id, times_cited, citations_posted in self.cursor.fetchall():
+            self.most_cited.add(discord_id, times_cited)
+            self.most_posted.add(discord_id, citations_posted)
+            self.total_posted += citations_posted
+
+        self.cursor.execute("SELECT finished FROM gullkorn_backfill WHERE channel_id = %s", (GULLKORN_CHANNEL_ID,))
+        result = self.cursor.fetchone()
+        self.backfill_finished = bool(result and result[0])
+
+    def user_name(self, user_id: int) -> str | None:
+        """
+        Get a user's name, looking it up in the bot's cache only the first time
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (str | None): The user's name. None if the user is unknown
+        """
+
+        if user_id not in self.user_names:
+            user = self.bot.get_user(user_id)
+            if not user:
+                return None
+            self.user_names[user_id] = user.name
+
+        return self.user_names[user_id]
+
     def init_db(self):
         """
         Create the necessary tables for the gullkorn cog to work
@@ -33,6 +88,26 @@ class Gullkorn(commands.Cog):
             );
             """
         )
+        # Every gullkorn seen, so the counts can be rebuilt from scratch without counting anything twice
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS gullkorn_messages (
+                message_id BIGINT PRIMARY KEY,
+                author_id BIGINT NOT NULL,
+                mentioned_ids BIGINT[] NOT NULL
+            );
+            """
+        )
+        # How far the history backfill has gotten
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS gullkorn_backfill (
+                channel_id BIGINT PRIMARY KEY,
+                last_message_id BIGINT NOT NULL,
+                finished BOOLEAN NOT NULL DEFAULT FALSE
+            );
+            """
+        )
         self.cursor.execute(
             """
             CREATE OR REPLACE VIEW most_cited AS
@@ -50,13 +125,13 @@ class Gullkorn(commands.Cog):
             """
         )
 
-    def construct_data_string(self, data: list[tuple[int, int, int]]) -> str:
+    def construct_data_string(self, data: list[tuple[int, int]]) -> str:
         """
         Constructs a formatted string displaying lists of gullkorn data
 
         Parameters
         ----------
-        data (list[tuple[int, int, int]]): List of database rows
+        data (list[tuple[int, int]]): List of user IDs and counts
 
         Returns
         ----------
@@ -65,9 +140,8 @@ class Gullkorn(commands.Cog):
 
         formatted_string = ""
         for i, row in enumerate(data):
-            user = self.bot.get_user(row[0])
-            if user:
-                formatted_string += f"**#{i+1}** {user.name} - *{row[1]}*\n"
+            if name := self.user_name(row[0]):
+                formatted_string += f"**#{i+1}** {name} - *{row[1]}*\n"
             else:
                 formatted_string += f"**#{i+1}** `Ukjent bruker` - *{row[1]}*\n"
 
@@ -83,28 +157,172 @@ class Gullkorn(commands.Cog):
         message (discord.Message): Message object to check for triggers to
         """
 
-        if message.author.bot or message.channel.id != 865970753748074576 or not message.mentions:
+        if message.author.bot or message.channel.id != GULLKORN_CHANNEL_ID or not message.mentions:
             return
 
+        # Authors can quote themselves, so counts are combined per user to only upsert each row once
+        counts = defaultdict(lambda: [0, 0])
         for user in message.mentions:
-            self.cursor.execute(
-                """
-                INSERT INTO gullkorn (discord_id, times_cited, citations_posted)
-                VALUES (%s, 1, 0)
-                ON CONFLICT (discord_id)
-                DO UPDATE SET times_cited = gullkorn.times_cited + 1;
-                """,
-                (user.id,),
-            )
+            counts[user.id][0] += 1
+            self.user_names[user.id] = user.name
+        counts[message.author.id][1] += 1
+        self.user_names[message.author.id] = message.author.name
 
         self.cursor.execute(
+            """
+            INSERT INTO gullkorn_messages (message_id, author_id, mentioned_ids)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (message_id) DO NOTHING;
+            """,
+            (message.id, message.author.id, [user.id for user in message.mentions]),
+        )
+        execute_values(
+            self.cursor,
             """
             INSERT INTO gullkorn (discord_id, times_cited, citations_posted)
-            VALUES (%s, 0, 1)
+            VALUES %s
             ON CONFLICT (discord_id)
-            DO UPDATE SET citations_posted = gullkorn.citations_posted + 1;
+            DO UPDATE SET times_cited = gullkorn.times_cited + EXCLUDED.times_cited,
+                citations_posted = gullkorn.citations_posted + EXCLUDED.citations_posted;
             """,
-            (message.author.id,),
+            [(user_id, times_cited, citations_posted) for user_id, (times_cited, citations_posted) in counts.items()],
+        )
+
+        for user_id, (times_cited, citations_posted) in counts.items():
+            self.most_cited.add(user_id, self.most_cited.scores.get(user_id, 0) + times_cited)
+            self.most_posted.add(user_id, self.most_posted.scores.get(user_id, 0) + citations_posted)
+        self.total_posted += 1
+
+    @commands.Cog.listener("on_user_update")
+    async def user_update_listener(self, before: discord.User, after: discord.User):
+        """
+        Keeps cached user names up to date
+
+        Parameters
+        ----------
+        before (discord.User): The user before the update
+        after (discord.User): The user after the update
+        """
+
+        if after.id in self.user_names:
+            self.user_names[after.id] = after.name
+
+    def rebuild_counts(self, connection: Connection):
+        """
+        Replaces all counts with ones computed from the recorded messages. Running it again gives the same result
+
+        Parameters
+        ----------
+        connection (Connection): Database connection to run the rebuild's transaction on
+        """
+
+        with connection, connection.cursor() as cursor:
+            cursor.execute("TRUNCATE gullkorn;")
+            cursor.execute(
+                """
+                INSERT INTO gullkorn (discord_id, times_cited, citations_posted)
+                SELECT discord_id, SUM(times_cited), SUM(citations_posted)
+                FROM (
+                    SELECT DISTINCT message_id, mentioned.discord_id, 1 AS times_cited, 0 AS citations_posted
+                    FROM gullkorn_messages
+                    CROSS JOIN LATERAL unnest(mentioned_ids) AS mentioned (discord_id)
+                    UNION ALL
+                    SELECT message_id, author_id, 0, 1
+                    FROM gullkorn_messages
+                ) AS counts
+                GROUP BY discord_id;
+                """
+            )
+
+        self.most_cited = Leaderboard()
+        self.most_posted = Leaderboard()
+        self.total_posted = 0
+        self.populate_cache()
+
+    @commands.is_owner()
+    @commands.command(name="gullkornbackfill", description="Tell opp gullkorn fra hele kanalhistorikken på nytt")
+    async def backfill(self, ctx: commands.Context):
+        """
+        Records every gullkorn in the channel's history and rebuilds the counts from them.
+        Progress is saved after every page, so it continues where it left off if interrupted
+
+        Parameters
+        ----------
+        ctx (commands.Context): Context object
+        """
+
+        if self.backfill_running:
+            return await ctx.reply(embed=embed_templates.error_warning("Backfill kjører allerede"))
+
+        if not (channel := self.bot.get_channel(GULLKORN_CHANNEL_ID)):
+            return await ctx.reply(embed=embed_templates.error_fatal("Fant ikke gullkornkanalen"))
+
+        self.backfill_running = True
+        connection = self.bot.connect_database()
+        try:
+            with connection, connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT last_message_id FROM gullkorn_backfill WHERE channel_id = %s", (GULLKORN_CHANNEL_ID,)
+                )
+                result = cursor.fetchone()
+            after = discord.Object(result[0]) if result else None
+
+            progress_message = await ctx.reply("Leser historikk...")
+            messages_read = 0
+            while True:
+                # Only one page is held in memory at a time
+                page = [
+                    message
+                    async for message in channel.history(limit=BACKFILL_PAGE_SIZE, after=after, oldest_first=True)
+                ]
+                if not page:
+                    break
+
+                rows = [
+                    (message.id, message.author.id, [user.id for user in message.mentions])
+                    for message in page
+                    if not message.author.bot and message.mentions
+                ]
+                after = page[-1]
+                messages_read += len(page)
+
+                # Recording the page and moving the checkpoint happen together, so a page is never half done
+                with connection, connection.cursor() as cursor:
+                    if rows:
+                        execute_values(
+                            cursor,
+                            """
+                            INSERT INTO gullkorn_messages (message_id, author_id, mentioned_ids)
+                            VALUES %s
+                            ON CONFLICT (message_id) DO NOTHING
+                            """,
+                            rows,
+                        )
+                    cursor.execute(
+                        """
+                        INSERT INTO gullkorn_backfill (channel_id, last_message_id)
+                        VALUES (%s, %s)
+                        ON CONFLICT (channel_id) DO UPDATE SET last_message_id = EXCLUDED.last_message_id
+                        """,
+                        (GULLKORN_CHANNEL_ID, after.id),
+                    )
+
+                if messages_read % (BACKFILL_PAGE_SIZE * 10) == 0:
+                    await progress_message.edit(content=f"Leser historikk... {messages_read} meldinger lest")
+
+            with connection, connection.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE gullkorn_backfill SET finished = TRUE WHERE channel_id = %s", (GULLKORN_CHANNEL_ID,)
+                )
+            self.rebuild_counts(connection)
+        finally:
+            self.backfill_running = False
+            connection.close()
+
+        self.bot.logger.info(f"Gullkorn backfill read {messages_read} messages")
+        await progress_message.edit(
+            content=None,
+            embed=embed_templates.success(f"Leste {messages_read} meldinger. Totalt {self.total_posted} gullkorn"),
         )
 
     gullkorn_group = app_commands.Group(name="gullkorn", description="Se statistikk for gullkorn")
@@ -124,19 +342,8 @@ class Gullkorn(commands.Cog):
         bruker (discord.Member, optional): Discord user to fetch stats for. Defaults to None.
         """
 
-        # This looks kinda ugly, ngl
         if bruker:
-            self.cursor.execute(
-                """
-                SELECT *
-                FROM gullkorn
-                WHERE discord_id = %s;
-                """,
-                (bruker.id,),
-            )
-            result = self.cursor.fetchone()
-
-            if not result:
+            if bruker.id not in self.most_cited.scores:
                 return await interaction.response.send_message(
                     embed=embed_templates.error_warning("Ingen data om denne brukeren funnet"),
                     ephemeral=False,
@@ -147,45 +354,28 @@ class Gullkorn(commands.Cog):
                 color=bruker.color,
             )
             embed.set_thumbnail(url=bruker.avatar)
-            embed.add_field(name="Antall gullkorn", value=result[1])
-            embed.add_field(name="Antall gullkorn postet", value=result[2])
+            embed.add_field(name="Antall gullkorn", value=self.most_cited.scores[bruker.id])
+            embed.add_field(name="Antall gullkorn postet", value=self.most_posted.scores[bruker.id])
             return await interaction.response.send_message(embed=embed, ephemeral=False)
 
-        self.cursor.execute(
-            """
-            SELECT SUM(citations_posted)
-            FROM gullkorn;
-            """
+        # The leaderboards are sorted lowest first. Everyone who has posted or been cited is on both,
+        # so small servers would otherwise list users with a count of zero
+        most_cited_string = self.construct_data_string(
+            [(user_id, score) for score, user_id in reversed(self.most_cited.entries[-5:]) if score]
         )
-        summary = self.cursor.fetchone()
-
-        self.cursor.execute(
-            """
-            SELECT *
-            FROM most_cited
-            LIMIT 5;
-            """
-        )
-        most_cited = self.cursor.fetchall()
-
-        self.cursor.execute(
-            """
-            SELECT *
-            FROM most_frequent_posters
-            LIMIT 5;
-            """
+        citations_posted_string = self.construct_data_string(
+            [(user_id, score) for score, user_id in reversed(self.most_posted.entries[-5:]) if score]
         )
-        citations_posted = self.cursor.fetchall()
-
-        most_cited_string = self.construct_data_string(most_cited)
-        citations_posted_string = self.construct_data_string(citations_posted)
 
         GULLKORN_FIRST_MSG = "https://canary.discord.com/channels/747542543750660178/865970753748074576/1034587913285025912"  # noqa: E501
 
         embed = discord.Embed(title="Gullkornstatistikk for serveren")
-        embed.description = f"Antall gullkorn siden [denne meldingen]({GULLKORN_FIRST_MSG}): *{summary[0]}*"
-        embed.add_field(name="Mest sitert", value=most_cited_string, inline=False)
-        embed.add_field(name="Postet mest", value=citations_posted_string, inline=False)
+        if self.backfill_finished:
+            embed.description = f"Antall gullkorn: *{self.total_posted}*"
+        else:
+            embed.description = f"Antall gullkorn siden [denne meldingen]({GULLKORN_FIRST_MSG}): *{self.total_posted}*"
+        embed.add_field(name="Mest sitert", value=most_cited_string or "Ingen enda", inline=False)
+        embed.add_field(name="Postet mest", value=citations_posted_string or "Ingen enda", inline=False)
         await interaction.response.send_message(embed=embed, ephemeral=False)
 
 
@@ -1,14 +1,26 @@
+import asyncio
+from collections import defaultdict
 from dataclasses import dataclass
-from random import randint
+from datetime import date
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from time import monotonic
 
 import discord
+import psycopg2
 from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
+from psycopg2.extras import execute_values
 
 from cogs.utils import discord_utils
 from cogs.utils import embed_templates
 from cogs.utils import misc_utils
+from cogs.utils.credit_rules import DEFAULT_RULES
+from cogs.utils.credit_rules import CreditRule
+from cogs.utils.credit_rules import RuleIndex
+from cogs.utils.voice_sessions import VoiceSessionTracker
 
 """
 ------ GJORT ------
@@ -18,13 +30,14 @@ from cogs.utils import misc_utils
 + score for å skrive i medlemschat
 - score for å bli pinged i uio gullkorn
 + score for å få melding på stjernetavla/bli stjerna. multiplier per stjerne
-- score hver dag med weebrolle (lite)
-
------- TO-DO ------
+- score hver dag med weebrolle (lite). Andre roller kan også få poeng hver dag
 - score sitte i afk
 + score for å sitte i voice per time
 """
 
+VOICE_POINTS_PER_HOUR = 5
+AFK_PENALTY_PER_HOUR = 10
+
 
 @dataclass
 class CreditUser:
@@ -35,11 +48,39 @@ class CreditUser:
 class SocialCredit(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.fuck_uwu.start()
+        self.daily_role_policies.start()
 
         self.START_POINTS = 1000
         self.cursor = self.bot.db_connection.cursor()
         self.init_db()
+        self.ensure_event_partitions(datetime.now(misc_utils.TIMEZONE).date())
+
+        self.rules = RuleIndex([])
+        self.load_rules()
+
+        # Score changes not yet written to the database, per user and reason
+        self.pending_deltas = defaultdict(lambda: defaultdict(int))
+        # Every single change, written to the event log on the next flush
+        self.pending_events = []  # list[tuple[int, str, int, datetime]]
+
+        # Time spent in voice is paid out together with the ledger flush
+        self.voice_sessions = VoiceSessionTracker()
+
+        # Flushes write to several tables, so they get their own connection to be able to use transactions
+        self.flush_connection = self.bot.connect_database()
+        self.flush_ledger_loop.start()
+        self.partition_loop.start()
+
+    async def cog_load(self):
+        asyncio.create_task(self.after_ready())
+
+    async def after_ready(self):
+        """
+        Wait for the bot's cache to be ready before picking up who is already in voice
+        """
+
+        await self.bot.wait_until_ready()
+        self.rebuild_voice_sessions()
 
     def init_db(self):
         """
@@ -50,62 +91,400 @@ class SocialCredit(commands.Cog):
             """
             CREATE TABLE IF NOT EXISTS social_credit (
                 user_id BIGINT PRIMARY KEY,
-                credit_score SMALLINT NOT NULL
+                credit_score INTEGER NOT NULL
             );
             """
         )
 
-    def add_new_citizen(func):
+        # Scores used to be SMALLINT, which night owls would eventually overflow
+        self.cursor.execute(
+            """
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_name = 'social_credit' AND column_name = 'credit_score' AND data_type = 'smallint';
+            """
+        )
+        if self.cursor.fetchone():
+            self.cursor.execute("ALTER TABLE social_credit ALTER COLUMN credit_score TYPE INTEGER;")
+
+        # Append-only log of every change, partitioned by month so old history can be dropped cheaply
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS social_credit_events (
+                event_id BIGSERIAL,
+                user_id BIGINT NOT NULL,
+                reason TEXT NOT NULL,
+                delta INTEGER NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL
+            ) PARTITION BY RANGE (created_at);
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS social_credit_events_default
+            PARTITION OF social_credit_events DEFAULT;
+            """
+        )
+
+        # Message rules. Changes are picked up on the next reload, without reloading the cog
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS social_credit_rules (
+                reason TEXT PRIMARY KEY,
+                points INTEGER NOT NULL,
+                probability REAL NOT NULL DEFAULT 1,
+                channel_ids BIGINT[] NOT NULL DEFAULT '{}',
+                hours SMALLINT[] NOT NULL DEFAULT '{}',
+                requires_mentions BOOLEAN NOT NULL DEFAULT FALSE,
+                target_mentions BOOLEAN NOT NULL DEFAULT FALSE
+            );
+            """
+        )
+
+        # Points given to or taken from every member of a role each day
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS social_credit_role_policies (
+                role_id BIGINT PRIMARY KEY,
+                reason TEXT NOT NULL,
+                points INTEGER NOT NULL
+            );
+            """
+        )
+        # The weeb role has always been punished
+        self.cursor.execute(
+            """
+            INSERT INTO social_credit_role_policies (role_id, reason, points)
+            SELECT 803629993539403826, 'weeb', -1
+            WHERE NOT EXISTS (SELECT 1 FROM social_credit_role_policies);
+            """
+        )
+
+        # Events summed per user, reason and month. History is read from here instead of the log
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS social_credit_rollups (
+                user_id BIGINT NOT NULL,
+                reason TEXT NOT NULL,
+                month DATE NOT NULL,
+                total_delta BIGINT NOT NULL,
+                event_count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, reason, month)
+            );
+            """
+        )
+
+    @staticmethod
+    def event_partition_name(month: date) -> str:
         """
-        Decorator that, when used, make sure that a user is inserted
-        into the database before executing the function
+        Get the table name of a month's event log partition
+
+        Parameters
+        ----------
+        month (date): Any day in the month
+
+        Returns
+        ----------
+        (str): The partition's table name
         """
 
-        async def wrapper(*args, **kwargs):
-            self = args[0]
-            self.cursor.execute("SELECT user_id FROM social_credit WHERE user_id = %s", (args[1],))
-            if not self.cursor.fetchone():
-                self.add_citizen(args[1])
-            await func(*args, **kwargs)
+        return f"social_credit_events_{month.strftime('%Y%m')}"
 
-        return wrapper
+    def ensure_event_partitions(self, today: date):
+        """
+        Create the event log partitions for this month and the next if they don't exist
+
+        Parameters
+        ----------
+        today (date): Today's date
+        """
+
+        this_month = today.replace(day=1)
+        next_month = (this_month + timedelta(days=32)).replace(day=1)
+        month_after = (next_month + timedelta(days=32)).replace(day=1)
+
+        for start, end in ((this_month, next_month), (next_month, month_after)):
+            # Table names can't be parameterized. The name only ever contains digits from the date though
+            self.cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.event_partition_name(start)}
+                PARTITION OF social_credit_events
+                FOR VALUES FROM (%s) TO (%s);
+                """,
+                (
+                    datetime.combine(start, time.min, tzinfo=misc_utils.TIMEZONE),
+                    datetime.combine(end, time.min, tzinfo=misc_utils.TIMEZONE),
+                ),
+            )
 
-    def roll(percent: int = 50):
+    def load_rules(self):
         """
-        Decorator that executes the function with a given percent chance
+        Reads the message rules from the database and compiles them. Seeds the default rules if there are none.
+        Keeps the current rules if the database can't be read
         """
 
-        def decorator(func):
-            async def wrapper(*args, **kwargs):
-                if randint(0, 100) <= percent:
-                    await func(*args, **kwargs)
-
-            return wrapper
+        try:
+            self.cursor.execute(
+                """
+                SELECT reason, points, probability, channel_ids, hours, requires_mentions, target_mentions
+                FROM social_credit_rules
+                """
+            )
+            result = self.cursor.fetchall()
+
+            if not result:
+                execute_values(
+                    self.cursor,
+                    """
+                    INSERT INTO social_credit_rules
+                    (reason, points, probability, channel_ids, hours, requires_mentions, target_mentions)
+                    VALUES %s
+                    ON CONFLICT (reason) DO NOTHING
+                    """,
+                    [
+                        (
+                            rule.reason,
+                            rule.points,
+                            rule.probability,
+                            sorted(rule.channel_ids),
+                            sorted(rule.hours),
+                            rule.requires_mentions,
+                            rule.target_mentions,
+                        )
+                        for rule in DEFAULT_RULES
+                    ],
+                )
+                rules = list(DEFAULT_RULES)
+            else:
+                rules = [
+                    CreditRule(
+                        reason=reason,
+                        points=points,
+                        probability=probability,
+                        channel_ids=frozenset(channel_ids),
+                        hours=frozenset(hours),
+                        requires_mentions=requires_mentions,
+                        target_mentions=target_mentions,
+                    )
+                    for reason, points, probability, channel_ids, hours, requires_mentions, target_mentions in result
+                ]
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to load social credit rules - {err}")
+            return
 
-        return decorator
+        if rules != self.rules.rules:
+            self.rules = RuleIndex(rules)
+            self.bot.logger.info(f"Loaded {len(rules)} social credit rules")
 
-    def add_citizen(self, user_id: int):
+    def pending_delta(self, user_id: int) -> int:
         """
-        Adds a user to the database
+        Get the sum of a user's score changes that haven't been written to the database yet
 
         Parameters
         ----------
         user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (int): The pending change
         """
 
-        self.cursor.execute(
-            """
-            INSERT INTO social_credit
-            (user_id, credit_score)
-            VALUES (%s, %s)
-            """,
-            (user_id, self.START_POINTS),
-        )
+        return sum(self.pending_deltas.get(user_id, {}).values())
+
+    def flush_ledger(self):
+        """
+        Writes all pending score changes to the database in a single transaction.
+        Scores are updated with one upsert, events are appended in one batch and rolled up with one upsert.
+        New users start at START_POINTS
+        """
+
+        if not self.pending_deltas:
+            return
+
+        # Swap in a fresh ledger so changes made during the write aren't lost or written twice
+        pending_deltas, self.pending_deltas = self.pending_deltas, defaultdict(lambda: defaultdict(int))
+        pending_events, self.pending_events = self.pending_events, []
+
+        # New users get the start points plus their changes. Existing users only get their changes.
+        # EXCLUDED.credit_score is the start points plus the change, so the start points are subtracted again
+        rows = [(user_id, self.START_POINTS + sum(deltas.values())) for user_id, deltas in pending_deltas.items()]
+
+        rollups = defaultdict(lambda: [0, 0])
+        for user_id, reason, delta, created_at in pending_events:
+            rollup = rollups[(user_id, reason, created_at.astimezone(misc_utils.TIMEZONE).date().replace(day=1))]
+            rollup[0] += delta
+            rollup[1] += 1
+
+        try:
+            # The connection context manager commits on success and rolls back on exceptions
+            with self.flush_connection, self.flush_connection.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    f"""
+                    INSERT INTO social_credit (user_id, credit_score)
+                    VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET credit_score = social_credit.credit_score + EXCLUDED.credit_score - {self.START_POINTS}
+                    """,
+                    rows,
+                )
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO social_credit_events (user_id, reason, delta, created_at)
+                    VALUES %s
+                    """,
+                    pending_events,
+                )
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO social_credit_rollups (user_id, reason, month, total_delta, event_count)
+                    VALUES %s
+                    ON CONFLICT (user_id, reason, month) DO UPDATE
+                    SET total_delta = social_credit_rollups.total_delta + EXCLUDED.total_delta,
+                        event_count = social_credit_rollups.event_count + EXCLUDED.event_count
+                    """,
+                    [(*key, total_delta, event_count) for key, (total_delta, event_count) in rollups.items()],
+                )
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to write social credit ledger to database - {err}")
+
+            # Nothing was written. Put the changes back so the next flush can retry
+            for user_id, deltas in pending_deltas.items():
+                for reason, delta in deltas.items():
+                    self.pending_deltas[user_id][reason] += delta
+            self.pending_events = pending_events + self.pending_events
+            return
+
+        self.bot.logger.info(f"Wrote {len(pending_events)} social credit changes for {len(rows)} users")
+
+    def rebuild_voice_sessions(self):
+        """
+        Start tracking everyone who is in a voice channel in the UiO Gaming server. Voice state updates
+        that were missed while the bot was offline or disconnected are accounted for this way
+        """
+
+        # Sessions are kept per member, so only one server is tracked to avoid counting anyone twice
+        if not (guild := self.bot.get_guild(self.bot.UIO_GAMING_GUILD_ID)):
+            return
+
+        present = {
+            member.id: (channel.id, channel == guild.afk_channel)
+            for channel in guild.voice_channels
+            for member in channel.members
+            if not member.bot
+        }
+        self.voice_sessions.rebuild(present, monotonic())
+        self.bot.logger.info(f"Tracking {len(present)} members in voice")
+
+    def pay_voice_time(self):
+        """
+        Converts time spent in voice into pending score changes. Whole points only, the rest carries over
+        """
+
+        self.voice_sessions.checkpoint(monotonic())
+        earned = self.voice_sessions.payout({False: 3600 / VOICE_POINTS_PER_HOUR, True: 3600 / AFK_PENALTY_PER_HOUR})
+
+        for user_id, points in earned.items():
+            if points.get(False):
+                self.social_reward(user_id, points[False], "voice")
+            if points.get(True):
+                self.social_punishment(user_id, points[True], "afk")
+
+    @tasks.loop(minutes=5)
+    async def flush_ledger_loop(self):
+        """
+        Pays out voice time, writes pending score changes to the database and picks up rule changes every 5 minutes
+        """
+
+        self.pay_voice_time()
+        self.flush_ledger()
+        self.load_rules()
+
+    @tasks.loop(time=misc_utils.MIDNIGHT)
+    async def partition_loop(self):
+        """
+        Makes sure next month's event log partition exists before it's needed
+        """
+
+        try:
+            self.ensure_event_partitions(datetime.now(misc_utils.TIMEZONE).date())
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to create social credit event partitions - {err}")
+
+    def apply_role_policies(self, guild: discord.Guild):
+        """
+        Applies the daily points of every role policy to the role's members. All members are updated at once
+        with set-based statements in a single transaction, bypassing the ledger
+
+        Parameters
+        ----------
+        guild (discord.Guild): The guild the roles belong to
+        """
+
+        now = datetime.now(misc_utils.TIMEZONE)
+        try:
+            with self.flush_connection, self.flush_connection.cursor() as cursor:
+                cursor.execute("SELECT role_id, reason, points FROM social_credit_role_policies")
+                policies = cursor.fetchall()
+
+                user_ids, reasons, deltas = [], [], []
+                for role_id, reason, points in policies:
+                    if not (role := guild.get_role(role_id)):
+                        self.bot.logger.warning(f"Could not fetch role {role_id} for social credit policy ({reason})")
+                        continue
+
+                    for member in role.members:
+                        user_ids.append(member.id)
+                        reasons.append(reason)
+                        deltas.append(points)
+
+                if not user_ids:
+                    return
+
+                # Members can have several roles with policies, so changes are summed per user before the upsert
+                cursor.execute(
+                    """
+                    INSERT INTO social_credit (user_id, credit_score)
+                    SELECT user_id, %(start_points)s + SUM(delta)
+                    FROM unnest(%(user_ids)s::BIGINT[], %(deltas)s::INTEGER[]) AS changes (user_id, delta)
+                    GROUP BY user_id
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET credit_score = social_credit.credit_score + EXCLUDED.credit_score - %(start_points)s
+                    """,
+                    {"start_points": self.START_POINTS, "user_ids": user_ids, "deltas": deltas},
+                )
+                cursor.execute(
+                    """
+                    INSERT INTO social_credit_events (user_id, reason, delta, created_at)
+                    SELECT user_id, reason, delta, %s
+                    FROM unnest(%s::BIGINT[], %s::TEXT[], %s::INTEGER[]) AS changes (user_id, reason, delta)
+                    """,
+                    (now, user_ids, reasons, deltas),
+                )
+                cursor.execute(
+                    """
+                    INSERT INTO social_credit_rollups (user_id, reason, month, total_delta, event_count)
+                    SELECT user_id, reason, %s, SUM(delta), COUNT(*)
+                    FROM unnest(%s::BIGINT[], %s::TEXT[], %s::INTEGER[]) AS changes (user_id, reason, delta)
+                    GROUP BY user_id, reason
+                    ON CONFLICT (user_id, reason, month) DO UPDATE
+                    SET total_delta = social_credit_rollups.total_delta + EXCLUDED.total_delta,
+                        event_count = social_credit_rollups.event_count + EXCLUDED.event_count
+                    """,
+                    (now.date().replace(day=1), user_ids, reasons, deltas),
+                )
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to apply social credit role policies - {err}")
+            return
+
+        self.bot.logger.info(f"Applied {len(policies)} social credit role policies to {len(set(user_ids))} users")
 
     @tasks.loop(time=misc_utils.MIDNIGHT, reconnect=True)
-    async def fuck_uwu(self):
+    async def daily_role_policies(self):
         """
-        Deducts points from people with the weeb role every 24 hours
+        Gives or takes points from members of roles with a policy every 24 hours. Mostly punishes weebs
         """
 
         await self.bot.wait_until_ready()
@@ -118,19 +497,11 @@ class SocialCredit(commands.Cog):
                 + "If it is, ignore this."
             )
             return
-        if not (weeb_role := guild.get_role(803629993539403826)):
-            self.bot.logger.warning(
-                "Could not fetch UiO Gaming's weeb role."
-                + "If the bot does not have access to the UiO Gaming server, this function won't work. "
-                + "If it is, ignore this."
-            )
-            return
 
-        for weeb in weeb_role.members:
-            await self.social_punishment(weeb.id, 1, "weeb")
+        self.apply_role_policies(guild)
 
-    @fuck_uwu.before_loop
-    async def before_fuck_uwu(self):
+    @daily_role_policies.before_loop
+    async def before_daily_role_policies(self):
         """
         Wait until bot cache is ready
         """
@@ -139,13 +510,17 @@ class SocialCredit(commands.Cog):
 
     async def cog_unload(self):
         self.bot.logger.info("Unloading cog")
-        self.fuck_uwu.cancel()
+        self.daily_role_policies.cancel()
+        self.flush_ledger_loop.cancel()
+        self.partition_loop.cancel()
+        self.pay_voice_time()
+        self.flush_ledger()
         self.cursor.close()
+        self.flush_connection.close()
 
-    @add_new_citizen
-    async def social_punishment(self, user_id: int, points: int, reason: str):
+    def social_punishment(self, user_id: int, points: int, reason: str):
         """
-        Deducts a given amount of points for a given user
+        Deducts a given amount of points for a given user. Written to the database on the next flush
 
         Parameters
         ----------
@@ -155,19 +530,12 @@ class SocialCredit(commands.Cog):
         """
 
         self.bot.logger.info(f"{points} points deducted from {user_id} ({reason})")
-        self.cursor.execute(
-            """
-            UPDATE social_credit
-            SET credit_score = credit_score - %s
-            WHERE user_id = %s
-            """,
-            (points, user_id),
-        )
+        self.pending_deltas[user_id][reason] -= points
+        self.pending_events.append((user_id, reason, -points, datetime.now(misc_utils.TIMEZONE)))
 
-    @add_new_citizen
-    async def social_reward(self, user_id: int, points: int, reason: str):
+    def social_reward(self, user_id: int, points: int, reason: str):
         """
-        Gives a given amount of points for a given user
+        Gives a given amount of points for a given user. Written to the database on the next flush
 
         Parameters
         ----------
@@ -177,14 +545,22 @@ class SocialCredit(commands.Cog):
         """
 
         self.bot.logger.info(f"{points} points given to {user_id} ({reason})")
-        self.cursor.execute(
-            """
-            UPDATE social_credit
-            SET credit_score = credit_score + %s
-            WHERE user_id = %s
-            """,
-            (points, user_id),
-        )
+        self.pending_deltas[user_id][reason] += points
+        self.pending_events.append((user_id, reason, points, datetime.now(misc_utils.TIMEZONE)))
+
+    @commands.is_owner()
+    @commands.command(name="reloadcreditrules", description="Last inn social credit-reglene fra databasen på nytt")
+    async def reload_rules(self, ctx: commands.Context):
+        """
+        Reload the message rules from the database right away instead of waiting for the next flush
+
+        Parameters
+        ----------
+        ctx (commands.Context): Context object
+        """
+
+        self.load_rules()
+        await ctx.reply(f"Lastet inn {len(self.rules.rules)} regler")
 
     social_credit_group = app_commands.Group(name="socialcredit", description="Trenger dette å forklares?")
 
@@ -213,12 +589,14 @@ class SocialCredit(commands.Cog):
         )
         result = self.cursor.fetchone()
 
-        if not result:
+        if not result and bruker.id not in self.pending_deltas:
             return await interaction.response.send_message(
                 embed=embed_templates.error_warning(f"{bruker.mention} er ikke registrert i databasen")
             )
 
-        db_user = CreditUser(*result)
+        # Include changes that haven't been written yet
+        db_user = CreditUser(*result) if result else CreditUser(bruker.id, self.START_POINTS)
+        db_user.credit_score += self.pending_delta(bruker.id)
 
         embed = discord.Embed(description=(f"{bruker.mention} har `{db_user.credit_score}` social credits"))
         await interaction.response.send_message(embed=embed)
@@ -243,13 +621,18 @@ class SocialCredit(commands.Cog):
             ORDER BY credit_score DESC
             """
         )
-        result = self.cursor.fetchall()
+        scores = dict(self.cursor.fetchall())
+
+        # Include changes that haven't been written yet
+        for user_id in self.pending_deltas:
+            scores[user_id] = scores.get(user_id, self.START_POINTS) + self.pending_delta(user_id)
 
-        if not result:
-            return await interaction.send(
+        if not scores:
+            return await interaction.followup.send(
                 embed=embed_templates.error_warning("Ingen brukere er registrert i databasen")
             )
 
+        result = sorted(scores.items(), key=lambda score: score[1], reverse=True)
         leaderboard_formatted = [f"**#{s[0]+1}** <@{s[1][0]}> - `{s[1][1]}` poeng" for s in enumerate(result)]
 
         paginator = misc_utils.Paginator(leaderboard_formatted)
@@ -258,94 +641,122 @@ class SocialCredit(commands.Cog):
         embed = view.construct_embed(discord.Embed(title="Våre beste og verste borgere"))
         await interaction.followup.send(embed=embed, view=view)
 
-    @commands.Cog.listener("on_message")
-    async def on_message(self, message: discord.Message):
+    @app_commands.checks.bot_has_permissions(embed_links=True)
+    @app_commands.checks.cooldown(1, 2)
+    @social_credit_group.command(name="historikk", description="Se hva du har fått og mistet social credits for")
+    async def history(self, interaction: discord.Interaction, *, bruker: discord.Member | None = None):
         """
-        Listens for messages and gives/takes points accordingly
+        Shows what a user has gained and lost points for, in total and this month
 
         Parameters
         ----------
-        message (discord.Message): The message object
+        interaction (discord.Interaction): The interaction object
+        bruker (discord.Member | None): The user to check the history of. Defaults to the user who invoked the command
         """
 
-        if message.author.bot:
-            return
-
-        await self.gullkorn(message)
-        await self.politcal_content(message)
-        await self.chad_message(message)
-        await self.early_bird(message)
-        await self.night_owl(message)
-
-    @roll(percent=50)
-    async def politcal_content(self, message: discord.Message):
-        """
-        Punishes users for writing in the politics channel
+        if not bruker:
+            bruker = interaction.user
 
-        Parameters
-        ----------
-        message (discord.Message): The message object
-        """
+        this_month = datetime.now(misc_utils.TIMEZONE).date().replace(day=1)
+        self.cursor.execute(
+            """
+            SELECT reason, SUM(total_delta), SUM(event_count), SUM(total_delta) FILTER (WHERE month = %s)
+            FROM social_credit_rollups
+            WHERE user_id = %s
+            GROUP BY reason
+            """,
+            (this_month, bruker.id),
+        )
+        history = {
+            reason: [total_delta, event_count, month_delta or 0]
+            for reason, total_delta, event_count, month_delta in self.cursor.fetchall()
+        }
+
+        # Rollups are only updated on flush, so add the changes that haven't been written yet
+        for user_id, reason, delta, created_at in self.pending_events:
+            if user_id != bruker.id:
+                continue
+
+            entry = history.setdefault(reason, [0, 0, 0])
+            entry[0] += delta
+            entry[1] += 1
+            if created_at.astimezone(misc_utils.TIMEZONE).date() >= this_month:
+                entry[2] += delta
+
+        if not history:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning(f"{bruker.mention} har ingen historikk")
+            )
 
-        if message.channel.id == 754706204349038644:
-            await self.social_punishment(message.author.id, 25, "politics")
+        embed = discord.Embed(title="Historikk", description=bruker.mention)
+        for reason, (total_delta, event_count, month_delta) in sorted(
+            history.items(), key=lambda item: item[1][0], reverse=True
+        ):
+            embed.add_field(
+                name=reason,
+                value=f"`{total_delta:+}` poeng ({event_count} ganger)\nDenne måneden: `{month_delta:+}`",
+            )
+        await interaction.response.send_message(embed=embed)
 
-    @roll(percent=25)
-    async def chad_message(self, message: discord.Message):
+    @commands.Cog.listener("on_message")
+    async def on_message(self, message: discord.Message):
         """
-        Rewards users for writing in the member-chat channel
+        Listens for messages and gives/takes points according to the rules that apply to the channel and hour
 
         Parameters
         ----------
         message (discord.Message): The message object
         """
 
-        if message.channel.id == 811606213665357824:
-            await self.social_reward(message.author.id, 10, "member-chat")
-
-    @roll(percent=50)
-    async def early_bird(self, message: discord.Message):
-        """
-        Punishes users for writing between 05 AM and 10 AM
-
-        Parameters
-        ----------
-        message (discord.Message): The message object
-        """
+        if message.author.bot:
+            return
 
-        illegal_hours = [5, 6, 7, 8, 9]
+        hour = message.created_at.astimezone(misc_utils.TIMEZONE).hour
+        for rule in self.rules.candidates(message.channel.id, hour):
+            if rule.requires_mentions and not message.mentions:
+                continue
+            if not rule.roll():
+                continue
 
-        if message.created_at.hour in illegal_hours:
-            await self.social_punishment(message.author.id, 10, "early-bird")
+            targets = message.mentions if rule.target_mentions else [message.author]
+            for target in targets:
+                if rule.points < 0:
+                    self.social_punishment(target.id, -rule.points, rule.reason)
+                else:
+                    self.social_reward(target.id, rule.points, rule.reason)
 
-    @roll(percent=50)
-    async def night_owl(self, message: discord.Message):
+    @commands.Cog.listener("on_ready")
+    async def on_ready(self):
         """
-        Rewards users for writing between 01 AM and 05 AM
-
-        Parameters
-        ----------
-        message (discord.Message): The message object
+        Voice state updates aren't received while disconnected, so sessions are rebuilt on every (re)connect
         """
 
-        happy_hours = [1, 2, 3, 4]
+        self.rebuild_voice_sessions()
 
-        if message.created_at.hour in happy_hours:
-            await self.social_reward(message.author.id, 10, "night-owl")
-
-    async def gullkorn(self, message: discord.Message):
+    @commands.Cog.listener("on_voice_state_update")
+    async def on_voice_state_update(
+        self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState
+    ):
         """
-        Listens for messages in the gullkorn channel and punishes the user if they are mentioned
+        Opens, moves and closes voice sessions as members join, switch and leave channels
 
         Parameters
         ----------
-        message (discord.Message): The message object
+        member (discord.Member): The member whose voice state changed
+        before (discord.VoiceState): The voice state before the change
+        after (discord.VoiceState): The voice state after the change
         """
 
-        # This only works in the UiO Gaming server as well
-        if message.channel.id == 865970753748074576 and message.mentions:
-            for mention in message.mentions:
-                await self.social_punishment(mention.id, 10, "gullkorn")
+        if member.bot or member.guild.id != self.bot.UIO_GAMING_GUILD_ID:
+            return
+
+        channel = after.channel
+        self.voice_sessions.move(
+            member.id,
+            channel.id if channel else None,
+            channel is not None and channel == member.guild.afk_channel,
+            monotonic(),
+        )
 
     @commands.Cog.listener("on_reaction_add")
     async def on_star_add(self, reaction: discord.Reaction, user: discord.User | discord.Member):
@@ -363,12 +774,12 @@ class SocialCredit(commands.Cog):
 
         if reaction.emoji == "⭐":
             if reaction.message.author == user:
-                await self.social_punishment(user.id, 100, "self-star")
+                self.social_punishment(user.id, 100, "self-star")
             elif reaction.count == 3:
-                await self.social_punishment(
+                self.social_punishment(
                     user.id, (len(reaction.message.reactions) - 1) * 25, "remove already accumulated stars"
                 )
-                await self.social_reward(user.id, 25 * len(reaction.message.reactions), "add new stars")
+                self.social_reward(user.id, 25 * len(reaction.message.reactions), "add new stars")
 
     @commands.Cog.listener("on_reaction_remove")
     async def on_star_remove(self, reaction: discord.Reaction, user: discord.User | discord.Member):
@@ -380,7 +791,7 @@ class SocialCredit(commands.Cog):
             return
 
         if reaction.emoji == "⭐" and reaction.count >= 3:
-            await self.social_punishment(user.id, 25, "remove star")
+            self.social_punishment(user.id, 25, "remove star")
 
 
 async def setup(bot: commands.Bot):
@@ -1,14 +1,18 @@
 from datetime import datetime
-from datetime import timezone
+from datetime import time
+from datetime import timedelta
 
 import discord
+import psycopg2
 from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
+from psycopg2.extras import execute_values
 
 from cogs.utils import discord_utils
 from cogs.utils import embed_templates
 from cogs.utils import misc_utils
+from cogs.utils.leaderboard import Leaderboard
 
 
 class Streak(commands.Cog):
@@ -28,8 +32,14 @@ class Streak(commands.Cog):
 
         # Cache to avoid having to insert to the db for every message
         self.streak_cache = {}
+
+        # Streaks ordered by start time, so the top list never has to touch the database
+        self.leaderboard = Leaderboard()
         self.populate_cache()
 
+        # Users who have posted since the last flush. Only they need to be written
+        self.dirty_users = set()
+
         self.streak_check.start()
         self.insert_cache_loop.start()
 
@@ -43,12 +53,38 @@ class Streak(commands.Cog):
             CREATE TABLE IF NOT EXISTS streak (
                 discord_id BIGINT PRIMARY KEY,
                 streak_start_id TEXT NOT NULL,
-                streak_start_time timestamp NOT NULL,
-                latest_post_time timestamp NOT NULL
+                streak_start_time TIMESTAMPTZ NOT NULL,
+                latest_post_time TIMESTAMPTZ NOT NULL
             );
             """
         )
 
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS streak_latest_post_time_idx
+            ON streak (latest_post_time);
+            """
+        )
+
+        # Timestamps used to be stored without a time zone. The aware datetimes written to them were converted to the
+        # session's time zone, which the birthday cog sets to Europe/Oslo on the shared connection. Pinned here since
+        # the cogs can load in any order
+        self.cursor.execute(
+            """
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_name = 'streak' AND data_type = 'timestamp without time zone';
+            """
+        )
+        for (column,) in self.cursor.fetchall():
+            self.cursor.execute(
+                f"""
+                ALTER TABLE streak
+                ALTER COLUMN {column} TYPE TIMESTAMPTZ USING {column} AT TIME ZONE %s;
+                """,
+                (misc_utils.TIMEZONE.key,),
+            )
+
     async def cog_unload(self):
         self.bot.logger.info("Unloading cog")
         self.insert_cache_loop.cancel()
@@ -74,6 +110,7 @@ class Streak(commands.Cog):
                 "first_post_time": streak[2],
                 "latest_post_time": streak[3],
             }
+            self.leaderboard.add(streak[0], streak[2])
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -97,6 +134,9 @@ class Streak(commands.Cog):
                 "first_post_time": message.created_at,
                 "latest_post_time": message.created_at,
             }
+            self.leaderboard.add(message.author.id, message.created_at)
+
+        self.dirty_users.add(message.author.id)
 
     @tasks.loop(minutes=10)
     async def insert_cache_loop(self):
@@ -109,33 +149,47 @@ class Streak(commands.Cog):
     @insert_cache_loop.after_loop
     async def on_insert_cache_loop_cancel(self):
         self.bot.logger.info("Insert cache loop cancelled")
-        if self.insert_cache_loop.is_being_cancelled() and self.streak_cache:
+        if self.insert_cache_loop.is_being_cancelled() and self.dirty_users:
             await self.insert_cache()
 
     async def insert_cache(self):
         """
-        Inserts cache into the database
+        Writes the streaks of users who have posted since the last flush to the database
         """
 
-        self.bot.logger.info("Inserting cache into database")
+        if not self.dirty_users:
+            return
 
-        # Insert into database
-        for user_id, user_data in self.streak_cache.items():
-            self.cursor.execute(
+        # Swap in a fresh set so posts arriving during the write are picked up by the next flush
+        dirty_users, self.dirty_users = self.dirty_users, set()
+
+        rows = [
+            (
+                user_id,
+                self.streak_cache[user_id]["first_post_id"],
+                self.streak_cache[user_id]["first_post_time"],
+                self.streak_cache[user_id]["latest_post_time"],
+            )
+            for user_id in dirty_users
+            if user_id in self.streak_cache
+        ]
+
+        self.bot.logger.info(f"Inserting {len(rows)} of {len(self.streak_cache)} cached streaks into database")
+
+        try:
+            execute_values(
+                self.cursor,
                 """
                 INSERT INTO streak (discord_id, streak_start_id, streak_start_time, latest_post_time)
-                VALUES (%s, %s, %s, %s)
+                VALUES %s
                 ON CONFLICT (discord_id) DO UPDATE
-                SET latest_post_time = %s;
+                SET latest_post_time = EXCLUDED.latest_post_time;
                 """,
-                (
-                    user_id,
-                    user_data["first_post_id"],
-                    user_data["first_post_time"],
-                    user_data["latest_post_time"],
-                    user_data["latest_post_time"],
-                ),
+                rows,
             )
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to insert streak cache into database - {err}")
+            self.dirty_users |= dirty_users
 
     @tasks.loop(time=misc_utils.MIDNIGHT)
     async def streak_check(self):
@@ -146,28 +200,31 @@ class Streak(commands.Cog):
         self.bot.logger.info("Checking streaks")
 
         # Clear cache to make sure all streaks are up to date
-        if self.streak_cache:
-            await self.insert_cache()
+        await self.insert_cache()
 
-        self.cursor.execute(
-            """
-            SELECT discord_id, latest_post_time
-            FROM streak;
-            """
-        )
-        streaks = self.cursor.fetchall()
+        # Runs at midnight. Anyone who didn't post at all yesterday has lost their streak
+        yesterday = datetime.now(misc_utils.TIMEZONE).date() - timedelta(days=1)
+        cutoff = datetime.combine(yesterday, time.min, tzinfo=misc_utils.TIMEZONE)
 
-        for streak in streaks:
-            if (datetime.now() - streak[1]).days >= 1:
-                self.bot.logger.info(f"User {streak[0]} lost their streak")
-                self.streak_cache.pop(streak[0])
-                self.cursor.execute(
-                    """
-                    DELETE FROM streak
-                    WHERE discord_id = %s;
-                    """,
-                    (streak[0],),
-                )
+        # Users still marked dirty weren't flushed, so their stored post time can't be trusted
+        try:
+            self.cursor.execute(
+                """
+                DELETE FROM streak
+                WHERE latest_post_time < %s AND discord_id != ALL(%s)
+                RETURNING discord_id;
+                """,
+                (cutoff, list(self.dirty_users)),
+            )
+        except psycopg2.Error as err:
+            return self.bot.logger.error(f"Failed to expire streaks - {err}")
+
+        expired_users = [row[0] for row in self.cursor.fetchall()]
+        for user_id in expired_users:
+            self.streak_cache.pop(user_id, None)
+            self.leaderboard.remove(user_id)
+
+        self.bot.logger.info(f"{len(expired_users)} users lost their streak")
 
     @streak_check.after_loop
     async def on_streak_check_cancel(self):
@@ -175,6 +232,23 @@ class Streak(commands.Cog):
         if self.streak_check.is_being_cancelled():
             await self.streak_check()
 
+    @staticmethod
+    def streak_days(streak_start_time: datetime) -> int:
+        """
+        Count the days of a streak. Days start at midnight Norwegian time
+
+        Parameters
+        ----------
+        streak_start_time (datetime): When the streak started
+
+        Returns
+        ----------
+        (int): Number of days since the streak started
+        """
+
+        today = datetime.now(misc_utils.TIMEZONE).date()
+        return (today - streak_start_time.astimezone(misc_utils.TIMEZONE).date()).days
+
     streak_group = app_commands.Group(name="streak", description="Snapchat streaks, men for Discord")
 
     @app_commands.checks.bot_has_permissions(embed_links=True)
@@ -190,51 +264,28 @@ class Streak(commands.Cog):
         bruker (discord.Member | discord.User | None): The user to get the streak for
         """
 
-        await interaction.response.defer()
-
         if not bruker:
             bruker = interaction.user
 
-        self.cursor.execute(
-            """
-            SELECT streak_start_id, streak_start_time
-            FROM streak
-            WHERE discord_id = %s;
-            """,
-            (bruker.id,),
-        )
-        streak = self.cursor.fetchone()
-
-        if not streak:
-            return await interaction.followup.send(embed=embed_templates.error_warning("Brukeren har ikke noen streak"))
+        # Read from the cache like the leaderboard, so /streak se and /streak plassering always agree
+        if not (streak := self.streak_cache.get(bruker.id)):
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Brukeren har ikke noen streak")
+            )
 
-        streak_msg_channel, streak_msg_id = streak[0].split("-")
+        # Everything we need is encoded in the stored IDs, so there's no need to fetch the message from the API
+        streak_msg_channel, streak_msg_id = streak["first_post_id"].split("-")
         streak_msg_channel, streak_msg_id = int(streak_msg_channel), int(streak_msg_id)
-        try:
-            streak_msg_channel = await interaction.guild.fetch_channel(streak_msg_channel)
-            streak_message = await streak_msg_channel.fetch_message(streak_msg_id)
-        except (discord.NotFound, discord.Forbidden, AttributeError):
-            streak_message = None
-
-        if not streak_message:
-            streak_msg_time = datetime.fromtimestamp(streak[2])
-            streak_msg_link_txt = "*Meldingen kunne ikke lastes inn*"
-            streak_msg_link = ""
-        else:
-            streak_msg_time = streak_message.created_at
-            streak_msg_link_txt = "Meldingen"
-            streak_msg_link = streak_message.jump_url
+        streak_msg_link = f"https://discord.com/channels/{interaction.guild_id}/{streak_msg_channel}/{streak_msg_id}"
 
-        streak_days = (datetime.now(timezone.utc) - streak_msg_time).days
-        streak_msg_timestamp = discord.utils.format_dt(streak_msg_time, "F")
+        streak_days = self.streak_days(streak["first_post_time"])
+        streak_msg_timestamp = discord.utils.format_dt(streak["first_post_time"], "F")
 
         embed = discord.Embed(title="Streak", description=bruker.mention)
         embed.set_author(name=bruker.name, icon_url=bruker.avatar)
         embed.add_field(name="Antall dager", value=streak_days)
-        embed.add_field(
-            name="Startet streaken", value=f"{streak_msg_timestamp}\n[{streak_msg_link_txt}]({streak_msg_link})"
-        )
-        await interaction.followup.send(embed=embed)
+        embed.add_field(name="Startet streaken", value=f"{streak_msg_timestamp}\n[Meldingen]({streak_msg_link})")
+        await interaction.response.send_message(embed=embed)
 
     @app_commands.checks.bot_has_permissions(embed_links=True)
     @app_commands.checks.cooldown(1, 2)
@@ -248,29 +299,55 @@ class Streak(commands.Cog):
         interaction (discord.Interaction): The interaction
         """
 
-        await interaction.response.defer()
-
-        self.cursor.execute(
-            """
-            SELECT discord_id, streak_start_time
-            FROM streak
-            ORDER BY streak_start_time;
-            """
-        )
-        streaks = self.cursor.fetchall()
+        if not self.leaderboard:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Ingen har noen streak enda")
+            )
 
-        if not streaks:
-            return await interaction.followup.send(embed=embed_templates.error_warning("Ingen har noen streak enda"))
+        paginator = misc_utils.Paginator(self.leaderboard.entries.copy())
 
-        streaks_formatted = [
-            f"**#{s[0]+1}** <@{s[1][0]}> - {(datetime.now() - s[1][1]).days} dager" for s in enumerate(streaks)
-        ]
+        # Only the page being shown is formatted
+        def construct_page(page: list[tuple[datetime, int]], embed: discord.Embed) -> discord.Embed:
+            first_rank = (paginator.current_page - 1) * 10 + 1
+            embed.description = "\n".join(
+                f"**#{rank}** <@{user_id}> - {self.streak_days(streak_start_time)} dager"
+                for rank, (streak_start_time, user_id) in enumerate(page, start=first_rank)
+            )
+            embed.set_footer(text=f"Side {paginator.current_page}/{paginator.total_page_count}")
+            return embed
 
-        paginator = misc_utils.Paginator(streaks_formatted)
-        view = discord_utils.Scroller(paginator, interaction.user)
+        view = discord_utils.Scroller(paginator, interaction.user, construct_page)
 
         embed = view.construct_embed(discord.Embed(title="Toppliste for streaks"))
-        await interaction.followup.send(embed=embed, view=view)
+        await interaction.response.send_message(embed=embed, view=view)
+
+    @app_commands.checks.bot_has_permissions(embed_links=True)
+    @app_commands.checks.cooldown(1, 2)
+    @streak_group.command(name="plassering", description="Se din eller en annen brukers plassering på topplisten")
+    async def streak_rank(self, interaction: discord.Interaction, bruker: discord.Member | discord.User | None = None):
+        """
+        Get a user's place on the streak leaderboard
+
+        Parameters
+        ----------
+        interaction (discord.Interaction): The interaction
+        bruker (discord.Member | discord.User | None): The user to get the place of
+        """
+
+        if not bruker:
+            bruker = interaction.user
+
+        rank = self.leaderboard.rank(bruker.id)
+        if not rank:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Brukeren har ikke noen streak")
+            )
+
+        embed = discord.Embed(title="Plassering", description=bruker.mention)
+        embed.set_author(name=bruker.name, icon_url=bruker.avatar)
+        embed.add_field(name="Plass", value=f"#{rank} av {len(self.leaderboard)}")
+        embed.add_field(name="Antall dager", value=self.streak_days(self.leaderboard.scores[bruker.id]))
+        await interaction.response.send_message(embed=embed)
 
 
 async def setup(bot: commands.Bot):
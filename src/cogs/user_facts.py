@@ -1,12 +1,29 @@
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
 import discord
-import graphviz
-import numpy as np
 from discord import app_commands
 from discord.ext import commands
 
 from cogs.utils import discord_utils
 from cogs.utils import embed_templates
 from cogs.utils import misc_utils
+from cogs.utils.mbti_graph import render_mbti_graph
+from cogs.utils.mbti_index import MBTI_CODES
+from cogs.utils.mbti_index import MbtiIndex
+
+MBTI_GRAPH_CACHE_SIZE = 64
+MBTI_MATCH_LIMIT = 10
+
+
+def _noop():
+    """
+    Does nothing. Submitted on startup to get the graph worker forked early
+    """
 
 
 class UserFacts(commands.Cog):
@@ -15,26 +32,34 @@ class UserFacts(commands.Cog):
         self.cursor = self.bot.db_connection.cursor()
         self.init_db()
 
-        self.mbti_codes = {
-            "INTJ",
-            "INTP",
-            "ENTJ",
-            "ENTP",
-            "INFJ",
-            "INFP",
-            "ENFJ",
-            "ENFP",
-            "ISTJ",
-            "ISFJ",
-            "ESTJ",
-            "ESFJ",
-            "ISTP",
-            "ISFP",
-            "ESTP",
-            "ESFP",
-        }
-        self.mbti_list = list(self.mbti_codes)
-        self.similarity_matrix = self.create_similarity_matrix()
+        self.cursor.execute("SELECT discord_id, mbti FROM user_facts WHERE mbti IS NOT NULL;")
+        self.mbti_index = MbtiIndex(self.cursor.fetchall())
+
+        self.graph_executor = self.create_graph_executor()
+        # Rendered graphs keyed by everything that is drawn: names, MBTIs and edge lengths
+        self.graph_cache = OrderedDict()  # OrderedDict[tuple[tuple[str, str], tuple[tuple[str, str, float]]], bytes]
+
+    async def cog_unload(self):
+        self.bot.logger.info("Unloading cog")
+        self.graph_executor.shutdown(wait=False, cancel_futures=True)
+        self.cursor.close()
+
+    @staticmethod
+    def create_graph_executor() -> ProcessPoolExecutor:
+        """
+        Start a worker process for drawing MBTI graphs
+
+        Returns
+        ----------
+        (ProcessPoolExecutor): The pool, with its worker started
+        """
+
+        # We fork explicitly. run.py has no __main__ guard, so spawned workers would start a second bot.
+        # The worker is forked right away while the cog loads, like the word cloud renderer's, instead of on the
+        # first /mbti se while other threads are running. It only runs numpy and PIL code
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+        executor.submit(_noop)
+        return executor
 
     def init_db(self):
         """
@@ -201,52 +226,37 @@ class UserFacts(commands.Cog):
         if not bruker:
             bruker = interaction.user
 
-        self.cursor.execute(
-            """
-            SELECT mbti FROM user_facts
-            WHERE discord_id = %s AND mbti IS NOT NULL;
-            """,
-            (bruker.id,),
-        )
-        user_mbti = self.cursor.fetchone()
-
-        if not user_mbti:
+        if not (user_mbti := self.mbti_index.get(bruker.id)):
             return await interaction.response.send_message(
                 embed=embed_templates.error_warning("Brukeren har ikke lagt inn MBTI-en sin")
             )
 
-        user_mbti = user_mbti[0]
-
         embed = discord.Embed(color=bruker.color, title="MBTI", description=user_mbti)
         embed.set_author(name=bruker.global_name, icon_url=bruker.avatar)
+        embed.add_field(name="Antall med samme type", value=self.mbti_index.count(user_mbti))
 
-        self.cursor.execute(
-            """
-            SELECT discord_id, mbti FROM user_facts
-            WHERE mbti IS NOT NULL and discord_id != %s;
-            """,
-            (bruker.id,),
-        )
-
-        if not (results := self.cursor.fetchall()):
+        if not (results := self.mbti_index.matches(bruker.id)):
             return await interaction.response.send_message(embed=embed)
 
-        others = []
-        for discord_id, mbti in results:
-            if user := self.bot.get_user(discord_id):
-                others.append((user, mbti))
-            elif user := await interaction.guild.fetch_member(discord_id):
-                others.append((user, mbti))
-            else:
-                others.append((discord_id, mbti))
+        await interaction.response.defer()
+
+        key = self.mbti_graph_nodes((bruker, user_mbti), results)
+        if key in self.graph_cache:
+            self.graph_cache.move_to_end(key)
+        else:
+            try:
+                self.graph_cache[key] = await self.create_mbti_graph(*key)
+            except (BrokenProcessPool, OSError, ValueError) as err:
+                self.bot.logger.error(f"Failed to draw MBTI graph - {err}")
+                return await interaction.followup.send(embed=embed)
 
-        self.create_mbti_graph((bruker, user_mbti), others)
+            if len(self.graph_cache) > MBTI_GRAPH_CACHE_SIZE:
+                self.graph_cache.popitem(last=False)
 
-        with open(f"src/assets/temp/{bruker.id}_mbti.png", "rb") as f:
-            image = discord.File(f, filename=f"{bruker.id}_mbti.png")
+        image = discord.File(BytesIO(self.graph_cache[key]), filename=f"{bruker.id}_mbti.png")
 
         embed.set_image(url=f"attachment://{bruker.id}_mbti.png")
-        await interaction.response.send_message(embed=embed, file=image)
+        await interaction.followup.send(embed=embed, file=image)
 
     @app_commands.checks.bot_has_permissions(embed_links=True)
     @app_commands.checks.cooldown(1, 2)
@@ -261,7 +271,7 @@ class UserFacts(commands.Cog):
         mbti (str): The MBTI of the user
         """
 
-        if mbti.upper() not in self.mbti_codes:
+        if mbti.upper() not in MBTI_CODES:
             return await interaction.response.send_message(embed=embed_templates.error_warning("Ugyldig MBTI"))
 
         self.cursor.execute(
@@ -273,6 +283,7 @@ class UserFacts(commands.Cog):
             """,
             (interaction.user.id, mbti.upper(), mbti.upper()),
         )
+        self.mbti_index.set(interaction.user.id, mbti)
 
         await interaction.response.send_message(embed=embed_templates.success("MBTI satt!"))
 
@@ -287,9 +298,7 @@ class UserFacts(commands.Cog):
         current (str): The current input
         """
 
-        return [
-            app_commands.Choice(name=mbti, value=mbti) for mbti in self.mbti_codes if mbti.startswith(current.upper())
-        ]
+        return [app_commands.Choice(name=mbti, value=mbti) for mbti in MBTI_CODES if mbti.startswith(current.upper())]
 
     @app_commands.checks.bot_has_permissions(embed_links=True)
     @app_commands.checks.cooldown(1, 2)
@@ -311,6 +320,7 @@ class UserFacts(commands.Cog):
             """,
             (interaction.user.id,),
         )
+        self.mbti_index.remove(interaction.user.id)
 
         if self.cursor.rowcount == 0:
             return await interaction.response.send_message(
@@ -319,6 +329,41 @@ class UserFacts(commands.Cog):
 
         await interaction.response.send_message(embed=embed_templates.success("MBTI fjernet!"))
 
+    @app_commands.guild_only()
+    @app_commands.checks.bot_has_permissions(embed_links=True)
+    @app_commands.checks.cooldown(1, 2)
+    @mbti_group.command(name="match", description="Finn de på serveren med MBTI mest lik din")
+    async def mbti_match(self, interaction: discord.Interaction):
+        """
+        List the members of the server whose MBTI is most similar to the invoking user's
+
+        Parameters
+        ----------
+        interaction (discord.Interaction): The interaction object
+        """
+
+        if not (user_mbti := self.mbti_index.get(interaction.user.id)):
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Du har ikke lagt inn MBTI-en din")
+            )
+
+        # Ranked across everyone, so members of other servers are skipped here
+        matches = []
+        for user_id, mbti, similarity in self.mbti_index.matches(interaction.user.id):
+            if interaction.guild.get_member(user_id):
+                matches.append(f"**#{len(matches) + 1}** <@{user_id}> - `{mbti}` ({similarity}/4 like)")
+                if len(matches) == MBTI_MATCH_LIMIT:
+                    break
+
+        if not matches:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Ingen andre på serveren har lagt inn MBTI-en sin")
+            )
+
+        embed = discord.Embed(title=f"Beste match for {user_mbti}", color=interaction.user.color)
+        embed.description = "\n".join(matches)
+        await interaction.response.send_message(embed=embed)
+
     @app_commands.checks.bot_has_permissions(embed_links=True)
     @app_commands.checks.cooldown(1, 2)
     @mbti_group.command(name="forklaring", description="Skjønner du ikke hva MBTI er? Her er en forklaring")
@@ -341,53 +386,59 @@ class UserFacts(commands.Cog):
         )
         await interaction.response.send_message(embed=embed)
 
-    def create_similarity_matrix(self):
-        def similarity(mbti_1, mbti_2):
-            similarity = 0
-            for i in range(4):
-                if mbti_1[i] == mbti_2[i]:
-                    similarity += 1
-            return similarity
-
-        # Create an empty similarity matrix
-        similarity_matrix = np.zeros((len(self.mbti_list), len(self.mbti_list)))
+    def mbti_graph_nodes(
+        self, user_mbti: tuple[discord.Member, str], others: list[tuple[int, str, int]]
+    ) -> tuple[tuple[str, str], tuple[tuple[str, str, float]]]:
+        """
+        Get what goes into an MBTI graph. Everyone else is placed closer the more similar their MBTI is
 
-        # Fill the similarity matrix
-        for i, mbti in enumerate(self.mbti_list):
-            for j, mbti2 in enumerate(self.mbti_list):
-                similarity_matrix[i, j] = similarity(mbti, mbti2)
+        Parameters
+        ----------
+        user_mbti (tuple[discord.Member, str]): The user in the center and their MBTI
+        others (list[tuple[int, str, int]]): Discord ID, MBTI and letters in common with the user of everyone else
 
-        return similarity_matrix
+        Returns
+        ----------
+        (tuple[tuple[str, str], tuple[tuple[str, str, float]]]): Name and MBTI of the user in the center,
+            and name, MBTI and edge length of everyone else
+        """
 
-    # TODO: fix this. The distances are wrong
-    def create_mbti_graph(self, user_mbti: tuple[discord.Member, str], others: list[tuple[discord.Member, str]]):
         user, mbti = user_mbti
 
-        # Create a Graphviz graph
-        graph = graphviz.Graph(engine="neato", format="png")
-        graph.attr("graph", overlap="false")
-        graph.node_attr["style"] = "filled"
-        graph.node_attr["shape"] = "circle"
+        nodes = []
+        for discord_id, other_mbti, similarity in others:
+            other_user = self.bot.get_user(discord_id)
+            name = (other_user.global_name or other_user.name) if other_user else str(discord_id)
+            nodes.append((name, other_mbti, 6 / similarity if similarity else 6.5))
 
-        # Invoking user's node
-        graph.node(str(user.global_name), f"{user.global_name}\n{mbti}", color="green")
+        return (user.global_name or user.name, mbti), tuple(nodes)
 
-        user_index = self.mbti_list.index(mbti)
+    async def create_mbti_graph(self, center: tuple[str, str], nodes: tuple[tuple[str, str, float]]) -> bytes:
+        """
+        Draws an MBTI graph in a worker process. If the worker has died, it is replaced and the graph drawn again
 
-        # Add nodes and edges to other users
-        for other_index, other in enumerate(others):
-            weight = (1 / self.similarity_matrix[user_index, other_index]) * 6
-            if weight == float("inf"):
-                weight = 6
-            elif weight == 0:
-                weight = 6.5
+        Parameters
+        ----------
+        center (tuple[str, str]): Name and MBTI of the user in the center
+        nodes (tuple[tuple[str, str, float]]): Name, MBTI and edge length of everyone else
+
+        Returns
+        ----------
+        (bytes): The graph as PNG
+        """
 
-            other_user, other_mbti = other
+        loop = asyncio.get_running_loop()
+        executor = self.graph_executor
 
-            graph.node(other_user.global_name, f"{other_user.global_name}\n{other_mbti}")
-            graph.edge(user.global_name, other_user.global_name, len=str(weight), weight=str(weight))
+        try:
+            return await loop.run_in_executor(executor, render_mbti_graph, center, list(nodes))
+        except BrokenProcessPool:
+            # Another call may have replaced it already
+            if self.graph_executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self.graph_executor = self.create_graph_executor()
 
-        graph.render(f"{user.id}_mbti", directory="./src/assets/temp", view=False, overwrite_source=True)
+        return await loop.run_in_executor(self.graph_executor, render_mbti_graph, center, list(nodes))
 
 
 async def setup(bot: commands.Bot):
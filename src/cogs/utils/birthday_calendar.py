@@ -0,0 +1,160 @@
+import bisect
+import calendar
+import itertools
+from collections import defaultdict
+from datetime import date
+
+LEAP_DAY = (2, 29)
+
+
+def next_occurrence(month: int, day: int, today: date) -> date:
+    """
+    Get the next time a birthday occurs, today included.
+    Leap day birthdays are celebrated on the 28th of February in other years
+
+    Parameters
+    ----------
+    month (int): Month of the birthday
+    day (int): Day of the birthday
+    today (date): Today's date
+
+    Returns
+    ----------
+    (date): The date of the next birthday
+    """
+
+    for year in (today.year, today.year + 1):
+        if (month, day) == LEAP_DAY and not calendar.isleap(year):
+            occurrence = date(year, 2, 28)
+        else:
+            occurrence = date(year, month, day)
+
+        if occurrence >= today:
+            return occurrence
+
+
+class BirthdayCalendar:
+    """Birthdays indexed by day of the year, and kept in a circular calendar that starts at today"""
+
+    def __init__(self, birthdays: list[tuple[int, date]], today: date):
+        """
+        Parameters
+        ----------
+        birthdays (list[tuple[int, date]]): User IDs and dates of birth
+        today (date): Today's date
+        """
+
+        self.birthdays = {}  # dict[int, date]
+        self.by_day = defaultdict(set)  # dict[tuple[int, int], set[int]]. Keyed by month and day
+        self.ring = []  # Sorted list[tuple[int, int, int]] of month, day and user ID
+        self.today = today
+        self.start = 0  # Index of the first birthday in the ring that is today or later this year
+
+        for user_id, birthday in birthdays:
+            self.add(user_id, birthday)
+
+    def add(self, user_id: int, birthday: date):
+        """
+        Add a birthday, or change it if the user already has one
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        birthday (date): The user's date of birth
+        """
+
+        self.remove(user_id)
+        self.birthdays[user_id] = birthday
+        self.by_day[(birthday.month, birthday.day)].add(user_id)
+        bisect.insort(self.ring, (birthday.month, birthday.day, user_id))
+        self.rotate(self.today)
+
+    def remove(self, user_id: int):
+        """
+        Remove a user's birthday if they have one
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        """
+
+        if not (birthday := self.birthdays.pop(user_id, None)):
+            return
+
+        key = (birthday.month, birthday.day)
+        self.by_day[key].discard(user_id)
+        if not self.by_day[key]:
+            del self.by_day[key]
+
+        del self.ring[bisect.bisect_left(self.ring, (*key, user_id))]
+        self.rotate(self.today)
+
+    def rotate(self, today: date):
+        """
+        Move the start of the circular calendar to a new day
+
+        Parameters
+        ----------
+        today (date): Today's date
+        """
+
+        # Leap day birthdays sort right after the 28th of February,
+        # so they're still at the start on the 28th in years they're celebrated then
+        self.today = today
+        self.start = bisect.bisect_left(self.ring, (today.month, today.day))
+
+    def upcoming(self, limit: int | None = None) -> list[tuple[int, date]]:
+        """
+        Get the next birthdays, starting with today's
+
+        Parameters
+        ----------
+        limit (int | None): Maximum number of birthdays. Defaults to all of them
+
+        Returns
+        ----------
+        (list[tuple[int, date]]): User IDs and the dates of their next birthdays, soonest first
+        """
+
+        # Walk the ring from the start and wrap around, without copying it
+        indices = itertools.chain(range(self.start, len(self.ring)), range(self.start))
+        return [
+            (user_id, next_occurrence(month, day, self.today))
+            for month, day, user_id in (self.ring[i] for i in itertools.islice(indices, limit))
+        ]
+
+    def next_birthday(self, user_id: int) -> date | None:
+        """
+        Get the date of a user's next birthday
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (date | None): The date of the next birthday. None if the user has no birthday saved
+        """
+
+        if not (birthday := self.birthdays.get(user_id)):
+            return None
+
+        return next_occurrence(birthday.month, birthday.day, self.today)
+
+    def on(self, day: date) -> set[int]:
+        """
+        Get everyone who has their birthday on a given day
+
+        Parameters
+        ----------
+        day (date): The day
+
+        Returns
+        ----------
+        (set[int]): The users' Discord IDs
+        """
+
+        user_ids = set(self.by_day.get((day.month, day.day), ()))
+        if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+            user_ids |= self.by_day.get(LEAP_DAY, set())
+        return user_ids
@@ -0,0 +1,136 @@
+import itertools
+import math
+from collections.abc import Iterable
+from collections.abc import Mapping
+
+# Bigrams said fewer times than this are never shown as phrases
+MIN_BIGRAM_COUNT = 3
+
+# Pointwise mutual information in bits. 3 means the words appear together 8 times more often than by chance
+MIN_PMI = 3.0
+
+
+class BigramExtractor:
+    """Picks out the adjacent word pairs worth counting as potential phrases"""
+
+    def __init__(self, stopwords: Iterable[str], min_word_length: int = 3):
+        """
+        Parameters
+        ----------
+        stopwords (Iterable[str]): Words that never take part in a phrase
+        min_word_length (int): Shorter words never take part in a phrase. Matches the renderer's limit
+        """
+
+        self.stopwords = set(stopwords)
+        self.min_word_length = min_word_length
+
+    def __call__(self, tokens: list[str]) -> list[tuple[str, str]]:
+        """
+        Get the bigrams of a message
+
+        Parameters
+        ----------
+        tokens (list[str]): The message's tokens in order
+
+        Returns
+        ----------
+        (list[tuple[str, str]]): The bigrams
+        """
+
+        return [
+            (first, second)
+            for first, second in itertools.pairwise(tokens)
+            if self.is_phrase_word(first) and self.is_phrase_word(second)
+        ]
+
+    def is_phrase_word(self, word: str) -> bool:
+        """
+        Check if a word can be part of a phrase
+
+        Parameters
+        ----------
+        word (str): The word
+
+        Returns
+        ----------
+        (bool): Whether the word can be part of a phrase
+        """
+
+        return len(word) >= self.min_word_length and word not in self.stopwords
+
+
+def pmi(bigram_count: int, first_count: int, second_count: int, total: int) -> float:
+    """
+    Calculate the pointwise mutual information of a bigram
+
+    Parameters
+    ----------
+    bigram_count (int): Times the words were said together
+    first_count (int): Times the first word was said
+    second_count (int): Times the second word was said
+    total (int): Total number of words said
+
+    Returns
+    ----------
+    (float): The PMI in bits
+    """
+
+    return math.log2(bigram_count * total / (first_count * second_count))
+
+
+def find_collocations(
+    word_freqs: Mapping[str, int], bigram_freqs: Mapping[tuple[str, str], int]
+) -> dict[tuple[str, str], int]:
+    """
+    Keep the bigrams that are both frequent and far more likely than chance
+
+    Parameters
+    ----------
+    word_freqs (Mapping[str, int]): Word frequencies
+    bigram_freqs (Mapping[tuple[str, str], int]): Bigram frequencies from the same text
+
+    Returns
+    ----------
+    (dict[tuple[str, str], int]): The collocations and their frequencies
+    """
+
+    total = sum(word_freqs.values())
+
+    collocations = {}
+    for (first, second), count in bigram_freqs.items():
+        if count < MIN_BIGRAM_COUNT:
+            continue
+
+        # Counts may be approximate or stored separately, so don't trust the unigrams to cover the bigram
+        first_count, second_count = word_freqs.get(first, 0), word_freqs.get(second, 0)
+        if first_count < count or second_count < count:
+            continue
+
+        if pmi(count, first_count, second_count, total) >= MIN_PMI:
+            collocations[(first, second)] = count
+
+    return collocations
+
+
+def merge_collocations(word_freqs: Mapping[str, int], collocations: Mapping[tuple[str, str], int]) -> dict[str, int]:
+    """
+    Add collocations as phrases and take their occurrences away from the single words.
+    Does the same as the wordcloud library's collocation handling
+
+    Parameters
+    ----------
+    word_freqs (Mapping[str, int]): Word frequencies
+    collocations (Mapping[tuple[str, str], int]): Collocations and their frequencies
+
+    Returns
+    ----------
+    (dict[str, int]): Word and phrase frequencies
+    """
+
+    merged = dict(word_freqs)
+    for (first, second), count in collocations.items():
+        merged[f"{first} {second}"] = count
+        merged[first] = max(0, merged[first] - count)
+        merged[second] = max(0, merged[second] - count)
+
+    return {word: freq for word, freq in merged.items() if freq}
@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+from random import random
+
+
+@dataclass(frozen=True)
+class CreditRule:
+    """
+    A rule that gives or takes social credits for messages.
+    Empty channel and hour sets mean the rule applies everywhere and at all hours
+    """
+
+    reason: str
+    points: int  # Negative for punishments
+    probability: float = 1.0
+    channel_ids: frozenset[int] = frozenset()
+    hours: frozenset[int] = frozenset()  # Hours of the day in Norwegian time
+    requires_mentions: bool = False
+    target_mentions: bool = False  # Whether the mentioned users are affected instead of the author
+
+    def roll(self) -> bool:
+        """
+        Decide whether the rule fires this time
+
+        Returns
+        ----------
+        (bool): Whether the rule fires
+        """
+
+        return self.probability >= 1 or random() < self.probability
+
+
+# Seeded into the database the first time the cog loads. Edit the rules in the database afterwards
+DEFAULT_RULES = (
+    CreditRule(
+        "gullkorn", -10, channel_ids=frozenset({865970753748074576}), requires_mentions=True, target_mentions=True
+    ),
+    CreditRule("politics", -25, probability=0.5, channel_ids=frozenset({754706204349038644})),
+    CreditRule("member-chat", 10, probability=0.25, channel_ids=frozenset({811606213665357824})),
+    CreditRule("early-bird", -10, probability=0.5, hours=frozenset(range(5, 10))),
+    CreditRule("night-owl", 10, probability=0.5, hours=frozenset(range(1, 5))),
+)
+
+
+class RuleIndex:
+    """Rules compiled into a lookup table keyed by channel and hour, so messages only see rules that can apply"""
+
+    def __init__(self, rules: list[CreditRule]):
+        """
+        Parameters
+        ----------
+        rules (list[CreditRule]): The rules to compile
+        """
+
+        self.rules = rules
+        self.table = {}  # dict[tuple[int | None, int], tuple[CreditRule, ...]]. None means any channel
+
+        for rule in rules:
+            for channel_id in rule.channel_ids or (None,):
+                for hour in rule.hours or range(24):
+                    self.table[(channel_id, hour)] = self.table.get((channel_id, hour), ()) + (rule,)
+
+    def candidates(self, channel_id: int, hour: int) -> tuple[CreditRule, ...]:
+        """
+        Get the rules that can apply to a message
+
+        Parameters
+        ----------
+        channel_id (int): The message's channel ID
+        hour (int): The hour the message was sent, in Norwegian time
+
+        Returns
+        ----------
+        (tuple[CreditRule, ...]): The rules
+        """
+
+        return self.table.get((channel_id, hour), ()) + self.table.get((None, hour), ())
@@ -0,0 +1,140 @@
+import csv
+import gzip
+import io
+import json
+from tempfile import SpooledTemporaryFile
+
+from psycopg2.extensions import connection as Connection
+
+ROWS_PER_FETCH = 2000
+
+# Parts stay in memory up to this size and are moved to disk beyond it
+SPOOL_MEMORY_BYTES = 1024 * 1024
+
+EXPORT_FORMATS = ("jsonl", "csv")
+
+
+class ExportWriter:
+    """Writes rows as gzipped JSON Lines or CSV, starting a new part whenever the current one gets too large"""
+
+    def __init__(self, columns: tuple[str, ...], export_format: str, max_part_bytes: int):
+        """
+        Parameters
+        ----------
+        columns (tuple[str, ...]): Column names, in the same order as the values of each row
+        export_format (str): One of EXPORT_FORMATS
+        max_part_bytes (int): Maximum compressed size of each part
+        """
+
+        self.columns = columns
+        self.export_format = export_format
+
+        # gzip doesn't write compressed data out right away, so parts are cut a bit before the limit
+        self.part_size_threshold = max_part_bytes - max_part_bytes // 8
+
+        self.parts = []  # list[SpooledTemporaryFile]
+        self.row_count = 0
+        self._start_part()
+
+    def _start_part(self):
+        """
+        Start writing to a new part. Every part is a complete file on its own
+        """
+
+        self.file = SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode="wb")
+        self.text = io.TextIOWrapper(self.gzip, encoding="utf-8", newline="")
+        self.parts.append(self.file)
+
+        if self.export_format == "csv":
+            self.csv_writer = csv.writer(self.text)
+            self.csv_writer.writerow(self.columns)
+
+    def _finish_part(self):
+        """
+        Flush and close the compression stream of the current part, leaving the part itself open
+        """
+
+        self.text.flush()
+        self.text.detach()
+        self.gzip.close()
+
+    def write(self, row: tuple):
+        """
+        Write a row
+
+        Parameters
+        ----------
+        row (tuple): The row's values
+        """
+
+        if self.file.tell() >= self.part_size_threshold:
+            self._finish_part()
+            self._start_part()
+
+        if self.export_format == "csv":
+            self.csv_writer.writerow(row)
+        else:
+            self.text.write(
+                json.dumps(dict(zip(self.columns, row, strict=True)), ensure_ascii=False, separators=(",", ":"))
+            )
+            self.text.write("\n")
+
+        self.row_count += 1
+
+    def close(self) -> list[SpooledTemporaryFile]:
+        """
+        Finish the export
+
+        Returns
+        ----------
+        (list[SpooledTemporaryFile]): The parts, rewound and ready to be read
+        """
+
+        self._finish_part()
+        for part in self.parts:
+            part.seek(0)
+        return self.parts
+
+
+def export_query(
+    connection: Connection,
+    query: str,
+    params: tuple | dict,
+    columns: tuple[str, ...],
+    export_format: str,
+    max_part_bytes: int,
+) -> tuple[list[SpooledTemporaryFile], int]:
+    """
+    Export the result of a query. Rows are read through a server-side cursor a batch at a time,
+    so memory use doesn't depend on the size of the result. Blocking, so it should be run in a separate thread
+
+    Parameters
+    ----------
+    connection (Connection): Database connection. Must not be in autocommit mode since server-side cursors
+        only live within a transaction
+    query (str): The query
+    params (tuple | dict): The query's parameters
+    columns (tuple[str, ...]): Names of the columns the query returns
+    export_format (str): One of EXPORT_FORMATS
+    max_part_bytes (int): Maximum compressed size of each part
+
+    Returns
+    ----------
+    (tuple[list[SpooledTemporaryFile], int]): The gzipped parts and the number of rows exported
+    """
+
+    writer = ExportWriter(columns, export_format, max_part_bytes)
+
+    try:
+        with connection, connection.cursor(name="export") as cursor:
+            cursor.itersize = ROWS_PER_FETCH
+            cursor.execute(query, params)
+            for row in cursor:
+                writer.write(row)
+    except Exception:
+        for part in writer.close():
+            part.close()
+        raise
+
+    return writer.close(), writer.row_count
@@ -0,0 +1,56 @@
+import csv
+import itertools
+from io import StringIO
+from typing import Iterable
+
+from psycopg2.extensions import cursor as Cursor
+
+ROWS_PER_READ = 1000
+
+
+class _CSVRowStream:
+    """File-like object that lazily renders rows as CSV, so COPY never needs the whole payload in memory"""
+
+    def __init__(self, rows: Iterable[tuple]):
+        """
+        Parameters
+        ----------
+        rows (Iterable[tuple]): The rows to render
+        """
+
+        self.rows = iter(rows)
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def read(self, size: int = -1) -> str:
+        """
+        Render the next chunk of rows. psycopg2 stops reading once an empty string is returned
+
+        Parameters
+        ----------
+        size (int): Ignored. psycopg2 accepts chunks of any size
+
+        Returns
+        ----------
+        (str): The next chunk of CSV
+        """
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.writer.writerows(itertools.islice(self.rows, ROWS_PER_READ))
+        return self.buffer.getvalue()
+
+
+def copy_rows(cursor: Cursor, table: str, columns: tuple[str, ...], rows: Iterable[tuple]):
+    """
+    Stream rows into a table using COPY. Much faster than inserting row by row
+
+    Parameters
+    ----------
+    cursor (Cursor): Database cursor
+    table (str): Table to copy into. Never pass user input here
+    columns (tuple[str, ...]): Columns to copy into, in the same order as the values of each row
+    rows (Iterable[tuple]): The rows to copy
+    """
+
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", _CSVRowStream(rows))
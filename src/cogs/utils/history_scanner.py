@@ -0,0 +1,104 @@
+import asyncio
+from collections import Counter
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Awaitable
+from typing import Callable
+
+import discord
+
+# Each channel's message history is its own rate limit bucket, so concurrent channels don't slow each other down.
+# Stay well below the global limit of 50 requests per second since every page is 100 messages
+DEFAULT_CONCURRENCY = 8
+
+
+@dataclass
+class ScanProgress:
+    channels_total: int
+    channels_done: int = 0
+    messages: int = 0
+    tokens: int = 0
+
+
+class HistoryScanner:
+    """Counts tokens from the recent message history of several channels concurrently"""
+
+    def __init__(
+        self,
+        message_filter: Callable[[discord.Message], bool],
+        tokenizer: Callable[[str], list[str]],
+        bigram_extractor: Callable[[list[str]], Iterable[tuple[str, str]]] | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        """
+        Parameters
+        ----------
+        message_filter (Callable[[discord.Message], bool]): Returns whether a message should be counted
+        tokenizer (Callable[[str], list[str]]): Splits message content into tokens
+        bigram_extractor (Callable[[list[str]], Iterable[tuple[str, str]]] | None): Picks out the bigrams to count
+            from a message's tokens. Bigrams aren't counted if not given
+        concurrency (int): Maximum number of channels read at once. Defaults to DEFAULT_CONCURRENCY
+        """
+
+        self.message_filter = message_filter
+        self.tokenizer = tokenizer
+        self.bigram_extractor = bigram_extractor
+        self.concurrency = concurrency
+
+    async def scan(
+        self,
+        channels: list[discord.TextChannel],
+        limit: int,
+        token_budget: int,
+        on_progress: Callable[[ScanProgress], Awaitable[None]] | None = None,
+    ) -> tuple[Counter, Counter, ScanProgress]:
+        """
+        Scans the history of the given channels. Stops early once the token budget is reached
+
+        Parameters
+        ----------
+        channels (list[discord.TextChannel]): Channels to scan
+        limit (int): Maximum number of messages to read per channel
+        token_budget (int): Stop scanning once this many tokens have been counted
+        on_progress (Callable[[ScanProgress], Awaitable[None]] | None): Called every time a channel is done
+
+        Returns
+        ----------
+        (tuple[Counter, Counter, ScanProgress]): Token frequencies, bigram frequencies and the final progress
+        """
+
+        counter = Counter()
+        bigram_counter = Counter()
+        progress = ScanProgress(channels_total=len(channels))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def scan_channel(channel: discord.TextChannel):
+            async with semaphore:
+                if progress.tokens < token_budget:
+                    try:
+                        async for message in channel.history(limit=limit):
+                            if not self.message_filter(message):
+                                continue
+
+                            tokens = self.tokenizer(message.clean_content)
+                            counter.update(tokens)
+                            if self.bigram_extractor:
+                                bigram_counter.update(self.bigram_extractor(tokens))
+                            progress.messages += 1
+                            progress.tokens += len(tokens)
+
+                            if progress.tokens >= token_budget:
+                                break
+                    except discord.errors.Forbidden:
+                        pass
+
+            progress.channels_done += 1
+            if on_progress:
+                # Progress is only cosmetic. A failed update, e.g. an expired interaction, shouldn't abort the scan
+                try:
+                    await on_progress(progress)
+                except discord.HTTPException:
+                    pass
+
+        await asyncio.gather(*(scan_channel(channel) for channel in channels))
+        return counter, bigram_counter, progress
@@ -0,0 +1,61 @@
+import bisect
+from typing import Any
+
+
+class Leaderboard:
+    """Members kept sorted by a score, lowest first, with O(log n) rank lookups"""
+
+    def __init__(self):
+        self.entries = []  # Sorted list[tuple[Any, int]] of scores and member IDs. Ties are ordered by ID
+        self.scores = {}  # dict[int, Any]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, member_id: int, score: Any):
+        """
+        Add a member, or move them if they're already on the leaderboard
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+        score (Any): The member's score. Must be comparable with the other scores
+        """
+
+        self.remove(member_id)
+        bisect.insort(self.entries, (score, member_id))
+        self.scores[member_id] = score
+
+    def remove(self, member_id: int):
+        """
+        Remove a member if they're on the leaderboard
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+        """
+
+        score = self.scores.pop(member_id, None)
+        if score is None:
+            return
+
+        del self.entries[bisect.bisect_left(self.entries, (score, member_id))]
+
+    def rank(self, member_id: int) -> int | None:
+        """
+        Get a member's rank
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+
+        Returns
+        ----------
+        (int | None): The member's rank, starting at 1. None if they're not on the leaderboard
+        """
+
+        score = self.scores.get(member_id)
+        if score is None:
+            return None
+
+        return bisect.bisect_left(self.entries, (score, member_id)) + 1
@@ -0,0 +1,100 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+# Sizes are in layout units. Edge lengths are a handful of units long
+NODE_RADIUS = 0.7
+PIXELS_PER_UNIT = 60
+MAX_LABEL_LENGTH = 14
+
+ITERATIONS = 300
+
+
+def force_layout(lengths: np.ndarray, iterations: int = ITERATIONS) -> np.ndarray:
+    """
+    Places nodes around a center node at the origin. Each node is pulled towards its own distance from the center
+    while all nodes push each other away, so they spread out without overlapping
+
+    Parameters
+    ----------
+    lengths (np.ndarray): Wanted distance from the center for each node
+    iterations (int): Number of simulation steps. Defaults to ITERATIONS
+
+    Returns
+    ----------
+    (np.ndarray): Positions of the nodes, shaped (len(lengths), 2)
+    """
+
+    # Start out evenly spread on circles of the right sizes. Deterministic, so the same input gives the same graph
+    angles = np.linspace(0, 2 * np.pi, len(lengths), endpoint=False)
+    positions = np.column_stack((np.cos(angles), np.sin(angles))) * lengths[:, None]
+    min_distance = NODE_RADIUS * 2.2
+
+    for step in range(iterations):
+        temperature = 1 - step / iterations
+
+        distances = np.maximum(np.linalg.norm(positions, axis=1), 1e-6)
+        force = positions * ((lengths - distances) / distances)[:, None]
+
+        # Weak repulsion between all nodes, and a strong one between overlapping nodes
+        differences = positions[:, None, :] - positions[None, :, :]
+        pair_distances = np.maximum(np.linalg.norm(differences, axis=2), 1e-6)
+        np.fill_diagonal(pair_distances, np.inf)
+        repulsion = 0.05 / pair_distances**2 + np.maximum(min_distance - pair_distances, 0)
+        force += (differences * (repulsion / pair_distances)[:, :, None]).sum(axis=1)
+
+        positions += force * 0.5 * temperature
+
+    return positions
+
+
+def render_mbti_graph(center: tuple[str, str], others: list[tuple[str, str, float]]) -> bytes:
+    """
+    Draws a graph of a user and their distance to everyone else. Blocking, so it should be run in a worker
+
+    Parameters
+    ----------
+    center (tuple[str, str]): Name and MBTI of the user in the center
+    others (list[tuple[str, str, float]]): Name, MBTI and edge length of everyone else
+
+    Returns
+    ----------
+    (bytes): The graph as PNG
+    """
+
+    lengths = np.array([length for _, _, length in others], dtype=float)
+    positions = np.vstack((np.zeros((1, 2)), force_layout(lengths)))
+    labels = [center] + [(name, mbti) for name, mbti, _ in others]
+
+    margin = NODE_RADIUS + 0.3
+    low = positions.min(axis=0) - margin
+    high = positions.max(axis=0) + margin
+    width, height = (int(size) for size in np.ceil((high - low) * PIXELS_PER_UNIT))
+    pixels = (positions - low) * PIXELS_PER_UNIT
+    radius = NODE_RADIUS * PIXELS_PER_UNIT
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=13)
+
+    center_x, center_y = pixels[0]
+    for x, y in pixels[1:]:
+        draw.line((center_x, center_y, x, y), fill="black", width=2)
+
+    for i, ((x, y), (name, mbti)) in enumerate(zip(pixels, labels, strict=True)):
+        draw.ellipse(
+            (x - radius, y - radius, x + radius, y + radius),
+            fill="green" if i == 0 else "lightgrey",
+            outline="black",
+            width=2,
+        )
+        draw.multiline_text(
+            (x, y), f"{name[:MAX_LABEL_LENGTH]}\n{mbti}", fill="black", font=font, anchor="mm", align="center"
+        )
+
+    b = BytesIO()
+    image.save(b, "png")
+    return b.getvalue()
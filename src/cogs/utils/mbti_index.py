@@ -0,0 +1,165 @@
+import numpy as np
+
+# Each letter pair is one bit of a type's code. The first letter of a pair is 0 and the second is 1
+MBTI_LETTERS = ("EI", "SN", "TF", "JP")
+
+MBTI_CODES = tuple(
+    "".join(letters[(code >> bit) & 1] for bit, letters in enumerate(MBTI_LETTERS)) for code in range(16)
+)
+
+# Number of set bits in every 4-bit value, used to count differing letters
+POPCOUNT = np.array([bin(value).count("1") for value in range(16)], dtype=np.uint8)
+
+
+def encode(mbti: str) -> int:
+    """
+    Pack an MBTI type into 4 bits
+
+    Parameters
+    ----------
+    mbti (str): The MBTI type, e.g. INTP
+
+    Returns
+    ----------
+    (int): The type's code
+    """
+
+    return MBTI_CODES.index(mbti.upper())
+
+
+def similarity(a: int | np.ndarray, b: int | np.ndarray) -> int | np.ndarray:
+    """
+    Count how many letters two MBTI types have in common. Works element-wise on arrays of codes
+
+    Parameters
+    ----------
+    a (int | np.ndarray): Code of the first type
+    b (int | np.ndarray): Code of the second type
+
+    Returns
+    ----------
+    (int | np.ndarray): Number of letters in common, from 0 to 4
+    """
+
+    return 4 - POPCOUNT[np.bitwise_xor(a, b)]
+
+
+class MbtiIndex:
+    """Everyone's MBTI type kept as arrays of codes, so comparisons against all users are vectorized"""
+
+    def __init__(self, types: list[tuple[int, str]]):
+        """
+        Parameters
+        ----------
+        types (list[tuple[int, str]]): User IDs and MBTI types
+        """
+
+        self.types = {}  # dict[int, int] of user ID to type code
+        self.counts = np.zeros(16, dtype=np.int64)  # Number of users per type code
+
+        # Rebuilt lazily on the next query after a change
+        self._user_ids = None
+        self._codes = None
+
+        for user_id, mbti in types:
+            self.set(user_id, mbti)
+
+    def set(self, user_id: int, mbti: str):
+        """
+        Set a user's type
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        mbti (str): The MBTI type
+        """
+
+        self.remove(user_id)
+        code = encode(mbti)
+        self.types[user_id] = code
+        self.counts[code] += 1
+        self._user_ids = None
+
+    def remove(self, user_id: int):
+        """
+        Remove a user's type if they have one
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        """
+
+        if (code := self.types.pop(user_id, None)) is None:
+            return
+
+        self.counts[code] -= 1
+        self._user_ids = None
+
+    def get(self, user_id: int) -> str | None:
+        """
+        Get a user's type
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (str | None): The MBTI type. None if the user hasn't set one
+        """
+
+        code = self.types.get(user_id)
+        return MBTI_CODES[code] if code is not None else None
+
+    def count(self, mbti: str) -> int:
+        """
+        Get the number of users with a type
+
+        Parameters
+        ----------
+        mbti (str): The MBTI type
+
+        Returns
+        ----------
+        (int): The number of users
+        """
+
+        return int(self.counts[encode(mbti)])
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get everyone's user ID and type code as arrays
+
+        Returns
+        ----------
+        (tuple[np.ndarray, np.ndarray]): User IDs and type codes, in the same order
+        """
+
+        if self._user_ids is None:
+            self._user_ids = np.fromiter(self.types.keys(), dtype=np.int64, count=len(self.types))
+            self._codes = np.fromiter(self.types.values(), dtype=np.uint8, count=len(self.types))
+
+        return self._user_ids, self._codes
+
+    def matches(self, user_id: int, limit: int | None = None) -> list[tuple[int, str, int]]:
+        """
+        Rank everyone else by how similar their type is to a user's
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID. Must have a type
+        limit (int | None): Maximum number of users. Defaults to everyone
+
+        Returns
+        ----------
+        (list[tuple[int, str, int]]): User ID, MBTI type and letters in common, most similar first
+        """
+
+        user_ids, codes = self.arrays()
+        others = user_ids != user_id
+        user_ids, codes = user_ids[others], codes[others]
+        similarities = similarity(codes, self.types[user_id])
+
+        # Stable, so ties keep the same order between calls
+        order = np.argsort(-similarities.astype(np.int8), kind="stable")[:limit]
+        return [(int(user_ids[i]), MBTI_CODES[codes[i]], int(similarities[i])) for i in order]
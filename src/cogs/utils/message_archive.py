@@ -0,0 +1,359 @@
+import asyncio
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+import discord
+from psycopg2.extensions import connection as Connection
+from psycopg2.extensions import cursor as Cursor
+from psycopg2.extras import execute_values
+
+from cogs.utils import misc_utils
+
+# Day segments older than this are dropped by the nightly maintenance
+RETENTION_DAYS = 90
+
+
+class MessageArchive:
+    """
+    Append-only archive of message metadata and tokens, partitioned into one segment per day.
+
+    Edits and deletions are appended as new events, so the latest event for a message decides its current state.
+    The only earlier rows ever modified are the tokens of deleted messages, which are cleared.
+    Callers are responsible for only recording messages from consenting users.
+
+    The archive has its own connection. Everything but the constructor runs the queries in a thread,
+    one at a time so transactions on the connection never interleave
+    """
+
+    def __init__(self, connection: Connection):
+        """
+        Parameters
+        ----------
+        connection (Connection): Database connection without autocommit. Owned by the archive
+        """
+
+        self.connection = connection
+        self.lock = asyncio.Lock()
+        self.buffer = []  # list[tuple[int, int, int, datetime, str, list[str]]]
+
+        with self.connection, self.connection.cursor() as cursor:
+            self.init_db(cursor)
+            self.ensure_segments(cursor, datetime.now(misc_utils.TIMEZONE).date())
+
+    @staticmethod
+    def init_db(cursor: Cursor):
+        """
+        Create the partitioned archive table and its indexes
+
+        Parameters
+        ----------
+        cursor (Cursor): Database cursor
+        """
+
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_archive (
+                seq BIGSERIAL,
+                message_id BIGINT NOT NULL,
+                channel_id BIGINT NOT NULL,
+                author_id BIGINT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL,
+                kind TEXT NOT NULL CHECK (kind IN ('create', 'edit', 'delete')),
+                tokens TEXT[] NOT NULL
+            ) PARTITION BY RANGE (created_at)
+            """
+        )
+        # Catches events for messages older than the oldest segment, e.g. edits of ancient messages
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_archive_default
+            PARTITION OF message_archive DEFAULT
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS message_archive_author_idx
+            ON message_archive (author_id, message_id)
+            """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS message_archive_channel_idx
+            ON message_archive (channel_id, message_id)
+            """
+        )
+
+    @staticmethod
+    def segment_name(day: date) -> str:
+        """
+        Get the table name of a day segment
+
+        Parameters
+        ----------
+        day (date): The day
+
+        Returns
+        ----------
+        (str): The segment's table name
+        """
+
+        return f"message_archive_{day.strftime('%Y%m%d')}"
+
+    @classmethod
+    def ensure_segments(cls, cursor: Cursor, today: date):
+        """
+        Create the segments for today and tomorrow if they don't exist
+
+        Parameters
+        ----------
+        cursor (Cursor): Database cursor
+        today (date): Today's date
+        """
+
+        for day in (today, today + timedelta(days=1)):
+            start = datetime.combine(day, datetime.min.time(), tzinfo=misc_utils.TIMEZONE)
+            end = start + timedelta(days=1)
+
+            # Table names can't be parameterized. The name only ever contains digits from the date though
+            cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {cls.segment_name(day)}
+                PARTITION OF message_archive
+                FOR VALUES FROM (%s) TO (%s)
+                """,
+                (start, end),
+            )
+
+    @classmethod
+    def drop_expired_segments(cls, cursor: Cursor, today: date):
+        """
+        Drop day segments past retention. Dropping a whole segment is far cheaper than deleting its rows.
+        Rows in the default segment have to be deleted one by one
+
+        Parameters
+        ----------
+        cursor (Cursor): Database cursor
+        today (date): Today's date
+        """
+
+        cutoff_day = today - timedelta(days=RETENTION_DAYS)
+        cutoff = cls.segment_name(cutoff_day)
+
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = 'message_archive' AND child.relname ~ '^message_archive_[0-9]{8}$'
+            """
+        )
+
+        for (segment,) in cursor.fetchall():
+            if segment < cutoff:
+                cursor.execute(f"DROP TABLE IF EXISTS {segment}")
+
+        cursor.execute(
+            "DELETE FROM message_archive_default WHERE created_at < %s",
+            (datetime.combine(cutoff_day, datetime.min.time(), tzinfo=misc_utils.TIMEZONE),),
+        )
+
+    def maintain_segments(self, today: date):
+        """
+        Create upcoming segments and drop expired ones. Blocking
+
+        Parameters
+        ----------
+        today (date): Today's date
+        """
+
+        with self.connection, self.connection.cursor() as cursor:
+            self.ensure_segments(cursor, today)
+            self.drop_expired_segments(cursor, today)
+
+    async def maintain(self, today: date):
+        """
+        Create upcoming segments and drop expired ones in a thread
+
+        Parameters
+        ----------
+        today (date): Today's date
+
+        Raises
+        ----------
+        psycopg2.Error: If a query fails
+        """
+
+        async with self.lock:
+            await asyncio.to_thread(self.maintain_segments, today)
+
+    def record(self, message: discord.Message, kind: str, tokens: list[str] | None = None):
+        """
+        Buffer an event for a message. Written to the database on the next flush
+
+        Parameters
+        ----------
+        message (discord.Message): The message
+        kind (str): One of 'create', 'edit' or 'delete'
+        tokens (list[str] | None): The message's tokens. Not needed for deletions
+        """
+
+        self.buffer.append((message.id, message.channel.id, message.author.id, message.created_at, kind, tokens or []))
+
+    def write_events(self, events: list[tuple[int, int, int, datetime, str, list[str]]]):
+        """
+        Write events to the database in a single transaction, and clear the tokens of deleted messages. Blocking
+
+        Parameters
+        ----------
+        events (list[tuple[int, int, int, datetime, str, list[str]]]): The events, oldest first
+        """
+
+        deleted = [(channel_id, message_id) for message_id, channel_id, _, _, kind, _ in events if kind == "delete"]
+
+        # execute_values sends the rows in pages. The transaction makes sure a retry never writes a page twice
+        with self.connection, self.connection.cursor() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO message_archive (message_id, channel_id, author_id, created_at, kind, tokens)
+                VALUES %s
+                """,
+                events,
+            )
+
+            # Content of deleted messages shouldn't be kept around for the rest of retention
+            if deleted:
+                execute_values(
+                    cursor,
+                    """
+                    UPDATE message_archive
+                    SET tokens = '{}'
+                    FROM (VALUES %s) AS deleted (channel_id, message_id)
+                    WHERE message_archive.channel_id = deleted.channel_id
+                        AND message_archive.message_id = deleted.message_id
+                        AND message_archive.tokens != '{}'
+                    """,
+                    deleted,
+                )
+
+    def read_recent_tokens(self, channel_ids: list[int], limit: int, since: datetime) -> list[tuple[int, list[str]]]:
+        """
+        Read the tokens of the most recent messages in each channel. Blocking
+
+        Parameters
+        ----------
+        channel_ids (list[int]): Channels to read from
+        limit (int): Maximum number of messages per channel
+        since (datetime): Ignore messages older than this
+
+        Returns
+        ----------
+        (list[tuple[int, list[str]]]): The ID and tokens of each message, newest first
+        """
+
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT message_id, tokens
+                FROM (
+                    SELECT
+                        message_id,
+                        tokens,
+                        ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY message_id DESC) AS channel_rank
+                    FROM (
+                        SELECT DISTINCT ON (message_id) message_id, channel_id, kind, tokens
+                        FROM message_archive
+                        WHERE channel_id = ANY(%s) AND created_at >= %s
+                        ORDER BY message_id DESC, seq DESC
+                    ) latest
+                    WHERE kind != 'delete'
+                ) ranked
+                WHERE channel_rank <= %s
+                ORDER BY message_id DESC
+                """,
+                (channel_ids, since, limit),
+            )
+            return cursor.fetchall()
+
+    async def flush(self):
+        """
+        Write buffered events to the database in a single transaction, in a thread
+
+        Raises
+        ----------
+        psycopg2.Error: If the write fails. Nothing is written and the events are put back so they can be retried
+        """
+
+        async with self.lock:
+            if not self.buffer:
+                return
+
+            # Events recorded during the write go into a fresh buffer
+            events, self.buffer = self.buffer, []
+            try:
+                await asyncio.to_thread(self.write_events, events)
+            except Exception:
+                self.buffer = events + self.buffer
+                raise
+
+    async def recent_tokens(
+        self, channel_ids: list[int], limit: int, since: datetime | None = None
+    ) -> list[tuple[int, list[str]]]:
+        """
+        Get the tokens of the most recent messages in a set of channels, newest first
+
+        Parameters
+        ----------
+        channel_ids (list[int]): Channels to read from
+        limit (int): Maximum number of messages per channel
+        since (datetime | None): Ignore messages older than this. Lets the planner skip old segments.
+            Defaults to the start of retention
+
+        Returns
+        ----------
+        (list[tuple[int, list[str]]]): The ID and tokens of each message
+
+        Raises
+        ----------
+        psycopg2.Error: If a query fails
+        """
+
+        await self.flush()
+
+        if not since:
+            since = datetime.now(misc_utils.TIMEZONE) - timedelta(days=RETENTION_DAYS)
+
+        async with self.lock:
+            return await asyncio.to_thread(self.read_recent_tokens, channel_ids, limit, since)
+
+    def delete_user(self, user_id: int):
+        """
+        Delete all archived rows of a user. Blocking
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        """
+
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute("DELETE FROM message_archive WHERE author_id = %s", (user_id,))
+
+    async def forget_user(self, user_id: int):
+        """
+        Delete everything archived about a user. The only time rows are ever removed outside of retention.
+        Waits for a running flush, so none of the user's events are written after the delete
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Raises
+        ----------
+        psycopg2.Error: If the delete fails
+        """
+
+        async with self.lock:
+            self.buffer = [event for event in self.buffer if event[2] != user_id]
+            await asyncio.to_thread(self.delete_user, user_id)
@@ -9,7 +9,8 @@ from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 
-MIDNIGHT = datetime.time(hour=0, minute=0, tzinfo=ZoneInfo("Europe/Oslo"))
+TIMEZONE = ZoneInfo("Europe/Oslo")
+MIDNIGHT = datetime.time(hour=0, minute=0, tzinfo=TIMEZONE)
 
 
 class Paginator:
@@ -0,0 +1,128 @@
+import heapq
+from collections.abc import Iterable
+from collections.abc import Iterator
+from collections.abc import Mapping
+
+
+class SpaceSaving:
+    """
+    Approximate top-k word counter using the Space-Saving algorithm.
+
+    Never tracks more than `capacity` words. When full, a new word replaces the least frequent one
+    and inherits its count as overestimation error. Every word with a true count above `max_error()`
+    is guaranteed to be tracked
+    """
+
+    def __init__(self, capacity: int):
+        """
+        Parameters
+        ----------
+        capacity (int): Maximum number of words to track
+        """
+
+        self.capacity = capacity
+        self.counts = {}  # dict[str, int]
+        self.errors = {}  # dict[str, int]
+
+        # One entry per tracked word. Counts only ever grow, so entries may be stale but never too high
+        self.heap = []  # list[tuple[int, str]]
+
+        # Error inherited from sketches merged into this one
+        self.carried_error = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.counts)
+
+    def _min_entry(self) -> tuple[int, str]:
+        """
+        Get the least frequent tracked word, refreshing stale heap entries on the way
+
+        Returns
+        ----------
+        (tuple[int, str]): The count and the word
+        """
+
+        while True:
+            count, word = self.heap[0]
+            if self.counts[word] == count:
+                return count, word
+            heapq.heapreplace(self.heap, (self.counts[word], word))
+
+    def add(self, word: str, count: int = 1):
+        """
+        Count a word
+
+        Parameters
+        ----------
+        word (str): The word
+        count (int): How many times it was said
+        """
+
+        if word in self.counts:
+            self.counts[word] += count
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[word] = count
+            self.errors[word] = 0
+            heapq.heappush(self.heap, (count, word))
+            return
+
+        min_count, min_word = self._min_entry()
+        heapq.heapreplace(self.heap, (min_count + count, word))
+        del self.counts[min_word]
+        del self.errors[min_word]
+        self.counts[word] = min_count + count
+        self.errors[word] = min_count
+
+    def update(self, words: "Iterable[str] | Mapping[str, int] | SpaceSaving"):
+        """
+        Count several words. Works like `collections.Counter.update`
+
+        Parameters
+        ----------
+        words (Iterable[str] | Mapping[str, int] | SpaceSaving): Words to count once each,
+            words mapped to counts, or another sketch to merge into this one
+        """
+
+        if isinstance(words, SpaceSaving):
+            self.carried_error += words.max_error()
+            words = dict(words.items())
+
+        if isinstance(words, Mapping):
+            for word, count in words.items():
+                self.add(word, count)
+        else:
+            for word in words:
+                self.add(word)
+
+    def items(self) -> Iterator[tuple[str, int]]:
+        """
+        Get the tracked words with their guaranteed counts, i.e. estimates minus error.
+        Never higher than the true counts, and lower by at most `max_error()`
+
+        Returns
+        ----------
+        (Iterator[tuple[str, int]]): Words and their guaranteed counts. Words with no guaranteed count are left out
+        """
+
+        for word, count in self.counts.items():
+            if guaranteed := count - self.errors[word]:
+                yield word, guaranteed
+
+    def max_error(self) -> int:
+        """
+        Get the most any word's count can be off by
+
+        Returns
+        ----------
+        (int): The error bound
+        """
+
+        if len(self.counts) < self.capacity:
+            return self.carried_error
+
+        return self._min_entry()[0] + self.carried_error
@@ -0,0 +1,169 @@
+import heapq
+from collections import Counter
+from collections.abc import Iterable
+from datetime import datetime
+
+from cogs.utils.space_saving import SpaceSaving
+
+HOURS_TRACKED = 24 * 7
+WINDOW_HOURS = 3
+WORDS_PER_HOUR = 2000
+
+# Words said fewer times than this in the window are never considered trending
+MIN_WINDOW_COUNT = 5
+
+
+class TrendTracker:
+    """
+    Server-wide word counts in a ring buffer of hourly slots. Each slot is a bounded sketch,
+    so memory stays fixed no matter how much is said
+    """
+
+    def __init__(
+        self,
+        stopwords: Iterable[str],
+        min_word_length: int = 3,
+        hours: int = HOURS_TRACKED,
+        window_hours: int = WINDOW_HOURS,
+        words_per_hour: int = WORDS_PER_HOUR,
+    ):
+        """
+        Parameters
+        ----------
+        stopwords (Iterable[str]): Words that are never counted
+        min_word_length (int): Shorter words are never counted. Matches the renderer's limit
+        hours (int): How many hours to keep counts for
+        window_hours (int): How many of the most recent hours to compare against the rest
+        words_per_hour (int): Maximum number of words tracked per hour
+        """
+
+        self.stopwords = set(stopwords)
+        self.min_word_length = min_word_length
+        self.window_hours = window_hours
+        self.words_per_hour = words_per_hour
+        self.slots = [SpaceSaving(words_per_hour) for _ in range(hours)]
+
+        self.current_hour = self.hour_of(datetime.now().astimezone())
+        self.first_hour = self.current_hour  # Trends are skewed until a full baseline has been collected
+
+    @staticmethod
+    def hour_of(when: datetime) -> int:
+        """
+        Get the number of whole hours since the epoch
+
+        Parameters
+        ----------
+        when (datetime): Timezone aware point in time
+
+        Returns
+        ----------
+        (int): The hour number
+        """
+
+        return int(when.timestamp()) // 3600
+
+    def advance(self, hour: int):
+        """
+        Move the ring buffer forward, clearing the slots of hours that fall out of it
+
+        Parameters
+        ----------
+        hour (int): The current hour number
+        """
+
+        if hour <= self.current_hour:
+            return
+
+        for skipped_hour in range(max(self.current_hour + 1, hour - len(self.slots) + 1), hour + 1):
+            self.slots[skipped_hour % len(self.slots)] = SpaceSaving(self.words_per_hour)
+        self.current_hour = hour
+
+    def add(self, tokens: Iterable[str], when: datetime):
+        """
+        Count the tokens of a message. Stopwords and short words are skipped so they don't take up room in the sketches
+
+        Parameters
+        ----------
+        tokens (Iterable[str]): The message's tokens
+        when (datetime): When the message was sent
+        """
+
+        hour = self.hour_of(when)
+        self.advance(hour)
+
+        if hour <= self.current_hour - len(self.slots):
+            return
+
+        self.slots[hour % len(self.slots)].update(
+            token for token in tokens if len(token) >= self.min_word_length and token not in self.stopwords
+        )
+
+    def counts(self, first_age: int, last_age: int) -> Counter:
+        """
+        Sum the counts of a range of hours
+
+        Parameters
+        ----------
+        first_age (int): Hours ago the range starts, inclusive. 0 is the current hour
+        last_age (int): Hours ago the range ends, exclusive
+
+        Returns
+        ----------
+        (Counter): Word counts in the range
+        """
+
+        total = Counter()
+        for age in range(first_age, min(last_age, len(self.slots))):
+            total.update(dict(self.slots[(self.current_hour - age) % len(self.slots)].items()))
+        return total
+
+    def trending(self, now: datetime, limit: int = 10) -> list[tuple[str, int, float]]:
+        """
+        Find the words said much more often in the window than in the baseline
+
+        Parameters
+        ----------
+        now (datetime): The current time
+        limit (int): Maximum number of words to return
+
+        Returns
+        ----------
+        (list[tuple[str, int, float]]): Words, their count in the window and how many times more frequent
+            they are than usual. Most trending first
+        """
+
+        self.advance(self.hour_of(now))
+
+        window = self.counts(0, self.window_hours)
+        baseline = self.counts(self.window_hours, len(self.slots))
+
+        # Only count the hours we've actually been collecting data for
+        baseline_hours = max(1, min(len(self.slots), self.current_hour - self.first_hour + 1) - self.window_hours)
+
+        scores = []
+        for word, count in window.items():
+            if count < MIN_WINDOW_COUNT:
+                continue
+
+            # Add-one smoothing so words never seen before don't get an infinite score
+            expected = (baseline[word] + 1) * self.window_hours / baseline_hours
+            if count > expected:
+                scores.append((word, count, count / expected))
+
+        return heapq.nlargest(limit, scores, key=lambda score: score[2])
+
+    def totals(self, now: datetime) -> Counter:
+        """
+        Sum the counts of every tracked hour
+
+        Parameters
+        ----------
+        now (datetime): The current time
+
+        Returns
+        ----------
+        (Counter): Word counts
+        """
+
+        self.advance(self.hour_of(now))
+        return self.counts(0, len(self.slots))
@@ -0,0 +1,120 @@
+from collections import defaultdict
+from dataclasses import dataclass
+
+
+@dataclass
+class VoiceSession:
+    channel_id: int
+    afk: bool
+    started: float  # Monotonic time the session was opened or last checkpointed
+
+
+class VoiceSessionTracker:
+    """Keeps the open voice sessions per member and the time they've accumulated since the last payout"""
+
+    def __init__(self):
+        self.sessions = {}  # dict[int, VoiceSession]
+        self.accrued = defaultdict(lambda: {False: 0.0, True: 0.0})  # Seconds per member, keyed by whether AFK
+
+    def open(self, member_id: int, channel_id: int, afk: bool, now: float):
+        """
+        Start a session. Closes the member's current session first if they're in one
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+        channel_id (int): The voice channel's ID
+        afk (bool): Whether the channel is the AFK channel
+        now (float): Current monotonic time
+        """
+
+        self.close(member_id, now)
+        self.sessions[member_id] = VoiceSession(channel_id, afk, now)
+
+    def close(self, member_id: int, now: float):
+        """
+        End a member's session, if any, and add its duration to what they've accrued
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+        now (float): Current monotonic time
+        """
+
+        if session := self.sessions.pop(member_id, None):
+            self.accrued[member_id][session.afk] += now - session.started
+
+    def move(self, member_id: int, channel_id: int | None, afk: bool, now: float):
+        """
+        Handle a voice state update. Only joins, leaves and channel moves change sessions
+
+        Parameters
+        ----------
+        member_id (int): The member's Discord ID
+        channel_id (int | None): The channel the member is in now. None if they left voice
+        afk (bool): Whether the channel is the AFK channel
+        now (float): Current monotonic time
+        """
+
+        if channel_id is None:
+            self.close(member_id, now)
+            return
+
+        session = self.sessions.get(member_id)
+        if not session or session.channel_id != channel_id:
+            self.open(member_id, channel_id, afk, now)
+
+    def rebuild(self, present: dict[int, tuple[int, bool]], now: float):
+        """
+        Bring the sessions in line with who is actually in voice, e.g. after a restart or reconnect.
+        Sessions of members that are still in the same channel are kept
+
+        Parameters
+        ----------
+        present (dict[int, tuple[int, bool]]): Channel ID and whether it's the AFK channel, per member in voice
+        now (float): Current monotonic time
+        """
+
+        for member_id in self.sessions.keys() - present.keys():
+            self.close(member_id, now)
+
+        for member_id, (channel_id, afk) in present.items():
+            self.move(member_id, channel_id, afk, now)
+
+    def checkpoint(self, now: float):
+        """
+        Add the duration of all open sessions so far to what they've accrued, without ending them
+
+        Parameters
+        ----------
+        now (float): Current monotonic time
+        """
+
+        for member_id, session in self.sessions.items():
+            self.accrued[member_id][session.afk] += now - session.started
+            session.started = now
+
+    def payout(self, seconds_per_point: dict[bool, float]) -> dict[int, dict[bool, int]]:
+        """
+        Convert accrued time to whole points. Leftover time that isn't worth a full point is kept for the next payout
+
+        Parameters
+        ----------
+        seconds_per_point (dict[bool, float]): Seconds needed per point, keyed by whether AFK
+
+        Returns
+        ----------
+        (dict[int, dict[bool, int]]): Points per member, keyed by whether AFK. Members with no points are left out
+        """
+
+        points = {}
+        for member_id, seconds in self.accrued.items():
+            earned = {}
+            for afk, duration in seconds.items():
+                if whole_points := int(duration // seconds_per_point[afk]):
+                    earned[afk] = whole_points
+                    seconds[afk] = duration - whole_points * seconds_per_point[afk]
+            if earned:
+                points[member_id] = earned
+
+        return points
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+CACHE_DIR = "./src/assets/temp/wordcloud_cache"
+
+
+class RenderCache:
+    """
+    Two-tier LRU cache for rendered word clouds. Images are kept in memory and on disk, each tier bounded by total bytes.
+
+    Entries are keyed by user ID, the user's data version and the render parameters.
+    Bumping a user's data version is enough to invalidate their old images
+    """
+
+    def __init__(self, max_memory_bytes: int = 32 * 1024**2, max_disk_bytes: int = 256 * 1024**2):
+        """
+        Parameters
+        ----------
+        max_memory_bytes (int): Maximum total size of images kept in memory. Defaults to 32 MiB
+        max_disk_bytes (int): Maximum total size of images kept on disk. Defaults to 256 MiB
+        """
+
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()  # OrderedDict[str, bytes]
+        self.memory_bytes = 0
+
+        self.disk = OrderedDict()  # OrderedDict[str, int] of file name to file size
+        self.disk_bytes = 0
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.load_disk_index()
+
+    def load_disk_index(self):
+        """
+        Rebuilds the disk index from the cache directory. Least recently modified files are evicted first
+        """
+
+        files = []
+        for file_name in os.listdir(CACHE_DIR):
+            stat = os.stat(os.path.join(CACHE_DIR, file_name))
+            files.append((stat.st_mtime, file_name, stat.st_size))
+
+        for _, file_name, size in sorted(files):
+            self.disk[file_name] = size
+            self.disk_bytes += size
+
+        self.evict()
+
+    @staticmethod
+    def make_key(user_id: int, data_version: int, **params) -> str:
+        """
+        Creates a cache key. Doubles as the file name on disk
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        data_version (int): The user's current data version
+
+        Returns
+        ----------
+        (str): The cache key
+        """
+
+        params_hash = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:12]
+        return f"{user_id}_{data_version}_{params_hash}.png"
+
+    @staticmethod
+    def read_file(key: str) -> bytes:
+        """
+        Read an image from the cache directory. Blocking
+
+        Parameters
+        ----------
+        key (str): The cache key
+
+        Returns
+        ----------
+        (bytes): The image
+        """
+
+        with open(os.path.join(CACHE_DIR, key), "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def write_file(key: str, image: bytes):
+        """
+        Write an image to the cache directory. Blocking
+
+        Parameters
+        ----------
+        key (str): The cache key
+        image (bytes): The image
+        """
+
+        with open(os.path.join(CACHE_DIR, key), "wb") as f:
+            f.write(image)
+
+    async def get(self, key: str) -> bytes | None:
+        """
+        Fetch an image from the cache. Disk reads run in a thread
+
+        Parameters
+        ----------
+        key (str): The cache key
+
+        Returns
+        ----------
+        (bytes | None): The cached image. None if not cached
+        """
+
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if key not in self.disk:
+            return None
+
+        try:
+            image = await asyncio.to_thread(self.read_file, key)
+        except OSError:
+            if key in self.disk:
+                self.disk_bytes -= self.disk.pop(key)
+            return None
+
+        # The entry may have been evicted while the file was read
+        if key in self.disk:
+            self.disk.move_to_end(key)
+        self.put_memory(key, image)
+        return image
+
+    async def put(self, key: str, image: bytes):
+        """
+        Store an image in the cache. Images for the same user from older data versions are removed.
+        Disk writes run in a thread
+
+        Parameters
+        ----------
+        key (str): The cache key
+        image (bytes): The image to cache
+        """
+
+        user_id, data_version, _ = key.split("_")
+        self.invalidate(int(user_id), before_version=int(data_version))
+
+        self.put_memory(key, image)
+
+        try:
+            await asyncio.to_thread(self.write_file, key, image)
+        except OSError:
+            return
+
+        # Another render of the same word cloud may have finished while the file was written
+        if key in self.disk:
+            return
+
+        self.disk[key] = len(image)
+        self.disk_bytes += len(image)
+        self.evict()
+
+    def put_memory(self, key: str, image: bytes):
+        """
+        Store an image in the memory tier only
+
+        Parameters
+        ----------
+        key (str): The cache key
+        image (bytes): The image to cache
+        """
+
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+
+        self.memory[key] = image
+        self.memory_bytes += len(image)
+        self.evict()
+
+    def invalidate(self, user_id: int, before_version: int | None = None):
+        """
+        Remove cached images for a user
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        before_version (int | None): Only remove images from data versions older than this. Defaults to all images
+        """
+
+        def is_stale(key: str) -> bool:
+            if not key.startswith(f"{user_id}_"):
+                return False
+            return before_version is None or int(key.split("_")[1]) < before_version
+
+        for key in [k for k in self.memory if is_stale(k)]:
+            self.memory_bytes -= len(self.memory.pop(key))
+
+        for key in [k for k in self.disk if is_stale(k)]:
+            self.remove_file(key)
+
+    def evict(self):
+        """
+        Evict least recently used images until both tiers are within their limits
+        """
+
+        while self.memory_bytes > self.max_memory_bytes:
+            _, image = self.memory.popitem(last=False)
+            self.memory_bytes -= len(image)
+
+        while self.disk_bytes > self.max_disk_bytes:
+            self.remove_file(next(iter(self.disk)))
+
+    def remove_file(self, key: str):
+        """
+        Remove an image from the disk tier
+
+        Parameters
+        ----------
+        key (str): The cache key
+        """
+
+        self.disk_bytes -= self.disk.pop(key)
+        try:
+            os.remove(os.path.join(CACHE_DIR, key))
+        except OSError:
+            pass
@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import numpy as np
+from nltk.corpus import stopwords
+from PIL import Image
+from wordcloud import WordCloud
+
+MASK_PATH = "./src/assets/word_cloud_mask.png"
+
+# Worker process state. Populated once per worker by _init_worker so renders don't have to
+# re-read the mask from disk or rebuild the stopword set
+_mask = None
+_stopwords = set()
+
+
+class RenderQueueFull(Exception):
+    """Raised when the render queue is at capacity"""
+
+
+class AlreadyQueued(Exception):
+    """Raised when a user already has a render in the queue"""
+
+
+def _init_worker(mask_path: str):
+    """
+    Loads the mask and stopwords into the worker process
+
+    Parameters
+    ----------
+    mask_path (str): Path to the word cloud mask image
+    """
+
+    global _mask, _stopwords
+
+    _mask = np.array(Image.open(mask_path))
+    _stopwords = set(stopwords.words("norwegian") + stopwords.words("english"))
+
+
+def _noop():
+    """
+    Does nothing. Submitted on startup to get the worker processes forked early
+    """
+
+
+def render_wordcloud(
+    text: str | None = None,
+    frequencies: dict[str, int] | None = None,
+    max_words: int = 4000,
+    allow_bigrams: bool = False,
+) -> bytes:
+    """
+    Generates a wordcloud. Runs inside a worker process
+
+    Parameters
+    ----------
+    text (str | None): Text to generate wordcloud from
+    frequencies (dict[str, int] | None): Word frequencies to generate wordcloud from. Takes precedence over text
+    max_words (int): Maximum number of words to include in the wordcloud. Defaults to 4000
+    allow_bigrams (bool): Whether to allow bigrams in the wordcloud. Only applies to text. Defaults to False
+
+    Returns
+    ----------
+    (bytes): The wordcloud image as PNG
+    """
+
+    wc = WordCloud(
+        max_words=max_words,
+        mask=_mask,
+        repeat=False,
+        stopwords=_stopwords,
+        min_word_length=3,
+        collocations=allow_bigrams,
+    )
+
+    if frequencies is not None:
+        # generate_from_frequencies skips the stopword and length filtering done by process_text
+        frequencies = {word: freq for word, freq in frequencies.items() if len(word) >= 3 and word not in _stopwords}
+        wc.generate_from_frequencies(frequencies)
+    else:
+        wc.generate(text)
+
+    b = BytesIO()
+    wc.to_image().save(b, "png")
+    return b.getvalue()
+
+
+class WordCloudRenderer:
+    """Renders word clouds in a dedicated process pool with a bounded queue"""
+
+    def __init__(self, workers: int = 2, max_queue_size: int = 8):
+        """
+        Parameters
+        ----------
+        workers (int): Number of worker processes. Defaults to 2
+        max_queue_size (int): Maximum number of renders queued or in progress at once. Defaults to 8
+        """
+
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.executor = self.create_executor()
+
+        self.queue = []  # list[int] of user IDs in submission order
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        """
+        Start a new pool of worker processes
+
+        Returns
+        ----------
+        (ProcessPoolExecutor): The pool, with all its workers started
+        """
+
+        # We fork explicitly. run.py has no __main__ guard, so spawned workers would start a second bot.
+        # Forking a process that runs threads is only unsafe if the child touches a lock another thread held at the
+        # time of the fork. Workers only run numpy, PIL and wordcloud code, and never log or use the database or the
+        # event loop. All workers are forked right away while the cog loads, before the gateway connection is up,
+        # and are kept for the lifetime of the pool. The only later fork is when replacing a broken pool
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(MASK_PATH,),
+        )
+
+        # Every submit starts another worker until the pool is full
+        for _ in range(self.workers):
+            executor.submit(_noop)
+
+        return executor
+
+    def replace_broken_executor(self, broken: ProcessPoolExecutor):
+        """
+        Replace the pool after a worker died. Does nothing if it has already been replaced
+
+        Parameters
+        ----------
+        broken (ProcessPoolExecutor): The pool that broke
+        """
+
+        if self.executor is not broken:
+            return
+
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor()
+
+    def shutdown(self):
+        """
+        Shuts down the worker processes without waiting for queued renders
+        """
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def queue_position(self, user_id: int) -> int | None:
+        """
+        Get a user's position in the render queue
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (int | None): 0 if currently rendering, otherwise the number of renders ahead. None if not queued
+        """
+
+        try:
+            index = self.queue.index(user_id)
+        except ValueError:
+            return None
+
+        return max(0, index - self.workers + 1)
+
+    async def render(self, user_id: int, **kwargs) -> bytes:
+        """
+        Render a word cloud in the pool. If a worker dies, the pool is replaced and the render is retried once
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID. Removed from the queue once the render is done
+
+        Returns
+        ----------
+        (bytes): The wordcloud image as PNG
+
+        Raises
+        ----------
+        BrokenProcessPool: If the retry fails too
+        """
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            for attempt in range(2):
+                executor = self.executor
+                try:
+                    return await loop.run_in_executor(executor, functools.partial(render_wordcloud, **kwargs))
+                except BrokenProcessPool:
+                    self.replace_broken_executor(executor)
+                    if attempt:
+                        raise
+        finally:
+            self.queue.remove(user_id)
+
+    def submit(self, user_id: int, **kwargs) -> asyncio.Task:
+        """
+        Queue a word cloud render for a user. Keyword arguments are passed on to render_wordcloud
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (asyncio.Task): Task resolving to the wordcloud image as PNG bytes
+
+        Raises
+        ----------
+        AlreadyQueued: If the user already has a render in the queue
+        RenderQueueFull: If the queue is at capacity
+        """
+
+        if user_id in self.queue:
+            raise AlreadyQueued()
+
+        if len(self.queue) >= self.max_queue_size:
+            raise RenderQueueFull()
+
+        self.queue.append(user_id)
+        return asyncio.create_task(self.render(user_id, **kwargs))
@@ -0,0 +1,214 @@
+import logging
+from typing import Iterable
+
+from psycopg2.extensions import connection as Connection
+from psycopg2.extensions import cursor as Cursor
+
+# Word frequency tables from before words were stored as IDs
+LEGACY_TABLES = ("wordcloud_words", "wordcloud_word_buckets")
+
+# B-tree index entries can be at most about 2.7 kB. Nothing this long is a real word anyway
+MAX_WORD_BYTES = 256
+
+
+def is_storable(word: str) -> bool:
+    """
+    Check if a word can be stored in the vocabulary. PostgreSQL text can't hold NUL characters,
+    and overly long words don't fit in the unique index
+
+    Parameters
+    ----------
+    word (str): The word
+
+    Returns
+    ----------
+    (bool): Whether the word can be stored
+    """
+
+    return "\x00" not in word and len(word.encode()) <= MAX_WORD_BYTES
+
+
+class Vocabulary:
+    """In-process cache of the global word to word ID mapping"""
+
+    def __init__(self):
+        self.word_ids = {}  # dict[str, int]
+
+    def load(self, cursor: Cursor):
+        """
+        Load the whole vocabulary from the database
+
+        Parameters
+        ----------
+        cursor (Cursor): Database cursor
+        """
+
+        cursor.execute("SELECT word, word_id FROM wordcloud_vocabulary")
+        self.word_ids = dict(cursor.fetchall())
+
+    def resolve(self, connection: Connection, words: Iterable[str]) -> dict[str, int]:
+        """
+        Make sure every word has an ID. Unknown words are added to the vocabulary in their own transaction,
+        so the cache never holds IDs that were rolled back
+
+        Parameters
+        ----------
+        connection (Connection): Database connection. Must not be in autocommit mode
+        words (Iterable[str]): The words to resolve
+
+        Returns
+        ----------
+        (dict[str, int]): The word to word ID mapping. Contains at least the given words
+        """
+
+        unknown = [word for word in words if word not in self.word_ids]
+        if not unknown:
+            return self.word_ids
+
+        with connection, connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO wordcloud_vocabulary (word)
+                SELECT unnest(%s::TEXT[])
+                ON CONFLICT (word) DO NOTHING
+                """,
+                (unknown,),
+            )
+            cursor.execute("SELECT word, word_id FROM wordcloud_vocabulary WHERE word = ANY(%s)", (unknown,))
+            self.word_ids.update(cursor.fetchall())
+
+        return self.word_ids
+
+
+def log_table_sizes(cursor: Cursor, logger: logging.Logger, tables: Iterable[str]):
+    """
+    Log the size of tables and their indexes
+
+    Parameters
+    ----------
+    cursor (Cursor): Database cursor
+    logger (logging.Logger): Logger to log to
+    tables (Iterable[str]): Names of the tables to measure
+    """
+
+    for table in tables:
+        cursor.execute(
+            """
+            SELECT pg_size_pretty(pg_table_size(oid)), pg_size_pretty(pg_indexes_size(oid))
+            FROM pg_class
+            WHERE relname = %s
+            """,
+            (table,),
+        )
+        if sizes := cursor.fetchone():
+            logger.info(f"{table}: table {sizes[0]}, indexes {sizes[1]}")
+
+
+def find_legacy_tables(cursor: Cursor) -> list[str]:
+    """
+    Find the old word frequency tables that store words as text and haven't been migrated yet
+
+    Parameters
+    ----------
+    cursor (Cursor): Database cursor
+
+    Returns
+    ----------
+    (list[str]): Names of the legacy tables that still exist
+    """
+
+    cursor.execute("SELECT relname FROM pg_class WHERE relname = ANY(%s) AND relkind = 'r'", (list(LEGACY_TABLES),))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def migrate_legacy_rows(connection: Connection, logger: logging.Logger, legacy_tables: list[str]):
+    """
+    Moves word frequencies from the legacy text keyed tables to the word ID keyed tables.
+    Works one user at a time in short transactions, so the tables stay usable while it runs.
+    Like regular flushes, rows are joined against wordcloud_metadata so users who have withdrawn their consent
+    are never written. Their legacy rows are still deleted
+    Blocking, so it should be run in a separate thread
+
+    Parameters
+    ----------
+    connection (Connection): Database connection only used for the migration. Must not be in autocommit mode
+    logger (logging.Logger): Logger to report progress to
+    legacy_tables (list[str]): The legacy tables to migrate
+    """
+
+    with connection, connection.cursor() as cursor:
+        log_table_sizes(cursor, logger, legacy_tables)
+        # Table names come from LEGACY_TABLES, never from user input
+        cursor.execute(" UNION ".join(f"SELECT DISTINCT discord_user_id FROM {table}" for table in legacy_tables))
+        user_ids = [row[0] for row in cursor.fetchall()]
+
+    logger.info(f"Migrating word frequencies for {len(user_ids)} users to word IDs")
+
+    for user_id in user_ids:
+        with connection, connection.cursor() as cursor:
+            for table in legacy_tables:
+                cursor.execute(
+                    f"""
+                    INSERT INTO wordcloud_vocabulary (word)
+                    SELECT DISTINCT word FROM {table} WHERE discord_user_id = %s
+                    ON CONFLICT (word) DO NOTHING
+                    """,
+                    (user_id,),
+                )
+
+            if "wordcloud_words" in legacy_tables:
+                cursor.execute(
+                    """
+                    WITH moved AS (
+                        DELETE FROM wordcloud_words
+                        WHERE discord_user_id = %s
+                        RETURNING word, frequency
+                    )
+                    INSERT INTO wordcloud_frequencies (discord_user_id, word_id, frequency)
+                    SELECT %s, vocabulary.word_id, moved.frequency
+                    FROM moved
+                    JOIN wordcloud_vocabulary vocabulary USING (word)
+                    JOIN wordcloud_metadata metadata ON metadata.discord_user_id = %s
+                    ON CONFLICT (discord_user_id, word_id)
+                    DO UPDATE SET frequency = wordcloud_frequencies.frequency + EXCLUDED.frequency
+                    """,
+                    (user_id, user_id, user_id),
+                )
+
+            if "wordcloud_word_buckets" in legacy_tables:
+                cursor.execute(
+                    """
+                    WITH moved AS (
+                        DELETE FROM wordcloud_word_buckets
+                        WHERE discord_user_id = %s
+                        RETURNING bucket_start, bucket_size, word, frequency
+                    )
+                    INSERT INTO wordcloud_frequency_buckets
+                        (discord_user_id, bucket_start, bucket_size, word_id, frequency)
+                    SELECT %s, moved.bucket_start, moved.bucket_size, vocabulary.word_id, moved.frequency
+                    FROM moved
+                    JOIN wordcloud_vocabulary vocabulary USING (word)
+                    JOIN wordcloud_metadata metadata ON metadata.discord_user_id = %s
+                    ON CONFLICT (discord_user_id, bucket_start, bucket_size, word_id)
+                    DO UPDATE SET frequency = wordcloud_frequency_buckets.frequency + EXCLUDED.frequency
+                    """,
+                    (user_id, user_id, user_id),
+                )
+
+
+def drop_legacy_tables(connection: Connection, logger: logging.Logger, legacy_tables: list[str]):
+    """
+    Drops the legacy tables once they've been emptied and logs the size of their replacements
+
+    Parameters
+    ----------
+    connection (Connection): Database connection only used for the migration. Must not be in autocommit mode
+    logger (logging.Logger): Logger to report to
+    legacy_tables (list[str]): The legacy tables to drop
+    """
+
+    with connection, connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {', '.join(legacy_tables)}")
+        log_table_sizes(
+            cursor, logger, ("wordcloud_frequencies", "wordcloud_frequency_buckets", "wordcloud_vocabulary")
+        )
@@ -1,24 +1,69 @@
-import functools
-import itertools
-import json
+import asyncio
 import re
+import time
+from collections import Counter
 from collections import defaultdict
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from io import SEEK_END
 from io import BytesIO
-from io import StringIO
+from typing import Literal
 
 import discord
 import nltk
-import numpy as np
 import psycopg2
 from discord import app_commands
 from discord.ext import commands
 from discord.ext import tasks
 from nltk.corpus import stopwords
-from PIL import Image
-from psycopg2.extras import execute_batch
-from wordcloud import WordCloud as WCloud  # Avoid naming conflicts with cog class name
+from psycopg2.extras import execute_values
 
+from cogs.utils import collocations
+from cogs.utils import data_export
+from cogs.utils import db_utils
 from cogs.utils import embed_templates
+from cogs.utils import misc_utils
+from cogs.utils import wordcloud_vocabulary
+from cogs.utils.history_scanner import HistoryScanner
+from cogs.utils.history_scanner import ScanProgress
+from cogs.utils.message_archive import MessageArchive
+from cogs.utils.space_saving import SpaceSaving
+from cogs.utils.trend_tracker import TrendTracker
+from cogs.utils.wordcloud_cache import RenderCache
+from cogs.utils.wordcloud_renderer import AlreadyQueued
+from cogs.utils.wordcloud_renderer import RenderQueueFull
+from cogs.utils.wordcloud_renderer import WordCloudRenderer
+
+# How long buckets are kept at each granularity before being rolled up or deleted
+DAILY_BUCKET_RETENTION_DAYS = 35
+WEEKLY_BUCKET_RETENTION_WEEKS = 52
+MONTHLY_BUCKET_RETENTION_YEARS = 5
+
+# How many tokens /ordsky generer siste reads per requested word before it stops scanning
+SCAN_TOKENS_PER_WORD = 25
+
+# How often the queue position shown while waiting for a render is refreshed
+QUEUE_POSITION_INTERVAL_SECONDS = 3
+
+# Used for exports outside of servers. Servers have their own limit depending on boosts
+DEFAULT_UPLOAD_LIMIT_BYTES = 25 * 1024 * 1024
+
+BIGRAM_EXPORT_QUERY = """
+    SELECT first.word, second.word, bigrams.frequency
+    FROM wordcloud_bigram_frequencies bigrams
+    JOIN wordcloud_vocabulary first ON first.word_id = bigrams.word_id
+    JOIN wordcloud_vocabulary second ON second.word_id = bigrams.next_word_id
+    WHERE bigrams.discord_user_id = %(user_id)s
+    ORDER BY bigrams.frequency DESC
+"""
+
+# A failed flush is retried on the next tick. After this many failures in a row the cached words are dropped
+MAX_FLUSH_ATTEMPTS = 3
+
+# Words tracked per user in heavy hitters mode. Matches the number of words drawn in a word cloud
+DEFAULT_MAX_WORDS_PER_USER = 4000
 
 
 class WordCloud(commands.Cog):
@@ -35,18 +80,60 @@ class WordCloud(commands.Cog):
         self.cursor = self.bot.db_connection.cursor()
         self.init_db()
 
-        # Default dict where all users are empty defaultdicts
-        # The user's defaultdict has a default value of 0
-        self.word_freq_cache = defaultdict(lambda: defaultdict(int))
+        # Legacy tables are migrated in the background on load. Reads include them until then
+        self.legacy_tables = wordcloud_vocabulary.find_legacy_tables(self.cursor)
+
+        self.vocabulary = wordcloud_vocabulary.Vocabulary()
+        self.vocabulary.load(self.cursor)
+
+        # In heavy hitters mode only each user's most frequent words are counted and stored.
+        # Bounds memory and storage, but counts become estimates with a known error bound
+        wordcloud_config = self.bot.wordcloud
+        self.heavy_hitters = wordcloud_config.get("heavy_hitters", False)
+        self.max_words_per_user = wordcloud_config.get("max_words_per_user", DEFAULT_MAX_WORDS_PER_USER)
+
+        # Default dict where all users get an empty word counter
+        self.word_freq_cache = defaultdict(self.new_word_counter)
+        # Same, but for pairs of adjacent words. Used to find phrases
+        self.bigram_freq_cache = defaultdict(self.new_word_counter)
+
+        # Flushes run in a separate thread, so they get their own connection to be able to use transactions
+        self.flush_connection = self.bot.connect_database()
+        self.flush_lock = asyncio.Lock()
 
         # We cache the consenting users to avoid querying the database every 16:36
         # It's frail but it works unless you have a skill issue
         self.consenting_users = []
+
+        # Incremented for a user every time their words are flushed to the database
+        # Used to tell whether a cached word cloud is still up to date
+        self.data_versions = {}  # dict[int, int]
+
+        # Cutoffs of the last finished rollup. Part of period cache keys, since a rollup changes what a period returns
+        self.rollup_cutoffs_applied = self.rollup_cutoffs(datetime.now(misc_utils.TIMEZONE).date())
+
+        # Consecutive failed flushes. Words are dropped instead of retried once it reaches MAX_FLUSH_ATTEMPTS
+        self.failed_flushes = 0
         self.populate_consenting_users()
 
+        self.render_cache = RenderCache()
+
+        # Local copy of consenting users' recent messages so we don't have to read history through the API
+        self.archive = MessageArchive(self.bot.connect_database())
+
         nltk.download("stopwords")
+        word_cloud_stopwords = set(stopwords.words("norwegian") + stopwords.words("english"))
+
+        # Server-wide word counts of the last week. Kept in memory only, so trends start over on restart
+        self.trends = TrendTracker(word_cloud_stopwords)
+
+        self.bigram_extractor = collocations.BigramExtractor(word_cloud_stopwords)
+
+        # Must be created after the stopwords are downloaded since the workers load them on startup
+        self.renderer = WordCloudRenderer()
 
         self.insert_cache_loop.start()
+        self.rollup_loop.start()
 
         self.MSG_NO_DATA = "Fant ingen data om deg"  # SonarCloud recommended this LMAO. Makes sense but also not
 
@@ -66,14 +153,207 @@ class WordCloud(commands.Cog):
         )
         self.cursor.execute(
             """
-            CREATE TABLE IF NOT EXISTS wordcloud_words (
+            ALTER TABLE wordcloud_metadata
+            ADD COLUMN IF NOT EXISTS data_version INTEGER NOT NULL DEFAULT 0
+            """
+        )
+        # How much a user's stored frequencies may be too low by. Only grows in heavy hitters mode
+        self.cursor.execute(
+            """
+            ALTER TABLE wordcloud_metadata
+            ADD COLUMN IF NOT EXISTS frequency_error INTEGER NOT NULL DEFAULT 0
+            """
+        )
+        # Words are stored once here and referred to by ID everywhere else
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wordcloud_vocabulary (
+                word_id SERIAL PRIMARY KEY,
+                word TEXT NOT NULL UNIQUE
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wordcloud_frequencies (
                 discord_user_id BIGINT NOT NULL,
-                word TEXT NOT NULL,
+                word_id INTEGER NOT NULL REFERENCES wordcloud_vocabulary (word_id),
                 frequency INTEGER NOT NULL,
-                PRIMARY KEY (discord_user_id, word)
+                PRIMARY KEY (discord_user_id, word_id)
+            )
+            """
+        )
+        # Same as wordcloud_frequencies, but split into time buckets.
+        # Daily buckets are rolled up into weekly and then monthly buckets as they age
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wordcloud_frequency_buckets (
+                discord_user_id BIGINT NOT NULL,
+                bucket_start DATE NOT NULL,
+                bucket_size TEXT NOT NULL CHECK (bucket_size IN ('day', 'week', 'month')),
+                word_id INTEGER NOT NULL REFERENCES wordcloud_vocabulary (word_id),
+                frequency INTEGER NOT NULL,
+                PRIMARY KEY (discord_user_id, bucket_start, bucket_size, word_id)
+            )
+            """
+        )
+        # Adjacent word pairs, counted at ingestion so phrases can be found without re-reading any text
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS wordcloud_bigram_frequencies (
+                discord_user_id BIGINT NOT NULL,
+                word_id INTEGER NOT NULL REFERENCES wordcloud_vocabulary (word_id),
+                next_word_id INTEGER NOT NULL REFERENCES wordcloud_vocabulary (word_id),
+                frequency INTEGER NOT NULL,
+                PRIMARY KEY (discord_user_id, word_id, next_word_id)
+            )
+            """
+        )
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS wordcloud_frequency_buckets_rollup_idx
+            ON wordcloud_frequency_buckets (bucket_size, bucket_start)
+            """
+        )
+
+    async def cog_load(self):
+        if self.legacy_tables:
+            asyncio.create_task(self.migrate_legacy_tables())
+
+    async def migrate_legacy_tables(self):
+        """
+        Moves word frequencies from the legacy tables, which store every word as text, to the word ID tables.
+        Runs in the background on its own connection
+        """
+
+        self.bot.logger.info(f"Migrating legacy word cloud tables: {self.legacy_tables}")
+
+        connection = self.bot.connect_database()
+        try:
+            await asyncio.to_thread(
+                wordcloud_vocabulary.migrate_legacy_rows, connection, self.bot.logger, self.legacy_tables
             )
+
+            # Stop reading from the legacy tables before they're dropped
+            legacy_tables, self.legacy_tables = self.legacy_tables, []
+            await asyncio.to_thread(wordcloud_vocabulary.drop_legacy_tables, connection, self.bot.logger, legacy_tables)
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to migrate legacy word cloud tables - {err}")
+        else:
+            self.bot.logger.info("Finished migrating legacy word cloud tables")
+        finally:
+            connection.close()
+
+    def word_freqs_query(self, bucketed: bool = False) -> str:
+        """
+        Build the query for a user's word frequencies, most frequent first.
+        Takes the named parameters user_id, and start and end if bucketed
+
+        Parameters
+        ----------
+        bucketed (bool): Whether to only count words from time buckets overlapping the range from start to end.
+            Rolled up buckets are counted whole, so the range is widened to whole weeks or months where needed
+
+        Returns
+        ----------
+        (str): The query
+        """
+
+        if bucketed:
+            sources = [
+                """
+                SELECT vocabulary.word, buckets.frequency
+                FROM wordcloud_frequency_buckets buckets
+                JOIN wordcloud_vocabulary vocabulary USING (word_id)
+                WHERE buckets.discord_user_id = %(user_id)s
+                    AND buckets.bucket_start <= %(end)s
+                    AND buckets.bucket_start + ('1 ' || buckets.bucket_size)::interval > %(start)s
+                """
+            ]
+            if "wordcloud_word_buckets" in self.legacy_tables:
+                sources.append(
+                    """
+                    SELECT word, frequency
+                    FROM wordcloud_word_buckets
+                    WHERE discord_user_id = %(user_id)s
+                        AND bucket_start <= %(end)s
+                        AND bucket_start + ('1 ' || bucket_size)::interval > %(start)s
+                    """
+                )
+        else:
+            sources = [
+                """
+                SELECT vocabulary.word, frequencies.frequency
+                FROM wordcloud_frequencies frequencies
+                JOIN wordcloud_vocabulary vocabulary USING (word_id)
+                WHERE frequencies.discord_user_id = %(user_id)s
+                """
+            ]
+            if "wordcloud_words" in self.legacy_tables:
+                sources.append(
+                    """
+                    SELECT word, frequency
+                    FROM wordcloud_words
+                    WHERE discord_user_id = %(user_id)s
+                    """
+                )
+
+        return f"""
+            SELECT word, SUM(frequency) AS frequency
+            FROM ({" UNION ALL ".join(sources)}) words
+            GROUP BY word
+            ORDER BY frequency DESC
             """
+
+    def fetch_word_freqs(
+        self, user_id: int, start: date | None = None, end: date | None = None
+    ) -> list[tuple[str, int]]:
+        """
+        Fetch a user's word frequencies, most frequent first
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        start (date | None): Only count words from time buckets starting on or after this date
+        end (date | None): Only count words from time buckets starting on or before this date
+
+        Returns
+        ----------
+        (list[tuple[str, int]]): Words and their frequencies
+        """
+
+        self.cursor.execute(
+            self.word_freqs_query(bucketed=bool(start and end)), {"user_id": user_id, "start": start, "end": end}
         )
+        return self.cursor.fetchall()
+
+    def fetch_phrase_freqs(self, user_id: int, word_freqs: dict[str, int]) -> dict[str, int]:
+        """
+        Add a user's collocations as phrases to their word frequencies
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+        word_freqs (dict[str, int]): The user's word frequencies
+
+        Returns
+        ----------
+        (dict[str, int]): Word and phrase frequencies
+        """
+
+        self.cursor.execute(
+            """
+            SELECT first.word, second.word, bigrams.frequency
+            FROM wordcloud_bigram_frequencies bigrams
+            JOIN wordcloud_vocabulary first ON first.word_id = bigrams.word_id
+            JOIN wordcloud_vocabulary second ON second.word_id = bigrams.next_word_id
+            WHERE bigrams.discord_user_id = %s AND bigrams.frequency >= %s
+            """,
+            (user_id, collocations.MIN_BIGRAM_COUNT),
+        )
+        bigram_freqs = {(first, second): freq for first, second, freq in self.cursor.fetchall()}
+
+        return collocations.merge_collocations(word_freqs, collocations.find_collocations(word_freqs, bigram_freqs))
 
     async def cog_unload(self):
         """
@@ -82,55 +362,329 @@ class WordCloud(commands.Cog):
 
         self.bot.logger.info("Unloading cog")
         self.insert_cache_loop.cancel()
+        self.rollup_loop.cancel()
+        self.renderer.shutdown()
+
+        # Flush here rather than relying on the loop's after_loop, which would run after the connections are closed
+        await self.insert_cache()
+        try:
+            await self.archive.flush()
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to write message archive to database - {err}")
+
         self.cursor.close()
+        self.flush_connection.close()
+        self.archive.connection.close()
 
     def populate_consenting_users(self):
         """
-        Populates the cached list of consenting users
+        Populates the cached list of consenting users and their data versions
         """
 
         self.cursor.execute(
             """
-            SELECT discord_user_id
+            SELECT discord_user_id, data_version
             FROM wordcloud_metadata
             """
         )
-        self.consenting_users = [row[0] for row in self.cursor.fetchall()]
+        self.data_versions = dict(self.cursor.fetchall())
+        self.consenting_users = list(self.data_versions)
 
-    async def insert_cache(self):
+    async def insert_cache(self, bucket_date: date | None = None):
         """
         Inserts cached word frequencies into the database.
         We do this in order to prevent excess database writes
+
+        Parameters
+        ----------
+        bucket_date (date | None): The day the cached words were said. Defaults to today
         """
 
-        if not self.word_freq_cache:
-            return
+        async with self.flush_lock:
+            if not self.word_freq_cache:
+                return
 
-        # Flatten the defaultdict into a list of tuples
-        # This is a bit of a hack but it works
-        word_freqs = list(
-            itertools.chain.from_iterable(
-                [(user_id, word, freq) for word, freq in user_word_freqs.items()]
-                for user_id, user_word_freqs in self.word_freq_cache.items()
-            )
+            if not bucket_date:
+                bucket_date = datetime.now(misc_utils.TIMEZONE).date()
+
+            # Swap in a fresh cache so messages arriving during the write aren't lost or written twice
+            snapshot = self.word_freq_cache
+            self.word_freq_cache = defaultdict(self.new_word_counter)
+            bigram_snapshot = self.bigram_freq_cache
+            self.bigram_freq_cache = defaultdict(self.new_word_counter)
+
+            flush_start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.write_word_freqs, snapshot, bigram_snapshot, bucket_date)
+            except (psycopg2.Error, ValueError) as err:
+                self.bot.logger.error(f"Failed to insert wordcloud cache into database - {err}")
+
+                # Words that keep failing would be merged back and fail every later flush too
+                self.failed_flushes += 1
+                if self.failed_flushes >= MAX_FLUSH_ATTEMPTS:
+                    self.bot.logger.error(
+                        f"Dropping cached words of {len(snapshot)} users after {self.failed_flushes} failed flushes"
+                    )
+                    self.failed_flushes = 0
+                    return
+
+                # Nothing was committed. Put the words back so the next flush can retry
+                for cache, cache_snapshot in (
+                    (self.word_freq_cache, snapshot),
+                    (self.bigram_freq_cache, bigram_snapshot),
+                ):
+                    for user_id, user_freqs in cache_snapshot.items():
+                        if user_id not in self.consenting_users:
+                            continue
+                        cache[user_id].update(user_freqs)
+                return
+
+            self.failed_flushes = 0
+            for user_id in snapshot:
+                if user_id in self.consenting_users:
+                    self.data_versions[user_id] = self.data_versions.get(user_id, 0) + 1
+
+            row_count = sum(len(user_word_freqs) for user_word_freqs in snapshot.values())
+            self.bot.logger.info(f"Flushed {row_count} word frequencies in {time.perf_counter() - flush_start:.2f}s")
+
+    def new_word_counter(self) -> Counter | SpaceSaving:
+        """
+        Create an empty word counter for a user
+
+        Returns
+        ----------
+        (Counter | SpaceSaving): An exact counter, or a bounded one in heavy hitters mode
+        """
+
+        if self.heavy_hitters:
+            return SpaceSaving(self.max_words_per_user)
+        return Counter()
+
+    def write_word_freqs(
+        self,
+        word_freqs: dict[int, Counter | SpaceSaving],
+        bigram_freqs: dict[int, Counter | SpaceSaving],
+        bucket_date: date,
+    ):
+        """
+        Writes word frequencies to the database in a single transaction.
+        Rows are streamed into a staging table with COPY and merged with one set-based upsert per table.
+        Blocking, so it should be run in a separate thread
+
+        Parameters
+        ----------
+        word_freqs (dict[int, Counter | SpaceSaving]): Word frequencies per user
+        bigram_freqs (dict[int, Counter | SpaceSaving]): Bigram frequencies per user
+        bucket_date (date): The day the words were said
+        """
+
+        # Every word in a bigram is also in the word frequencies, unless it was evicted in heavy hitters mode
+        words = {word for user_word_freqs in word_freqs.values() for word in user_word_freqs}
+        words.update(
+            word for user_bigram_freqs in bigram_freqs.values() for bigram in user_bigram_freqs for word in bigram
+        )
+        # Words the database can't hold would fail the whole flush, so they're skipped
+        words = {word for word in words if wordcloud_vocabulary.is_storable(word)}
+        word_ids = self.vocabulary.resolve(self.flush_connection, words)
+        rows = (
+            (user_id, word_ids[word], freq)
+            for user_id, user_word_freqs in word_freqs.items()
+            for word, freq in user_word_freqs.items()
+            if word in words
+        )
+        bigram_rows = (
+            (user_id, word_ids[first], word_ids[second], freq)
+            for user_id, user_bigram_freqs in bigram_freqs.items()
+            for (first, second), freq in user_bigram_freqs.items()
+            if first in words and second in words
         )
 
-        # Insert cache into database
-        try:
-            execute_batch(
-                self.cursor,
+        # The connection context manager commits on success and rolls back on exceptions.
+        # Rows are joined against wordcloud_metadata so users who have withdrawn their consent are never written
+        with self.flush_connection, self.flush_connection.cursor() as cursor:
+            cursor.execute(
                 """
-                INSERT INTO wordcloud_words (discord_user_id, word, frequency)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (discord_user_id, word)
-                DO UPDATE SET frequency = wordcloud_words.frequency + EXCLUDED.frequency
+                CREATE TEMP TABLE IF NOT EXISTS wordcloud_staging (
+                    discord_user_id BIGINT NOT NULL,
+                    word_id INTEGER NOT NULL,
+                    frequency INTEGER NOT NULL
+                ) ON COMMIT DELETE ROWS
+                """
+            )
+            db_utils.copy_rows(cursor, "wordcloud_staging", ("discord_user_id", "word_id", "frequency"), rows)
+            cursor.execute(
+                """
+                INSERT INTO wordcloud_frequencies (discord_user_id, word_id, frequency)
+                SELECT discord_user_id, word_id, frequency
+                FROM wordcloud_staging
+                JOIN wordcloud_metadata USING (discord_user_id)
+                ON CONFLICT (discord_user_id, word_id)
+                DO UPDATE SET frequency = wordcloud_frequencies.frequency + EXCLUDED.frequency
+                """
+            )
+            cursor.execute(
+                """
+                INSERT INTO wordcloud_frequency_buckets (discord_user_id, bucket_start, bucket_size, word_id, frequency)
+                SELECT discord_user_id, %s, 'day', word_id, frequency
+                FROM wordcloud_staging
+                JOIN wordcloud_metadata USING (discord_user_id)
+                ON CONFLICT (discord_user_id, bucket_start, bucket_size, word_id)
+                DO UPDATE SET frequency = wordcloud_frequency_buckets.frequency + EXCLUDED.frequency
                 """,
-                word_freqs,
+                (bucket_date,),
             )
-        except psycopg2.Error as err:
-            self.bot.logger.error(f"Failed to insert wordcloud cache into database - {err}")
+            cursor.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS wordcloud_bigram_staging (
+                    discord_user_id BIGINT NOT NULL,
+                    word_id INTEGER NOT NULL,
+                    next_word_id INTEGER NOT NULL,
+                    frequency INTEGER NOT NULL
+                ) ON COMMIT DELETE ROWS
+                """
+            )
+            db_utils.copy_rows(
+                cursor,
+                "wordcloud_bigram_staging",
+                ("discord_user_id", "word_id", "next_word_id", "frequency"),
+                bigram_rows,
+            )
+            cursor.execute(
+                """
+                INSERT INTO wordcloud_bigram_frequencies (discord_user_id, word_id, next_word_id, frequency)
+                SELECT discord_user_id, word_id, next_word_id, frequency
+                FROM wordcloud_bigram_staging
+                JOIN wordcloud_metadata USING (discord_user_id)
+                ON CONFLICT (discord_user_id, word_id, next_word_id)
+                DO UPDATE SET frequency = wordcloud_bigram_frequencies.frequency + EXCLUDED.frequency
+                """
+            )
+            cursor.execute(
+                """
+                UPDATE wordcloud_metadata
+                SET data_version = data_version + 1
+                WHERE discord_user_id = ANY(%s)
+                """,
+                (list(word_freqs),),
+            )
+
+            if self.heavy_hitters:
+                self.prune_word_freqs(cursor, word_freqs)
+                self.prune_bigram_freqs(cursor, list(bigram_freqs))
+
+    def prune_word_freqs(self, cursor: psycopg2.extensions.cursor, word_freqs: dict[int, SpaceSaving]):
+        """
+        Deletes everything but each user's most frequent words and adds the error this introduces,
+        along with the error of the flushed estimates, to the users' error bounds
+
+        Parameters
+        ----------
+        cursor (psycopg2.extensions.cursor): Cursor of the flush transaction
+        word_freqs (dict[int, SpaceSaving]): The flushed word frequencies per user
+        """
+
+        cursor.execute(
+            """
+            WITH ranked AS (
+                SELECT
+                    discord_user_id,
+                    word_id,
+                    ROW_NUMBER() OVER (PARTITION BY discord_user_id ORDER BY frequency DESC, word_id) AS rank
+                FROM wordcloud_frequencies
+                WHERE discord_user_id = ANY(%s)
+            ),
+            pruned AS (
+                DELETE FROM wordcloud_frequencies frequencies
+                USING ranked
+                WHERE frequencies.discord_user_id = ranked.discord_user_id
+                    AND frequencies.word_id = ranked.word_id
+                    AND ranked.rank > %s
+                RETURNING frequencies.discord_user_id, frequencies.frequency
+            )
+            SELECT discord_user_id, MAX(frequency)
+            FROM pruned
+            GROUP BY discord_user_id
+            """,
+            (list(word_freqs), self.max_words_per_user),
+        )
+        pruned_errors = dict(cursor.fetchall())
+
+        # A pruned word may come back later, missing at most what it had when it was pruned
+        errors = [
+            (user_id, user_word_freqs.max_error() + pruned_errors.get(user_id, 0))
+            for user_id, user_word_freqs in word_freqs.items()
+        ]
+        execute_values(
+            cursor,
+            """
+            UPDATE wordcloud_metadata
+            SET frequency_error = frequency_error + errors.error
+            FROM (VALUES %s) AS errors (discord_user_id, error)
+            WHERE wordcloud_metadata.discord_user_id = errors.discord_user_id AND errors.error > 0
+            """,
+            errors,
+        )
+
+    def prune_bigram_freqs(self, cursor: psycopg2.extensions.cursor, user_ids: list[int]):
+        """
+        Deletes everything but each user's most frequent bigrams.
+        Bigrams only decide which phrases are shown, so no error is tracked for them
+
+        Parameters
+        ----------
+        cursor (psycopg2.extensions.cursor): Cursor of the flush transaction
+        user_ids (list[int]): The users whose bigrams were flushed
+        """
 
-        self.word_freq_cache.clear()
+        cursor.execute(
+            """
+            WITH ranked AS (
+                SELECT
+                    discord_user_id,
+                    word_id,
+                    next_word_id,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY discord_user_id ORDER BY frequency DESC, word_id, next_word_id
+                    ) AS rank
+                FROM wordcloud_bigram_frequencies
+                WHERE discord_user_id = ANY(%s)
+            )
+            DELETE FROM wordcloud_bigram_frequencies bigrams
+            USING ranked
+            WHERE bigrams.discord_user_id = ranked.discord_user_id
+                AND bigrams.word_id = ranked.word_id
+                AND bigrams.next_word_id = ranked.next_word_id
+                AND ranked.rank > %s
+            """,
+            (user_ids, self.max_words_per_user),
+        )
+
+    def frequency_error_note(self, user_id: int) -> str:
+        """
+        Get a note about how inaccurate a user's word counts may be
+
+        Parameters
+        ----------
+        user_id (int): The user's Discord ID
+
+        Returns
+        ----------
+        (str): The note. Empty if the counts are exact
+        """
+
+        self.cursor.execute(
+            """
+            SELECT frequency_error
+            FROM wordcloud_metadata
+            WHERE discord_user_id = %s
+            """,
+            (user_id,),
+        )
+        result = self.cursor.fetchone()
+
+        if not result or not result[0]:
+            return ""
+        return f"\n\nAntallet for hvert ord er estimert og kan være opptil {result[0]} for lavt"
 
     @tasks.loop(minutes=20)
     async def insert_cache_loop(self):
@@ -141,10 +695,123 @@ class WordCloud(commands.Cog):
         self.bot.logger.info("Dumping word cloud cache to database...")
         await self.insert_cache()
 
+        try:
+            await self.archive.flush()
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to write message archive to database - {err}")
+
     @insert_cache_loop.after_loop
     async def on_insert_cache_loop_cancel(self):
-        if self.insert_cache_loop.is_being_cancelled() and self.word_freq_cache:
-            await self.insert_cache()
+        if self.insert_cache_loop.is_being_cancelled():
+            if self.word_freq_cache:
+                await self.insert_cache()
+            try:
+                await self.archive.flush()
+            except psycopg2.Error as err:
+                self.bot.logger.error(f"Failed to write message archive to database - {err}")
+
+    @staticmethod
+    def rollup_cutoffs(today: date) -> tuple[date, date]:
+        """
+        Get the dates before which daily buckets are rolled up into weeks, and weekly buckets into months
+
+        Parameters
+        ----------
+        today (date): Today's date
+
+        Returns
+        ----------
+        (tuple[date, date]): The week cutoff and the month cutoff
+        """
+
+        # Align the cutoffs to bucket boundaries so we never roll up half a week or month
+        week_cutoff = today - timedelta(days=DAILY_BUCKET_RETENTION_DAYS)
+        week_cutoff -= timedelta(days=week_cutoff.weekday())
+        month_cutoff = (today - timedelta(weeks=WEEKLY_BUCKET_RETENTION_WEEKS)).replace(day=1)
+        return week_cutoff, month_cutoff
+
+    def rollup_buckets(self, today: date):
+        """
+        Rolls daily buckets up into weekly buckets, weekly buckets up into monthly buckets
+        and deletes monthly buckets past retention. Runs in a single transaction on its own connection.
+        Blocking, so it should be run in a separate thread
+
+        Parameters
+        ----------
+        today (date): Today's date
+        """
+
+        week_cutoff, month_cutoff = self.rollup_cutoffs(today)
+        retention_cutoff = today.replace(year=today.year - MONTHLY_BUCKET_RETENTION_YEARS, day=1)
+
+        connection = self.bot.connect_database()
+        try:
+            with connection, connection.cursor() as cursor:
+                self.roll_up(cursor, week_cutoff, month_cutoff, retention_cutoff)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def roll_up(cursor: psycopg2.extensions.cursor, week_cutoff: date, month_cutoff: date, retention_cutoff: date):
+        """
+        Runs the rollup queries
+
+        Parameters
+        ----------
+        cursor (psycopg2.extensions.cursor): Cursor of the rollup transaction
+        week_cutoff (date): Daily buckets before this are rolled up into weeks
+        month_cutoff (date): Weekly buckets before this are rolled up into months
+        retention_cutoff (date): Monthly buckets before this are deleted
+        """
+
+        for from_size, to_size, cutoff in (("day", "week", week_cutoff), ("week", "month", month_cutoff)):
+            cursor.execute(
+                """
+                WITH expired AS (
+                    DELETE FROM wordcloud_frequency_buckets
+                    WHERE bucket_size = %s AND bucket_start < %s
+                    RETURNING discord_user_id, bucket_start, word_id, frequency
+                )
+                INSERT INTO wordcloud_frequency_buckets (discord_user_id, bucket_start, bucket_size, word_id, frequency)
+                SELECT discord_user_id, date_trunc(%s, bucket_start)::date, %s, word_id, SUM(frequency)
+                FROM expired
+                GROUP BY discord_user_id, date_trunc(%s, bucket_start)::date, word_id
+                ON CONFLICT (discord_user_id, bucket_start, bucket_size, word_id)
+                DO UPDATE SET frequency = wordcloud_frequency_buckets.frequency + EXCLUDED.frequency
+                """,
+                (from_size, cutoff, to_size, to_size, to_size),
+            )
+
+        cursor.execute(
+            """
+            DELETE FROM wordcloud_frequency_buckets
+            WHERE bucket_size = 'month' AND bucket_start < %s
+            """,
+            (retention_cutoff,),
+        )
+
+    @tasks.loop(time=misc_utils.MIDNIGHT)
+    async def rollup_loop(self):
+        """
+        Flushes yesterday's words into their daily bucket and rolls up old buckets every midnight
+        """
+
+        self.bot.logger.info("Rolling up word cloud buckets...")
+
+        today = datetime.now(misc_utils.TIMEZONE).date()
+        await self.insert_cache(bucket_date=today - timedelta(days=1))
+
+        try:
+            await asyncio.to_thread(self.rollup_buckets, today)
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to roll up wordcloud buckets - {err}")
+        else:
+            self.rollup_cutoffs_applied = self.rollup_cutoffs(today)
+
+        try:
+            await self.archive.maintain(today)
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to maintain message archive segments - {err}")
 
     @commands.Cog.listener("on_message")
     async def word_freq_listener(self, message: discord.Message):
@@ -161,10 +828,45 @@ class WordCloud(commands.Cog):
 
         tokens = self.tokenize(message.clean_content)
 
-        for token in tokens:
-            # Enter into cache
-            # This may take a performance hit but who tf cares. We're using python anyway
-            self.word_freq_cache[message.author.id][token] += 1
+        # Enter into cache
+        # This may take a performance hit but who tf cares. We're using python anyway
+        self.word_freq_cache[message.author.id].update(tokens)
+        self.bigram_freq_cache[message.author.id].update(self.bigram_extractor(tokens))
+
+        self.archive.record(message, "create", tokens)
+
+        # Only public channels count towards server trends so words from private chats don't leak
+        if message.guild and message.channel.permissions_for(message.guild.default_role).read_messages:
+            self.trends.add(tokens, message.created_at)
+
+    @commands.Cog.listener("on_message_edit")
+    async def archive_edit_listener(self, before: discord.Message, after: discord.Message):
+        """
+        Archives edits of consenting users' messages. Word counts are left as they were
+
+        Parameters
+        ----------
+        before (discord.Message): The message before the edit
+        after (discord.Message): The message after the edit
+        """
+
+        if before.clean_content == after.clean_content or not self.can_count_message(after):
+            return
+
+        self.archive.record(after, "edit", self.tokenize(after.clean_content))
+
+    @commands.Cog.listener("on_message_delete")
+    async def archive_delete_listener(self, message: discord.Message):
+        """
+        Archives deletions of consenting users' messages
+
+        Parameters
+        ----------
+        message (discord.Message): The deleted message
+        """
+
+        if message.author.id in self.consenting_users:
+            self.archive.record(message, "delete")
 
     def can_count_message(self, message: discord.Message) -> bool:
         """
@@ -211,51 +913,63 @@ class WordCloud(commands.Cog):
 
             # Remove punctuation
             word = word.lower().strip("/+-=~|$%@#*_.,;:!?()[]{}<>\"'`\n")
-            if not word:
+            if not word or not wordcloud_vocabulary.is_storable(word):
                 continue
 
             tokens.append(word)
 
         return tokens
 
-    @staticmethod
-    def generate_wordcloud(text: str, max_words: int = 4000, allow_bigrams: bool = False) -> BytesIO:
+    async def render_wordcloud(self, interaction: discord.Interaction, **kwargs) -> BytesIO | None:
         """
-        Generates a wordcloud
+        Queues a word cloud render for the invoking user and reports their position in the queue.
+        Keyword arguments are passed on to the renderer
 
         Parameters
         ----------
-        text (str): Text to generate wordcloud from
-        max_words (int): Maximum number of words to include in the wordcloud. Defaults to 4000
-        allow_bigrams (bool): Whether to allow bigrams in the wordcloud. Defaults to False
+        interaction (discord.Interaction): Slash command context object. Must be deferred
 
         Returns
         ----------
-        BytesIO: BytesIO object containing the wordcloud image
+        (BytesIO | None): BytesIO object containing the wordcloud image. None if it could not be rendered
         """
 
-        filter_words = set(stopwords.words("norwegian") + stopwords.words("english"))
-        mask = np.array(Image.open("./src/assets/word_cloud_mask.png"))
+        try:
+            render = self.renderer.submit(interaction.user.id, **kwargs)
+        except AlreadyQueued:
+            await interaction.followup.send(embed=embed_templates.error_warning("Ordskyen din er allerede i køen"))
+            return
+        except RenderQueueFull:
+            await interaction.followup.send(embed=embed_templates.error_warning("Køen er full. Prøv igjen om litt"))
+            return
 
-        wc = WCloud(
-            max_words=max_words,
-            mask=mask,
-            repeat=False,
-            stopwords=filter_words,
-            min_word_length=3,
-            collocations=allow_bigrams,
-        )
-        wc.process_text(text)
-        wc.generate(text)
+        # Keep the queue position up to date until the render starts
+        shown_position = None
+        while not render.done():
+            position = self.renderer.queue_position(interaction.user.id)
+            if position and position != shown_position:
+                await interaction.edit_original_response(content=f"⏳ Du er nummer {position} i køen...")
+                shown_position = position
+            elif not position and shown_position:
+                await interaction.edit_original_response(content="⏳ Lager ordskyen...")
+                shown_position = None
+            await asyncio.wait((render,), timeout=QUEUE_POSITION_INTERVAL_SECONDS)
 
-        # Color the wordcloud based on the mask
-        # wc.recolor(color_func=ImageColorGenerator(mask))
+        try:
+            image = await render
+        except ValueError:  # Raised by the wordcloud library when there are no words left after filtering
+            await interaction.edit_original_response(
+                content=None, embed=embed_templates.error_warning(self.MSG_NO_DATA)
+            )
+            return
+        except BrokenProcessPool:
+            self.bot.logger.error("Word cloud worker process died while rendering")
+            await interaction.edit_original_response(
+                content=None, embed=embed_templates.error_fatal("Klarte ikke å lage ordskyen. Prøv igjen senere")
+            )
+            return
 
-        img = wc.to_image()
-        b = BytesIO()
-        img.save(b, "png")
-        b.seek(0)
-        return b
+        return BytesIO(image)
 
     wordcloud_group = app_commands.Group(
         name="ordsky", description="Generer en ordsky basert på dine mest frekvente sagte ord"
@@ -298,6 +1012,7 @@ class WordCloud(commands.Cog):
             )
 
         self.consenting_users.append(interaction.user.id)
+        self.data_versions[interaction.user.id] = 0
 
         embed = embed_templates.success(interaction, "Samtykke registrert!")
         await interaction.response.send_message(embed=embed, ephemeral=False)
@@ -314,72 +1029,130 @@ class WordCloud(commands.Cog):
         interaction (discord.Interaction): Slash command context object
         """
 
-        try:
-            self.consenting_users.remove(interaction.user.id)
-        except ValueError:
+        if interaction.user.id not in self.consenting_users:
             return await interaction.response.send_message(
                 embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=False
             )
 
-        self.word_freq_cache.pop(f"{interaction.user.id}", None)
+        # Waiting for a running flush can take a while
+        await interaction.response.defer()
 
-        try:
-            self.cursor.execute(
-                """
-                DELETE FROM wordcloud_metadata WHERE discord_user_id = %s;
-                DELETE FROM wordcloud_words WHERE discord_user_id = %s;
-                """,
-                (interaction.user.id, interaction.user.id),
-            )
-        except psycopg2.Error as err:
-            self.bot.db_connection.rollback()
-            self.bot.logger.error(f"Failed to delete wordcloud metadata from database - {err}")
-            return await interaction.response.send_message(
-                embed=embed_templates.error_fatal("Klarte ikke å slette fra database"),
-                ephemeral=False,
-            )
+        # A flush that is already writing would otherwise commit the user's words again after they're deleted
+        async with self.flush_lock:
+            self.consenting_users.remove(interaction.user.id)
+            self.word_freq_cache.pop(interaction.user.id, None)
+            self.bigram_freq_cache.pop(interaction.user.id, None)
+            self.data_versions.pop(interaction.user.id, None)
+            self.render_cache.invalidate(interaction.user.id)
+
+            try:
+                await self.archive.forget_user(interaction.user.id)
+                self.cursor.execute(
+                    """
+                    DELETE FROM wordcloud_metadata WHERE discord_user_id = %s;
+                    DELETE FROM wordcloud_frequencies WHERE discord_user_id = %s;
+                    DELETE FROM wordcloud_frequency_buckets WHERE discord_user_id = %s;
+                    DELETE FROM wordcloud_bigram_frequencies WHERE discord_user_id = %s;
+                    """,
+                    (interaction.user.id, interaction.user.id, interaction.user.id, interaction.user.id),
+                )
+                for table in self.legacy_tables:
+                    self.cursor.execute(f"DELETE FROM {table} WHERE discord_user_id = %s", (interaction.user.id,))
+            except psycopg2.Error as err:
+                self.bot.db_connection.rollback()
+                self.bot.logger.error(f"Failed to delete wordcloud metadata from database - {err}")
+                return await interaction.followup.send(
+                    embed=embed_templates.error_fatal("Klarte ikke å slette fra database"),
+                    ephemeral=False,
+                )
 
         embed = embed_templates.success("Meldingsdata er slettet!")
-        await interaction.response.send_message(embed=embed)
+        await interaction.followup.send(embed=embed)
 
     @app_commands.checks.bot_has_permissions(embed_links=True, attach_files=True)
     @app_commands.checks.cooldown(1, 10)
-    @wordcloud_group.command(name="data", description="Få tilsendt dine ordskydata i JSON-format")
-    async def data(self, interaction: discord.Interaction):
+    @wordcloud_group.command(name="data", description="Få tilsendt dine ordskydata som komprimert JSON Lines eller CSV")
+    async def data(self, interaction: discord.Interaction, filformat: Literal["jsonl", "csv"] = "jsonl"):
         """
         Få tilsendt dine data
 
         Parameters
         ----------
         interaction (discord.Interaction): Slash command context object
+        filformat (Literal["jsonl", "csv"]): Format of the exported files
         """
 
-        self.cursor.execute(
-            """
-            SELECT word, frequency
-            FROM wordcloud_words
-            WHERE discord_user_id = %s
-            ORDER BY frequency DESC
-            """,
-            (interaction.user.id,),
+        await interaction.response.defer(ephemeral=True)
+
+        # Include words said since the last flush
+        if interaction.user.id in self.word_freq_cache:
+            await self.insert_cache()
+
+        max_part_bytes = interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT_BYTES
+        exports = (
+            ("uiog_word_freqs", self.word_freqs_query(), ("word", "frequency")),
+            ("uiog_bigram_freqs", BIGRAM_EXPORT_QUERY, ("word", "next_word", "frequency")),
         )
-        result = self.cursor.fetchall()
 
-        if not result:
-            return await interaction.response.send_message(
-                embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=False
+        # Server-side cursors need a transaction, so exports get their own connection
+        files = []
+        connection = self.bot.connect_database()
+        try:
+            for name, query, columns in exports:
+                parts, row_count = await asyncio.to_thread(
+                    data_export.export_query,
+                    connection,
+                    query,
+                    {"user_id": interaction.user.id},
+                    columns,
+                    filformat,
+                    max_part_bytes,
+                )
+
+                if not row_count:
+                    for part in parts:
+                        part.close()
+                    continue
+
+                for i, part in enumerate(parts, start=1):
+                    part_suffix = f"_{i}" if len(parts) > 1 else ""
+                    size = part.seek(0, SEEK_END)
+                    part.seek(0)
+                    files.append(
+                        (
+                            discord.File(part, filename=f"{name}_{interaction.user.id}{part_suffix}.{filformat}.gz"),
+                            size,
+                        )
+                    )
+        except psycopg2.Error as err:
+            for file, _ in files:
+                file.close()
+            self.bot.logger.error(f"Failed to export wordcloud data - {err}")
+            return await interaction.followup.send(
+                embed=embed_templates.error_fatal("Klarte ikke å hente data fra databasen"), ephemeral=True
             )
+        finally:
+            connection.close()
 
-        freq_list = {f"{word}": freq for word, freq in result}
+        if not files:
+            return await interaction.followup.send(
+                embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=True
+            )
 
-        # Create Json file
-        buffer = StringIO()
-        buffer.write(json.dumps(freq_list, indent=4))
-        buffer.seek(0)
-        file = discord.File(buffer, filename=f"uiog_word_freqs_{interaction.user.id}.json")
+        # The upload limit applies to the total size of a message's attachments, and a message can have at most 10
+        messages = [[]]
+        message_bytes = 0
+        for file, size in files:
+            if messages[-1] and (len(messages[-1]) == 10 or message_bytes + size > max_part_bytes):
+                messages.append([])
+                message_bytes = 0
+            messages[-1].append(file)
+            message_bytes += size
 
         embed = discord.Embed(description="Her er dataen jeg har lagret om deg")
-        await interaction.response.send_message(embed=embed, file=file, ephemeral=True)
+        await interaction.followup.send(embed=embed, files=messages[0], ephemeral=True)
+        for message_files in messages[1:]:
+            await interaction.followup.send(files=message_files, ephemeral=True)
 
     @app_commands.checks.bot_has_permissions(embed_links=True, attach_files=True)
     @app_commands.checks.cooldown(1, 10)
@@ -398,63 +1171,134 @@ class WordCloud(commands.Cog):
         await interaction.response.defer()
 
         # Clear cache first to ensure correct count
-        await self.insert_cache()
+        # Not needed if the user hasn't said anything since the last flush
+        if interaction.user.id in self.word_freq_cache:
+            await self.insert_cache()
 
-        # Fetch word count from database
-        self.cursor.execute(
-            """
-            SELECT word, frequency
-            FROM wordcloud_words
-            WHERE discord_user_id = %s
-            """,
-            (interaction.user.id,),
+        # Reuse the last rendered word cloud if the user's data hasn't changed since
+        cache_key = RenderCache.make_key(
+            interaction.user.id, self.data_versions.get(interaction.user.id, 0), max_words=4000, phrases=True
         )
-        results = self.cursor.fetchall()
+        cached_word_cloud = await self.render_cache.get(cache_key)
 
-        if not results:
-            return await interaction.followup.send(
-                embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=False
-            )
+        # Fetch word count from database
+        if not cached_word_cloud:
+            results = self.fetch_word_freqs(interaction.user.id)
+
+            if not results:
+                return await interaction.followup.send(
+                    embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=False
+                )
 
         # Fetch tracking start time metadata
-        # This doesn't work most of the time so consider using the API call instead of cache call
-        # Or consider removing this feature entirely
+        # The stored ID is the consent interaction's ID, not a message, so there's nothing to fetch.
+        # The timestamp is encoded in the snowflake itself
         self.cursor.execute(
             """
-            SELECT tracked_since_message_channel_id, tracked_since_message_id
+            SELECT tracked_since_message_id
             FROM wordcloud_metadata
             WHERE discord_user_id = %s
             """,
             (interaction.user.id,),
         )
-        origin_msg_channel_id, origin_msg_id = self.cursor.fetchone()
+        origin_msg_id = self.cursor.fetchone()[0]
+        origin_msg_timestamp = discord.utils.format_dt(discord.utils.snowflake_time(origin_msg_id), style="f")
+
+        # Generate word cloud
+        if cached_word_cloud:
+            word_cloud = BytesIO(cached_word_cloud)
+        else:
+            word_freqs = self.fetch_phrase_freqs(interaction.user.id, dict(results))
+            word_cloud = await self.render_wordcloud(interaction, frequencies=word_freqs, max_words=4000)
+            if not word_cloud:
+                return
+            await self.render_cache.put(cache_key, word_cloud.getvalue())
+
+        word_cloud_file = discord.File(word_cloud, filename=f"wordcloud_{interaction.user.id}.png")
+        embed = discord.Embed(title="☁️ Her er ordskyen din! ☁️")
+        embed.description = f"Basert på de 4000 mest frekvente ordene dine siden {origin_msg_timestamp}"
+        embed.description += self.frequency_error_note(interaction.user.id)
+        embed.set_image(url=f"attachment://wordcloud_{interaction.user.id}.png")
+        await interaction.edit_original_response(content=None, embed=embed, attachments=[word_cloud_file])
+
+    @app_commands.checks.bot_has_permissions(embed_links=True, attach_files=True)
+    @app_commands.checks.cooldown(1, 10)
+    @wordcloud_generate_group.command(
+        name="periode", description="Generer en ordsky basert på dine mest frekvente sagte ord i en gitt periode"
+    )
+    async def generate_period(self, interaction: discord.Interaction, fra: str, til: str | None = None):
+        """
+        Generer en ordsky basert på dine mest frekvente sagte ord i en gitt periode
+
+        Parameters
+        ----------
+        interaction (discord.Interaction): Slash command context object
+        fra (str): Start date of the period in the format DD.MM.YYYY
+        til (str | None): End date of the period in the format DD.MM.YYYY. Defaults to today
+        """
+
         try:
-            origin_msg_channel = self.bot.get_channel(origin_msg_channel_id)
-            origin_msg = await origin_msg_channel.fetch_message(origin_msg_id)
-            origin_msg_timestamp = discord.utils.format_dt(origin_msg.created_at, style="f")
-        except discord.errors.NotFound:
-            origin_found = False
+            start = datetime.strptime(fra, "%d.%m.%Y").date()
+            end = datetime.strptime(til, "%d.%m.%Y").date() if til else datetime.now(misc_utils.TIMEZONE).date()
+        except ValueError:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Ugyldig dato. Bruk formatet DD.MM.ÅÅÅÅ"), ephemeral=True
+            )
+
+        if start > end:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Startdatoen må være før sluttdatoen"), ephemeral=True
+            )
+
+        await interaction.response.defer()
+
+        # Clear cache first to ensure correct count
+        if interaction.user.id in self.word_freq_cache:
+            await self.insert_cache()
+
+        cache_key = RenderCache.make_key(
+            interaction.user.id,
+            self.data_versions.get(interaction.user.id, 0),
+            max_words=4000,
+            start=start,
+            end=end,
+            rollup_cutoffs=self.rollup_cutoffs_applied,
+        )
+
+        if cached_word_cloud := await self.render_cache.get(cache_key):
+            word_cloud = BytesIO(cached_word_cloud)
         else:
-            origin_found = True
+            # Older buckets are coarser, so ranges reaching far back are widened to whole weeks or months
+            results = self.fetch_word_freqs(interaction.user.id, start, end)
 
-        # Converts the raw SQL results tuple to a string where
-        # each word occurs the x number of frequency that is provided
-        # Having to reconstruct the data this way is probably not optimal
-        text = " ".join(list(itertools.chain(*([word] * count for (word, count) in results))))
+            if not results:
+                return await interaction.followup.send(
+                    embed=embed_templates.error_warning("Fant ingen data om deg i denne perioden"), ephemeral=False
+                )
 
-        # Generate word cloud
-        generation_task = functools.partial(WordCloud.generate_wordcloud, text)
-        word_cloud = await self.bot.loop.run_in_executor(None, generation_task)
+            word_cloud = await self.render_wordcloud(interaction, frequencies=dict(results), max_words=4000)
+            if not word_cloud:
+                return
+            await self.render_cache.put(cache_key, word_cloud.getvalue())
 
         word_cloud_file = discord.File(word_cloud, filename=f"wordcloud_{interaction.user.id}.png")
         embed = discord.Embed(title="☁️ Her er ordskyen din! ☁️")
-        embed.description = "Basert på de 4000 mest frekvente ordene dine siden "
-        if origin_found:
-            embed.description += f"{origin_msg_timestamp}\n[Se melding]({origin_msg.jump_url})"
-        else:
-            embed.description += "`ukjent dato`"
+        embed.description = (
+            "Basert på de 4000 mest frekvente ordene dine fra "
+            + f"{discord.utils.format_dt(datetime.combine(start, datetime.min.time()), style='D')} til "
+            + f"{discord.utils.format_dt(datetime.combine(end, datetime.min.time()), style='D')}"
+            + self.frequency_error_note(interaction.user.id)
+        )
+
+        # Tell the user when the range starts inside a rolled up bucket, since the whole bucket is counted
+        week_cutoff, month_cutoff = self.rollup_cutoffs(datetime.now(misc_utils.TIMEZONE).date())
+        if start < month_cutoff:
+            embed.description += "\n\nEldre data er lagret per måned, så perioden kan være utvidet til hele måneder"
+        elif start < week_cutoff:
+            embed.description += "\n\nEldre data er lagret per uke, så perioden kan være utvidet til hele uker"
+
         embed.set_image(url=f"attachment://wordcloud_{interaction.user.id}.png")
-        await interaction.followup.send(embed=embed, file=word_cloud_file)
+        await interaction.edit_original_response(content=None, embed=embed, attachments=[word_cloud_file])
 
     @app_commands.checks.bot_has_permissions(embed_links=True, attach_files=True)
     @app_commands.checks.cooldown(1, 30)
@@ -477,8 +1321,7 @@ class WordCloud(commands.Cog):
         # This shouldn't be hard coded but eh
         board_member_role = interaction.guild.get_role(779849617651138601)
 
-        # This is horrible but there's a lot of edge cases to handle so spare me pls
-        all_messages = ""
+        channels = []
         for channel in interaction.guild.text_channels:
             if not channel.permissions_for(interaction.user).send_messages:
                 continue
@@ -491,28 +1334,78 @@ class WordCloud(commands.Cog):
             ):
                 continue
 
-            try:
-                # Limit search to half of requested messages to avoid rate limits
-                # We assume we can still fetch enough tokens to reach the requested amount
-                async for message in channel.history(limit=int(antall / 2)):
-                    if not self.can_count_message(message):
-                        continue
-
-                    filtered_msg = " ".join(self.tokenize(message.clean_content))
-                    all_messages += f"{filtered_msg} "
-            except discord.errors.Forbidden:
-                continue
+            channels.append(channel)
+
+        last_progress_edit = time.monotonic()
+
+        async def report_progress(progress: ScanProgress):
+            nonlocal last_progress_edit
 
-        if not all_messages:
+            # Message edits are rate limited too, so don't report more often than every other second
+            if time.monotonic() - last_progress_edit < 2:
+                return
+            last_progress_edit = time.monotonic()
+
+            await interaction.edit_original_response(
+                content=f"🔍 Leser kanaler... {progress.channels_done}/{progress.channels_total} "
+                + f"({progress.tokens} ord funnet)"
+            )
+
+        # The token budget lets us stop early once there's enough words to fill the requested cloud
+        token_budget = antall * SCAN_TOKENS_PER_WORD
+
+        # Prefer the local archive. Scan through the API for whatever it can't cover (e.g. right after deploying)
+        word_freqs = Counter()
+        bigram_freqs = Counter()
+        try:
+            # Same limit per channel as the API scan below
+            archived_messages = await self.archive.recent_tokens(
+                [channel.id for channel in channels], limit=int(antall / 2)
+            )
+        except psycopg2.Error as err:
+            self.bot.logger.error(f"Failed to read message archive - {err}")
+            archived_messages = []
+
+        token_count = 0
+        archived_message_ids = set()
+        for message_id, tokens in archived_messages:
+            word_freqs.update(tokens)
+            bigram_freqs.update(self.bigram_extractor(tokens))
+            archived_message_ids.add(message_id)
+            token_count += len(tokens)
+            if token_count >= token_budget:
+                break
+
+        if token_count < token_budget:
+            # Messages already counted from the archive are skipped so nothing is counted twice
+            scanner = HistoryScanner(
+                lambda message: message.id not in archived_message_ids and self.can_count_message(message),
+                self.tokenize,
+                self.bigram_extractor,
+            )
+            # Limit search to half of requested messages per channel to avoid rate limits
+            scanned_word_freqs, scanned_bigram_freqs, _ = await scanner.scan(
+                channels,
+                limit=int(antall / 2),
+                token_budget=token_budget - token_count,
+                on_progress=report_progress,
+            )
+            word_freqs.update(scanned_word_freqs)
+            bigram_freqs.update(scanned_bigram_freqs)
+
+        if not word_freqs:
             return await interaction.followup.send(
                 embed=embed_templates.error_warning(self.MSG_NO_DATA), ephemeral=False
             )
 
-        # Generate word cloud
-        generation_task = functools.partial(
-            WordCloud.generate_wordcloud, all_messages, max_words=1000, allow_bigrams=True
+        word_freqs = collocations.merge_collocations(
+            word_freqs, collocations.find_collocations(word_freqs, bigram_freqs)
         )
-        word_cloud = await self.bot.loop.run_in_executor(None, generation_task)
+
+        # Generate word cloud
+        word_cloud = await self.render_wordcloud(interaction, frequencies=word_freqs, max_words=1000)
+        if not word_cloud:
+            return
 
         word_cloud_file = discord.File(word_cloud, filename=f"wordcloud_{interaction.user.id}.png")
         embed = discord.Embed(title="☁️ Her er ordskyen din! ☁️")
@@ -521,7 +1414,67 @@ class WordCloud(commands.Cog):
             + f"topp {antall} mest frekvente ord i dine meldinger"
         )
         embed.set_image(url=f"attachment://wordcloud_{interaction.user.id}.png")
-        await interaction.followup.send(embed=embed, file=word_cloud_file)
+        await interaction.edit_original_response(content=None, embed=embed, attachments=[word_cloud_file])
+
+    @app_commands.checks.bot_has_permissions(embed_links=True)
+    @app_commands.checks.cooldown(1, 10)
+    @wordcloud_group.command(name="trender", description="Se hvilke ord som er mer populære enn vanlig på serveren")
+    async def trends_list(self, interaction: discord.Interaction):
+        """
+        Se hvilke ord som er mer populære enn vanlig på serveren
+
+        Parameters
+        ----------
+        interaction (discord.Interaction): Slash command context object
+        """
+
+        trending = self.trends.trending(datetime.now(misc_utils.TIMEZONE))
+
+        if not trending:
+            return await interaction.response.send_message(
+                embed=embed_templates.error_warning("Ingen ord trender akkurat nå"), ephemeral=False
+            )
+
+        embed = discord.Embed(title="📈 Trender på serveren 📈")
+        embed.description = "\n".join(
+            f"**#{i}** {word} - {count} ganger, {score:.1f}x mer enn vanlig"
+            for i, (word, count, score) in enumerate(trending, start=1)
+        )
+        embed.set_footer(text=f"Siste {self.trends.window_hours} timer sammenlignet med resten av uka")
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.checks.bot_has_permissions(embed_links=True, attach_files=True)
+    @app_commands.checks.cooldown(1, 30)
+    @wordcloud_generate_group.command(
+        name="server", description="Generer en ordsky basert på de mest frekvente ordene på serveren siste uke"
+    )
+    async def generate_server(self, interaction: discord.Interaction):
+        """
+        Generer en ordsky basert på de mest frekvente ordene på serveren siste uke
+
+        Parameters
+        ----------
+        interaction (discord.Interaction): Slash command context object
+        """
+
+        await interaction.response.defer()
+
+        word_freqs = self.trends.totals(datetime.now(misc_utils.TIMEZONE))
+
+        if not word_freqs:
+            return await interaction.followup.send(
+                embed=embed_templates.error_warning("Fant ingen data om serveren"), ephemeral=False
+            )
+
+        word_cloud = await self.render_wordcloud(interaction, frequencies=word_freqs, max_words=1000)
+        if not word_cloud:
+            return
+
+        word_cloud_file = discord.File(word_cloud, filename="wordcloud_server.png")
+        embed = discord.Embed(title="☁️ Her er serverens ordsky! ☁️")
+        embed.description = "Basert på de 1000 mest frekvente ordene i offentlige kanaler siste uke"
+        embed.set_image(url="attachment://wordcloud_server.png")
+        await interaction.edit_original_response(content=None, embed=embed, attachments=[word_cloud_file])
 
 
 async def setup(bot: commands.Bot):
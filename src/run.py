@@ -46,12 +46,7 @@ class Bot(commands.Bot):
 
         # Check for missing credentials
         if self.check_credentials(config["database"], DATABASE_RELIANT_COGS):
-            self.db_connection = psycopg2.connect(
-                host=config["database"]["host"],
-                dbname=config["database"]["dbname"],
-                user=config["database"]["username"],
-                password=config["database"]["password"],
-            )
+            self.db_connection = self.connect_database()
             self.db_connection.autocommit = True  # Scary
 
         if self.check_credentials(config["sanity"], SANITY_RELIANT_COGS):
@@ -70,6 +65,7 @@ class Bot(commands.Bot):
         self.presence = config["bot"].get("presence", {})
         self.emoji = config.get("emoji", {})
         self.misc = config.get("misc", {})
+        self.wordcloud = config.get("wordcloud", {})
 
     async def setup_hook(self):
         # Load cogs
@@ -85,6 +81,23 @@ class Bot(commands.Bot):
             self.tree.copy_global_to(guild=discord.Object(id=self.guild_id))
             await self.tree.sync(guild=discord.Object(id=self.guild_id))
 
+    def connect_database(self) -> psycopg2.extensions.connection:
+        """
+        Opens a new database connection. Cogs that need transactions or work outside the event loop
+        should use their own connection instead of the shared autocommit one
+
+        Returns
+        ----------
+        (psycopg2.extensions.connection): The new connection
+        """
+
+        return psycopg2.connect(
+            host=config["database"]["host"],
+            dbname=config["database"]["dbname"],
+            user=config["database"]["username"],
+            password=config["database"]["password"],
+        )
+
     def check_credentials(self, credentials: dict, dependant_cogs: set[str]) -> bool:
         """
         Check if the credentials are valid. Removes cogs from the class' `cog_files` attribute if not